@@ -0,0 +1,13 @@
+import pytest
+
+import deeptools
+
+
+@pytest.fixture(scope="session", autouse=True)
+def cacheDir():
+    """
+    The package fixture of deeptools (used by nose), for pytest
+    """
+    deeptools.setup_package()
+    yield
+    deeptools.teardown_package()
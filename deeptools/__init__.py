@@ -0,0 +1,30 @@
+import os
+import shutil
+import tempfile
+
+_cacheDir = None
+_oldCacheDir = None
+
+
+def setup_package():
+    """
+    Test fixture of the whole package (used by nose, and by conftest.py for
+    pytest), so that the tests and doctests keep their cached statistics and
+    indices (see deeptools.bamStats) in a temporary directory rather than the
+    user's cache directory
+    """
+    global _cacheDir, _oldCacheDir
+    _oldCacheDir = os.environ.get('DEEPTOOLS_CACHE_DIR')
+    _cacheDir = tempfile.mkdtemp()
+    os.environ['DEEPTOOLS_CACHE_DIR'] = _cacheDir
+
+
+def teardown_package():
+    global _cacheDir
+    if _oldCacheDir is None:
+        os.environ.pop('DEEPTOOLS_CACHE_DIR', None)
+    else:
+        os.environ['DEEPTOOLS_CACHE_DIR'] = _oldCacheDir
+    if _cacheDir is not None:
+        shutil.rmtree(_cacheDir, ignore_errors=True)
+    _cacheDir = None
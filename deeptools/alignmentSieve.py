@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 import argparse
+import copy
+import json
+import numpy as np
 import pysam
+import pyBigWig
 import os
+import shlex
+import shutil
 import sys
 
-from deeptools import parserCommon
+from deeptools import parserCommon, bamWriter
 from deeptools.bamHandler import openBam
 from deeptools.mapReduce import mapReduce
 from deeptools._version import __version__
@@ -76,6 +82,27 @@ def parseArguments():
                         action='store_true',
                         help='Instead of producing BAM files, write output in BEDPE format (as defined by MACS2). Note that only reads/fragments passing filtering criterion are written in BEDPE format.')
 
+    output.add_argument('--fragmentCoverage',
+                        metavar='FILE.bw',
+                        help='Also write the coverage of the fragments passing the filtering criteria (as they would be '
+                        'written with --BED, so including any shift) to this bigWig file. Each position holds the number '
+                        'of fragments covering it. This is computed in the same pass as the other output, --outFile can '
+                        'then be omitted if only the coverage is needed.')
+
+    output.add_argument('--outputs',
+                        metavar='FILE',
+                        help='A JSON (or YAML, if PyYAML is installed) file listing further outputs, which are all '
+                        'produced in a single pass over the BAM file. Each entry holds the command line arguments '
+                        'of an output (filters, shift, --BED, --outFile, --filteredOutReads, --filterMetrics, ...) '
+                        'without --bam and optionally a label for its --filterMetrics, for example: '
+                        '[{"args": "--ATACshift -o shifted.bam"}, '
+                        '{"args": "--BED -o fragments.bedpe --filterMetrics metrics.txt", "label": "fragments"}, '
+                        '{"args": "--maxFragmentLength 150 -o nucleosomeFree.bam"}]. Filter, shift and format '
+                        'options given on the command line are the defaults of every entry, which can override '
+                        'them (but not turn off flags such as --BED). --blackListFileName and --numberOfProcessors '
+                        'apply to all outputs and are only taken from the command line. If --outFile or '
+                        '--fragmentCoverage is also given on the command line, then that is an output as well.')
+
     filtering = parser.add_argument_group('Optional arguments')
 
     filtering.add_argument('--filterRNAstrand',
@@ -201,26 +228,135 @@ def shiftRead(b, chromDict, args):
     return b2
 
 
+def passesFilters(read, args, dupState):
+    """
+    Whether a read passes the filters in args. dupState holds the recently
+    seen positions for --ignoreDuplicates and must be kept between calls.
+    """
+    if read.flag & 4:
+        # Ignore unmapped reads, they were counted already
+        return False
+
+    if args.minMappingQuality and read.mapq < args.minMappingQuality:
+        return False
+
+    if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
+        return False
+    if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
+        return False
+
+    tLen = getTLen(read)
+    if args.minFragmentLength > 0 and tLen < args.minFragmentLength:
+        return False
+    if args.maxFragmentLength > 0 and tLen > args.maxFragmentLength:
+        return False
+
+    if args.ignoreDuplicates:
+        # Assuming more or less concordant reads, use the fragment bounds, otherwise the start positions
+        if tLen >= 0:
+            s = read.pos
+            e = s + tLen
+        else:
+            s = read.pnext
+            e = s - tLen
+        if read.reference_id != read.next_reference_id:
+            e = read.pnext
+        if dupState['lpos'] is not None and dupState['lpos'] == read.reference_start \
+                and (s, e, read.next_reference_id, read.is_reverse) in dupState['prev_pos']:
+            return False
+        if dupState['lpos'] != read.reference_start:
+            dupState['prev_pos'].clear()
+        dupState['lpos'] = read.reference_start
+        dupState['prev_pos'].add((s, e, read.next_reference_id, read.is_reverse))
+
+    # filterRNAstrand
+    if args.filterRNAstrand:
+        if read.is_paired:
+            if args.filterRNAstrand == 'forward':
+                if not (read.flag & 144 == 128 or read.flag & 96 == 64):
+                    return False
+            elif args.filterRNAstrand == 'reverse':
+                if not (read.flag & 144 == 144 or read.flag & 96 == 96):
+                    return False
+        else:
+            if args.filterRNAstrand == 'forward':
+                if read.flag & 16 != 16:
+                    return False
+            elif args.filterRNAstrand == 'reverse':
+                if read.flag & 16 != 0:
+                    return False
+
+    return True
+
+
+def addFragment(b, chromLen, starts, ends):
+    """
+    Appends the bounds of the fragment of a read (as written with --BED), if
+    it has one
+    """
+    tLen = getTLen(b, notAbs=True)
+    if tLen > 0:
+        start = b.pos
+        end = start + tLen
+        if end > chromLen:
+            end = chromLen
+        if end - start > 0:
+            starts.append(start)
+            ends.append(end)
+
+
+def writeFragments(fname, chrom, starts, ends):
+    """
+    Stores fragments in BEDPE format, which is:
+    chromosome	frag_leftend	frag_rightend
+    """
+    with open(fname, "w") as ofile:
+        ofile.write("".join(["{}\t{}\t{}\n".format(chrom, s, e) for s, e in zip(starts, ends)]))
+
+
 def filterWorker(arglist):
-    chrom, start, end, args, chromDict = arglist
-    fh = openBam(args.bam)
+    """
+    Filters the reads starting in a region for each of the outputs, which
+    are given as a list of their arguments (or a single one), with a single
+    pass over the reads. Reads are written to temporary BAM files, while
+    for --BED and --fragmentCoverage only the fragment bounds are kept.
+
+    Returns the TID, start and end of the region, the number of reads in it
+    and, for each output, the number of reads filtered out and the
+    temporary files with the reads that passed and didn't pass the filters
+    and with the fragments for the coverage.
+    """
+    chrom, start, end, outputs, chromDict = arglist
+    if not isinstance(outputs, list):
+        outputs = [outputs]
+    fh = openBam(outputs[0].bam)
+    chromLen = chromDict[chrom]
 
     mode = 'wbu'
-    oname = getTempFileName(suffix='.bam')
-    if args.filteredOutReads:
-        onameFiltered = getTempFileName(suffix='.bam')
-    else:
-        onameFiltered = None
-    ofh = pysam.AlignmentFile(oname, mode=mode, template=fh)
-    if onameFiltered:
-        ofiltered = pysam.AlignmentFile(onameFiltered, mode=mode, template=fh)
-    else:
-        ofiltered = None
-
-    prev_pos = set()
-    lpos = None
+    outs = []
+    for args in outputs:
+        out = {'args': args,
+               'nFiltered': 0,
+               'dupState': {'lpos': None, 'prev_pos': set()},
+               'oname': None,
+               'onameFiltered': None,
+               'ofh': None,
+               'ofiltered': None,
+               'frags': None,
+               'fragsFiltered': None}
+        if args.BED or args.fragmentCoverage:
+            out['frags'] = ([], [])
+        if args.outFile and not args.BED:
+            out['oname'] = getTempFileName(suffix='.bam')
+            out['ofh'] = pysam.AlignmentFile(out['oname'], mode=mode, template=fh)
+        if args.filteredOutReads:
+            if args.BED:
+                out['fragsFiltered'] = ([], [])
+            else:
+                out['onameFiltered'] = getTempFileName(suffix='.bam')
+                out['ofiltered'] = pysam.AlignmentFile(out['onameFiltered'], mode=mode, template=fh)
+        outs.append(out)
 
-    nFiltered = 0
     total = 0
     for read in fh.fetch(chrom, start, end):
         if read.pos < start:
@@ -228,146 +364,151 @@ def filterWorker(arglist):
             continue
 
         total += 1
-        if read.flag & 4:
-            # Ignore unmapped reads, they were counted already
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        if args.minMappingQuality and read.mapq < args.minMappingQuality:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-        if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        tLen = getTLen(read)
-        if args.minFragmentLength > 0 and tLen < args.minFragmentLength:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-        if args.maxFragmentLength > 0 and tLen > args.maxFragmentLength:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        if args.ignoreDuplicates:
-            # Assuming more or less concordant reads, use the fragment bounds, otherwise the start positions
-            if tLen >= 0:
-                s = read.pos
-                e = s + tLen
-            else:
-                s = read.pnext
-                e = s - tLen
-            if read.reference_id != read.next_reference_id:
-                e = read.pnext
-            if lpos is not None and lpos == read.reference_start \
-                    and (s, e, read.next_reference_id, read.is_reverse) in prev_pos:
-                nFiltered += 1
-                if ofiltered:
-                    ofiltered.write(read)
-                continue
-            if lpos != read.reference_start:
-                prev_pos.clear()
-            lpos = read.reference_start
-            prev_pos.add((s, e, read.next_reference_id, read.is_reverse))
-
-        # filterRNAstrand
-        if args.filterRNAstrand:
-            if read.is_paired:
-                if args.filterRNAstrand == 'forward':
-                    if read.flag & 144 == 128 or read.flag & 96 == 64:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-                elif args.filterRNAstrand == 'reverse':
-                    if read.flag & 144 == 144 or read.flag & 96 == 96:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-            else:
-                if args.filterRNAstrand == 'forward':
-                    if read.flag & 16 == 16:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-                elif args.filterRNAstrand == 'reverse':
-                    if read.flag & 16 == 0:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-
-        if args.shift:
-            read = shiftRead(read, chromDict, args)
-            if not read:
+        for out in outs:
+            args = out['args']
+            if not passesFilters(read, args, out['dupState']):
+                out['nFiltered'] += 1
+                if out['ofiltered']:
+                    out['ofiltered'].write(read)
+                elif out['fragsFiltered']:
+                    addFragment(read, chromLen, *out['fragsFiltered'])
                 continue
 
-        # Read survived filtering
-        ofh.write(read)
+            if args.shift:
+                read2 = shiftRead(read, chromDict, args)
+                if not read2:
+                    continue
+            else:
+                read2 = read
+            # Read survived filtering
+            if out['ofh']:
+                out['ofh'].write(read2)
+            if out['frags']:
+                addFragment(read2, chromLen, *out['frags'])
 
     # The results from the workers will get sorted, so get the TID
     tid = fh.get_tid(chrom)
-
-    ofh.close()
-    if ofiltered:
-        ofiltered.close()
     fh.close()
-    return tid, start, total, nFiltered, oname, onameFiltered
+
+    res = []
+    for out in outs:
+        args = out['args']
+        onameCoverage = None
+
+        # Compress the output here, so the parent only needs to append the files
+        if out['ofh']:
+            out['ofh'].close()
+            bamWriter.finishChunk(out['oname'])
+        if out['ofiltered']:
+            out['ofiltered'].close()
+            bamWriter.finishChunk(out['onameFiltered'])
+
+        if args.BED and args.outFile:
+            out['oname'] = getTempFileName(suffix='.bed')
+            writeFragments(out['oname'], chrom, *out['frags'])
+        if out['fragsFiltered']:
+            out['onameFiltered'] = getTempFileName(suffix='.bed')
+            writeFragments(out['onameFiltered'], chrom, *out['fragsFiltered'])
+        if args.fragmentCoverage:
+            onameCoverage = getTempFileName(suffix='.npy')
+            np.save(onameCoverage, np.array(out['frags'], dtype=np.int64).reshape(2, -1))
+        res.append((out['nFiltered'], out['oname'], out['onameFiltered'], onameCoverage))
+    return tid, start, end, total, res
+
+
+def catFiles(oname, tmpFiles):
+    """
+    Concatenates text files, deleting them
+    """
+    with open(oname, "w") as ofile:
+        for tmpFile in tmpFiles:
+            with open(tmpFile) as fh:
+                shutil.copyfileobj(fh, ofile)
+            os.unlink(tmpFile)
 
 
-def convertBED(oname, tmpFiles, chromDict):
+def coverageRuns(starts, ends, lo, hi):
     """
-    Stores results in BEDPE format, which is:
-    chromosome	frag_leftend	frag_rightend
+    The number of fragments [starts, ends) covering each position of
+    [lo, hi), as the starts, ends and values of the runs of nonzero coverage
 
-    The fragment ends can be shifted
+    >>> coverageRuns(np.array([0, 5, 5, 20]), np.array([10, 10, 12, 30]), 2, 25)
+    (array([ 2,  5, 10, 20]), array([ 5, 10, 12, 25]), array([1, 3, 1, 1]))
     """
-    ofile = open(oname, "w")
-    for tmpFile in tmpFiles:
-        fh = pysam.AlignmentFile(tmpFile)
-
-        for b in fh.fetch(until_eof=True):
-            tLen = getTLen(b, notAbs=True)
-            if tLen > 0:
-                start = b.pos
-                end = start + tLen
-                if end > chromDict[b.reference_name]:
-                    end = chromDict[b.reference_name]
-                if end - start < 1:
-                    continue
-                ofile.write("{}\t{}\t{}\n".format(b.reference_name, start, end))
-        fh.close()
+    starts = np.maximum(starts, lo)
+    ends = np.minimum(ends, hi)
+    keep = ends > starts
+    if not keep.any():
+        return starts[keep], ends[keep], np.zeros(0, dtype=np.int64)
+    pos = np.concatenate([starts[keep], ends[keep]])
+    delta = np.repeat([1, -1], keep.sum())
+    order = np.argsort(pos, kind='mergesort')
+    pos = pos[order]
+    depth = np.cumsum(delta[order])
+
+    # Keep the coverage after the last change at each position
+    last = np.r_[pos[1:] != pos[:-1], True]
+    pos = pos[last]
+    depth = depth[last]
+
+    # Merge neighbouring runs with the same coverage
+    change = np.r_[True, depth[1:-1] != depth[:-2]]
+    runStarts = pos[:-1][change]
+    runEnds = np.r_[runStarts[1:], pos[-1:]]
+    values = depth[:-1][change]
+    nonzero = values > 0
+    return runStarts[nonzero], runEnds[nonzero], values[nonzero]
+
+
+def writeFragmentCoverage(fname, chunks, chromSizes, maxShift=0):
+    """
+    Writes the fragment coverage to a bigWig file. chunks lists, in order,
+    the chromosome, start and end of each region processed by filterWorker()
+    and the file with its fragments. Fragments can extend beyond the end of
+    their region and shifting can move them up to maxShift bases before its
+    start, so the coverage is written up to where the following region can
+    no longer change it.
+    """
+    bw = pyBigWig.open(fname, "w")
+    bw.addHeader(chromSizes, maxZooms=10)
+    chromDict = dict(chromSizes)
+    starts = np.zeros(0, dtype=np.int64)
+    ends = np.zeros(0, dtype=np.int64)
+    done = 0
+    for i, (chrom, start, end, tmpFile) in enumerate(chunks):
+        frags = np.load(tmpFile)
         os.unlink(tmpFile)
-    ofile.close()
+        starts = np.concatenate([starts, frags[0]])
+        ends = np.concatenate([ends, frags[1]])
+        if i + 1 < len(chunks) and chunks[i + 1][0] == chrom:
+            hi = max(done, chunks[i + 1][1] - maxShift)
+        else:
+            hi = chromDict[chrom]
 
+        runStarts, runEnds, values = coverageRuns(starts, ends, done, hi)
+        if len(runStarts):
+            bw.addEntries([chrom] * len(runStarts), runStarts.tolist(),
+                          ends=runEnds.tolist(), values=values.astype(float).tolist())
 
-def main(args=None):
-    args = parseArguments().parse_args(args)
+        if hi == chromDict[chrom]:
+            keep = np.zeros(len(ends), dtype=bool)
+            done = 0
+        else:
+            keep = ends > hi
+            done = hi
+        starts = starts[keep]
+        ends = ends[keep]
+    bw.close()
+
+
+# The options naming the files written for an output
+OUTPUT_FILES = ['outFile', 'filteredOutReads', 'filterMetrics', 'fragmentCoverage']
+
+
+def processArgs(args):
+    """
+    Checks the arguments of an output and expands its shift
+    """
     if args.shift:
         if len(args.shift) not in [2, 4]:
             sys.exit("The --shift option can accept either 2 or 4 values only.")
@@ -375,44 +516,81 @@ def main(args=None):
             args.shift.extend([-args.shift[1], -args.shift[0]])
     elif args.ATACshift:
         args.shift = [4, -5, 5, -4]
+    if not args.outFile and not args.fragmentCoverage:
+        sys.exit("An output file must be specified with --outFile (or --fragmentCoverage).")
+    return args
 
-    bam, mapped, unmapped, stats = openBam(args.bam, returnStats=True, nThreads=args.numberOfProcessors)
-    total = mapped + unmapped
-    chrom_sizes = [(x, y) for x, y in zip(bam.references, bam.lengths)]
-    chromDict = {x: y for x, y in zip(bam.references, bam.lengths)}
-
-    # Filter, writing the results to a bunch of temporary files
-    res = mapReduce([args, chromDict],
-                    filterWorker,
-                    chrom_sizes,
-                    blackListFileName=args.blackListFileName,
-                    numberOfProcessors=args.numberOfProcessors,
-                    verbose=args.verbose)
 
-    res = sorted(res)  # The temp files are now in order for concatenation
-    nFiltered = sum([x[3] for x in res])
-    totalSeen = sum([x[2] for x in res])  # The * contig isn't queried
-
-    tmpFiles = [x[4] for x in res]
-    if not args.BED:
-        arguments = ["-o", args.outFile]
-        arguments.extend(tmpFiles)  # [..., *someList] isn't available in python 2.7
-        pysam.samtools.cat(*arguments)
-        for tmpFile in tmpFiles:
-            os.unlink(tmpFile)
+def loadOutputs(fname, args):
+    """
+    Returns the arguments of each of the outputs listed in a JSON/YAML file.
+    The filter, shift and format options in args are the defaults of each
+    output, while the output files are only taken from the entries.
+    """
+    with open(fname) as fh:
+        s = fh.read()
+    if fname.endswith(".yaml") or fname.endswith(".yml"):
+        try:
+            import yaml
+        except ImportError:
+            sys.exit("PyYAML must be installed to read {}\n".format(fname))
+        outputs = yaml.safe_load(s)
     else:
-        convertBED(args.outFile, tmpFiles, chromDict)
+        outputs = json.loads(s)
+
+    defaults = copy.deepcopy(args)
+    for name in OUTPUT_FILES:
+        setattr(defaults, name, None)
+    defaults.outputs = None
+    defaults.blackListFileName = None
+
+    res = []
+    for output in outputs:
+        label = None
+        if isinstance(output, dict):
+            unknown = set(output.keys()) - set(['args', 'label'])
+            if unknown:
+                sys.exit("Unknown keys in an entry of {}: {}. Only 'args' and 'label' are allowed.\n".format(fname, ", ".join(sorted(unknown))))
+            label = output.get('label')
+            output = output.get('args', [])
+        if not isinstance(output, list):
+            output = shlex.split(output)
+        outputArgs = parseArguments().parse_args(['--bam', args.bam] + [str(x) for x in output],
+                                                 namespace=copy.deepcopy(defaults))
+        if outputArgs.outputs or outputArgs.blackListFileName:
+            sys.exit("--outputs and --blackListFileName can only be given on the command line, not in {}\n".format(fname))
+        if label is not None:
+            outputArgs.label = str(label)
+        res.append(processArgs(outputArgs))
+    return res
+
+
+def writeOutput(args, results, bam, chromDict, total):
+    """
+    Concatenates the temporary files of an output and writes its metrics
+    """
+    nFiltered = sum([x[4] for x in results])
+    totalSeen = sum([x[3] for x in results])  # The * contig isn't queried
+
+    if args.outFile:
+        tmpFiles = [x[5] for x in results]
+        if not args.BED:
+            header = bamWriter.bamHeader(bam)
+            bamWriter.writeBAM(args.outFile, header, [(x, None) for x in tmpFiles])
+        else:
+            catFiles(args.outFile, tmpFiles)
 
     if args.filteredOutReads:
-        tmpFiles = [x[5] for x in res]
+        tmpFiles = [x[6] for x in results]
         if not args.BED:
-            arguments = ["-o", args.filteredOutReads]
-            arguments.extend(tmpFiles)  # [..., *someList] isn't available in python 2.7
-            pysam.samtools.cat(*arguments)
-            for tmpFile in tmpFiles:
-                os.unlink(tmpFile)
+            bamWriter.writeBAM(args.filteredOutReads, bamWriter.bamHeader(bam), [(x, None) for x in tmpFiles])
         else:
-            convertBED(args.outFile, tmpFiles, chromDict, args)
+            catFiles(args.filteredOutReads, tmpFiles)
+
+    if args.fragmentCoverage:
+        chunks = [(bam.references[x[0]], x[1], x[2], x[7]) for x in results]
+        maxShift = max([abs(x) for x in args.shift]) if args.shift else 0
+        writeFragmentCoverage(args.fragmentCoverage, chunks, list(zip(bam.references, bam.lengths)), maxShift)
 
     if args.filterMetrics:
         sampleName = args.bam
@@ -427,4 +605,35 @@ def main(args=None):
         of.write("{}\t{}\t{}\n".format(sampleName, totalSeen - nFiltered, total))
         of.close()
 
+
+def main(args=None):
+    args = parseArguments().parse_args(args)
+    outputs = []
+    if args.outFile or args.fragmentCoverage or not args.outputs:
+        outputs.append(processArgs(args))
+    elif args.filteredOutReads or args.filterMetrics:
+        sys.exit("--filteredOutReads and --filterMetrics on the command line require --outFile or --fragmentCoverage, "
+                 "use them in the entries of --outputs instead.\n")
+    if args.outputs:
+        outputs.extend(loadOutputs(args.outputs, args))
+
+    bam, mapped, unmapped, stats = openBam(args.bam, returnStats=True, nThreads=args.numberOfProcessors)
+    total = mapped + unmapped
+    chrom_sizes = [(x, y) for x, y in zip(bam.references, bam.lengths)]
+    chromDict = {x: y for x, y in zip(bam.references, bam.lengths)}
+
+    # Filter for all outputs at once, writing the results to a bunch of
+    # temporary files
+    res = mapReduce([outputs, chromDict],
+                    filterWorker,
+                    chrom_sizes,
+                    blackListFileName=args.blackListFileName,
+                    numberOfProcessors=args.numberOfProcessors,
+                    verbose=args.verbose)
+
+    res = sorted(res)  # The temp files are now in order for concatenation
+    for i, outputArgs in enumerate(outputs):
+        results = [x[:4] + x[4][i] for x in res]
+        writeOutput(outputArgs, results, bam, chromDict, total)
+
     return 0
@@ -27,7 +27,14 @@ def getMappingStats(bam, nThreads):
     This is used for CRAM files, since idxstats() and .mapped/.unmapped are meaningless
 
     This requires pysam > 0.13.0
+
+    The results are cached, see bamStats.
     """
+    from deeptools import bamStats
+    cached = bamStats.getCached(bam.filename, 'mappingStats')
+    if cached is not None:
+        return cached['mapped'], cached['unmapped'], cached['stats']
+
     header = [(x, y) for x, y in zip(bam.references, bam.lengths)]
     res = mapReduce([bam.filename, False], countReadsInInterval, header, numberOfProcessors=nThreads)
 
@@ -41,6 +48,7 @@ def getMappingStats(bam, nThreads):
     # We need to count the number of unmapped reads as well
     unmapped += bam.count("*")
 
+    bamStats.setCached(bam.filename, 'mappingStats', {'mapped': mapped, 'unmapped': unmapped, 'stats': stats})
     return mapped, unmapped, stats
 
 
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Statistics of BAM files that take a full pass over the file are cached in
+small JSON files, one per BAM file and statistic, so that later runs (of the
+same or another tool) can reuse them. These are kept in $DEEPTOOLS_CACHE_DIR
+(by default ~/.cache/deeptools, set it to an empty value to disable the
+cache), which is only used if it belongs to the current user and isn't
+writable by others, in a directory named after the absolute path of the BAM
+file. Cached values are discarded once the size, modification time or inode
+of the BAM file changes.
+
+The following are cached, each under its own key:
+
+ * mappingStats: the mapped and unmapped reads per chromosome of CRAM files
+   (bamHandler.getMappingStats())
+ * blacklisted:<blacklist>: the alignments per chromosome within the
+   regions of a blacklist (utilities.bam_blacklisted_reads())
+ * filterCounts:<settings>: the alignments per chromosome filtered for each
+   reason (exactFilterCounts())
+ * fractionKept:<settings>: the sampled fraction of alignments kept by
+   bamCoverage and bamCompare (getScaleFactor.fraction_kept())
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+from deeptoolsintervals.index import privateDirectory
+from deeptools import bamHandler
+from deeptools.mapReduce import mapReduce
+from deeptools.utilities import getTLen
+
+# The counts of countFilters_worker(), in order
+FILTER_COUNTS = ['total', 'filtered', 'kept', 'minMappingQuality', 'samFlagInclude', 'samFlagExclude',
+                 'fragmentLength', 'internalDupes', 'externalDupes', 'singletons', 'filterRNAstrand']
+
+
+def cacheDir():
+    """
+    The directory holding the cached statistics, or None if caching is
+    disabled or the directory isn't private to the current user (see
+    deeptoolsintervals.index.privateDirectory())
+    """
+    d = os.environ.get('DEEPTOOLS_CACHE_DIR')
+    if d is None:
+        d = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'deeptools')
+    if not d or not privateDirectory(d):
+        return None
+    return d
+
+
+def _str(fname):
+    """
+    pysam gives file names as bytes
+    """
+    if isinstance(fname, bytes):
+        return fname.decode("utf-8")
+    return fname
+
+
+def cachePath(fname):
+    """
+    The directory with the cached statistics of a BAM file, or None if
+    caching is disabled
+    """
+    d = cacheDir()
+    if d is None:
+        return None
+    fname = os.path.abspath(_str(fname))
+    return os.path.join(d, "{}.{}".format(os.path.basename(fname), hashlib.md5(fname.encode("utf-8")).hexdigest()))
+
+
+def cacheFile(fname, key):
+    """
+    The file with the value cached for a BAM file under key, or None if
+    caching is disabled
+    """
+    d = cachePath(fname)
+    if d is None:
+        return None
+    return os.path.join(d, hashlib.md5(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def fileSignature(fname):
+    """
+    The size, modification time (in nanoseconds where available) and inode
+    of a file, which change if it's modified or replaced
+    """
+    st = os.stat(fname)
+    return [st.st_size, getattr(st, "st_mtime_ns", st.st_mtime), st.st_ino]
+
+
+def _loadValue(cname, signature):
+    """
+    The key and value cached in the file cname, or None if it's unreadable or
+    outdated
+    """
+    try:
+        with open(cname) as fh:
+            cache = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if cache.get('signature') != signature or 'key' not in cache:
+        return None
+    return cache['key'], cache.get('value')
+
+
+def loadCache(fname):
+    """
+    Returns all of the statistics cached for a BAM file as a dict, which is
+    empty if there are none or they're outdated
+    """
+    d = cachePath(fname)
+    if d is None or not os.path.isdir(d):
+        return dict()
+    signature = fileSignature(fname)
+    stats = dict()
+    for cname in os.listdir(d):
+        if not cname.endswith(".json"):
+            continue
+        res = _loadValue(os.path.join(d, cname), signature)
+        if res is not None:
+            stats[res[0]] = res[1]
+    return stats
+
+
+def getCached(fname, key):
+    """
+    The value cached for a BAM file under key, or None
+    """
+    cname = cacheFile(fname, key)
+    if cname is None or not os.path.exists(cname):
+        return None
+    res = _loadValue(cname, fileSignature(fname))
+    if res is None or res[0] != key:
+        return None
+    return res[1]
+
+
+def setCached(fname, key, value):
+    """
+    Caches a (JSON serializable) value for a BAM file under key. Failing to
+    write the cache isn't an error.
+
+    Each value is a file of its own, which is written to a temporary file
+    and then renamed, so processes caching different values (e.g., the
+    workers of computeGCBias) or reading the cache at the same time don't
+    interfere.
+    """
+    cname = cacheFile(fname, key)
+    if cname is None:
+        return
+    try:
+        d = os.path.dirname(cname)
+        if not os.path.isdir(d):
+            try:
+                os.mkdir(d)
+            except OSError:
+                # Another process may have created it
+                pass
+        fd, tmpName = tempfile.mkstemp(suffix=".tmp", dir=d)
+        with os.fdopen(fd, "w") as fh:
+            json.dump({'file': os.path.abspath(_str(fname)), 'signature': fileSignature(fname),
+                       'key': key, 'value': value}, fh)
+        os.rename(tmpName, cname)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Warning: couldn't cache the statistics of {} ({})\n".format(fname, e))
+
+
+def blackListKey(blackListFileName):
+    """
+    A string identifying one or more blacklist files, including their
+    fileSignature()
+    """
+    blackList = blackListFileName or []
+    if not isinstance(blackList, list):
+        blackList = [blackList]
+    return json.dumps([[os.path.abspath(x)] + fileSignature(x) for x in blackList])
+
+
+def filterKey(args):
+    """
+    A string describing the filtering settings in args, which are those of
+    bamCoverage, bamCompare and estimateReadFiltering. Settings that a tool
+    doesn't have are taken to be unset.
+    """
+    settings = dict()
+    for name in ['minMappingQuality', 'samFlagInclude', 'samFlagExclude', 'minFragmentLength',
+                 'maxFragmentLength', 'filterRNAstrand']:
+        settings[name] = getattr(args, name, None) or None
+    settings['ignoreDuplicates'] = bool(getattr(args, 'ignoreDuplicates', False))
+    settings['blackListFileName'] = json.loads(blackListKey(getattr(args, 'blackListFileName', None)))
+    return json.dumps(settings, sort_keys=True)
+
+
+def countFilters_wrapper(args):
+    return countFilters_worker(*args)
+
+
+def countFilters_worker(chrom, start, end, bamFile, args):
+    """
+    Counts the mapped alignments starting in a region and how many of them
+    are filtered for each reason, as listed in FILTER_COUNTS. 'filtered' is
+    the number of alignments filtered for any reason tracked by
+    estimateReadFiltering (so including marked duplicates and singletons)
+    and 'kept' the number that bamCoverage and bamCompare keep.
+
+    >>> import argparse
+    >>> bamFile = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/test_paired.bam"
+    >>> args = argparse.Namespace(minMappingQuality=10, ignoreDuplicates=True)
+    >>> chrom, counts = countFilters_worker('chr2', 0, 6000000, bamFile, args)
+    >>> dict(zip(FILTER_COUNTS, counts))['kept'], dict(zip(FILTER_COUNTS, counts))['total']
+    (39, 49)
+    """
+    minMappingQuality = getattr(args, 'minMappingQuality', None)
+    samFlagInclude = getattr(args, 'samFlagInclude', None)
+    samFlagExclude = getattr(args, 'samFlagExclude', None)
+    minFragmentLength = getattr(args, 'minFragmentLength', 0) or 0
+    maxFragmentLength = getattr(args, 'maxFragmentLength', 0) or 0
+    ignoreDuplicates = getattr(args, 'ignoreDuplicates', False)
+    filterRNAstrand = getattr(args, 'filterRNAstrand', None)
+
+    counts = dict([(x, 0) for x in FILTER_COUNTS])
+    # The duplicates among all alignments (estimateReadFiltering) and among those not filtered otherwise (bamCoverage)
+    dupStates = [[None, set()], [None, set()]]
+    fh = bamHandler.openBam(bamFile)
+    if chrom not in fh.references:
+        fh.close()
+        return chrom, [0] * len(FILTER_COUNTS)
+    for read in fh.fetch(chrom, start, end):
+        if read.pos < start:
+            # ensure that we never double count
+            continue
+        if read.flag & 4:
+            continue
+
+        counts['total'] += 1
+        reasons = []
+        if minMappingQuality and read.mapq < minMappingQuality:
+            reasons.append('minMappingQuality')
+        if samFlagInclude and read.flag & samFlagInclude != samFlagInclude:
+            reasons.append('samFlagInclude')
+        if samFlagExclude and read.flag & samFlagExclude != 0:
+            reasons.append('samFlagExclude')
+        tLen = getTLen(read)
+        if (minFragmentLength > 0 and tLen < minFragmentLength) or (maxFragmentLength > 0 and tLen > maxFragmentLength):
+            reasons.append('fragmentLength')
+        keep = len(reasons) == 0
+
+        if ignoreDuplicates:
+            # estimateReadFiltering uses the TLEN field, bamCoverage the observed template length
+            for dupState, l, track in [(dupStates[0], read.tlen, True), (dupStates[1], tLen, keep)]:
+                if not track:
+                    continue
+                # Assuming more or less concordant reads, use the fragment bounds, otherwise the start positions
+                if l >= 0:
+                    s = read.pos
+                    e = s + l
+                else:
+                    s = read.pnext
+                    e = s - l
+                if read.reference_id != read.next_reference_id:
+                    e = read.pnext
+                pos = (s, e, read.next_reference_id, read.is_reverse)
+                if dupState[0] is not None and dupState[0] == read.reference_start and pos in dupState[1]:
+                    if dupState is dupStates[0]:
+                        reasons.append('internalDupes')
+                    else:
+                        keep = False
+                if dupState[0] != read.reference_start:
+                    dupState[1].clear()
+                dupState[0] = read.reference_start
+                dupState[1].add(pos)
+
+        if read.is_duplicate:
+            reasons.append('externalDupes')
+        if read.is_paired and read.mate_is_unmapped:
+            reasons.append('singletons')
+
+        if filterRNAstrand:
+            if read.is_paired:
+                if filterRNAstrand == 'forward':
+                    wrongStrand = not (read.flag & 144 == 128 or read.flag & 96 == 64)
+                else:
+                    wrongStrand = not (read.flag & 144 == 144 or read.flag & 96 == 96)
+            elif filterRNAstrand == 'forward':
+                wrongStrand = read.flag & 16 != 16
+            else:
+                wrongStrand = read.flag & 16 != 0
+            if wrongStrand:
+                reasons.append('filterRNAstrand')
+                keep = False
+
+        for reason in reasons:
+            counts[reason] += 1
+        if reasons:
+            counts['filtered'] += 1
+        if keep:
+            counts['kept'] += 1
+    fh.close()
+    return chrom, [counts[x] for x in FILTER_COUNTS]
+
+
+def exactFilterCounts(bamFile, args, numberOfProcessors=1, verbose=False):
+    """
+    Returns, for each chromosome, the counts of countFilters_worker() over all
+    alignments of a BAM file, excluding those in blacklisted regions. The
+    result is cached for the filtering settings in args.
+    """
+    key = "filterCounts:" + filterKey(args)
+    res = getCached(bamFile, key)
+    if res is not None:
+        return res
+
+    fh = bamHandler.openBam(bamFile)
+    chromSizes = list(zip(fh.references, fh.lengths))
+    fh.close()
+    chunks = mapReduce((bamFile, args),
+                       countFilters_wrapper,
+                       chromSizes,
+                       genomeChunkLength=1e6,
+                       blackListFileName=getattr(args, 'blackListFileName', None),
+                       numberOfProcessors=numberOfProcessors,
+                       verbose=verbose)
+    res = dict([(chrom, [0] * len(FILTER_COUNTS)) for chrom, _ in chromSizes])
+    for chrom, counts in chunks:
+        res[chrom] = [x + y for x, y in zip(res[chrom], counts)]
+    setCached(bamFile, key, res)
+    return res
+
+
+def sumFilterCounts(counts, ignore=None):
+    """
+    Sums the counts of exactFilterCounts() over chromosomes, skipping those
+    in ignore, and returns them as a dict
+
+    >>> sumFilterCounts({'chr1': list(range(11)), 'chr2': [1] * 11, 'chrM': [5] * 11}, ignore=['chrM'])['kept']
+    3
+    """
+    total = [0] * len(FILTER_COUNTS)
+    for chrom, c in counts.items():
+        if ignore and chrom in ignore:
+            continue
+        total = [x + y for x, y in zip(total, c)]
+    return dict(zip(FILTER_COUNTS, total))
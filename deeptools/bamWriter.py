@@ -0,0 +1,380 @@
+"""
+Writing of a BAM file from chunks produced in parallel.
+
+Each worker writes the alignments of its chunk to an uncompressed temporary
+BAM file and then calls finishChunk(), which strips the header, compresses
+the alignments into BGZF blocks and, if requested, notes where each
+alignment ends up so that the chunk's part of the index is known. The
+parent then only has to append the chunks, in genomic order, to the
+compressed header with writeBAM(), which also writes the .bai index
+without reading the result again.
+
+The BAI format is described in section 5 of the SAM specification.
+"""
+import os
+import shutil
+import struct
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pysam
+
+from deeptools import bgzf
+from deeptools.utilities import getTempFileName
+
+# The linear index has one entry per 16kb window
+LINEAR_SHIFT = 14
+
+# The pseudo-bin holding the offsets and read counts of a chromosome
+META_BIN = 37450
+
+# Bins whose alignments span fewer compressed bytes are merged into their parent
+MIN_MARKER_DIST = 0x10000
+
+# CIGAR operations consuming the reference: M, D, N, = and X
+REF_CONSUMING = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0], dtype=bool)
+
+
+def bamHeader(template):
+    """
+    Returns the (uncompressed) binary BAM header of an open pysam file
+    """
+    fname = getTempFileName(suffix='.bam')
+    fh = pysam.AlignmentFile(fname, 'wbu', template=template)
+    fh.close()
+    header = bgzf.decompress(fname)
+    os.remove(fname)
+    return header
+
+
+def _headerLength(data):
+    """
+    The length of the binary header at the start of data and the number of
+    chromosomes in it
+    """
+    if data[:4] != b'BAM\x01':
+        raise IOError("Not a BAM file")
+    p = 8 + struct.unpack_from('<i', data, 4)[0]
+    nRef = struct.unpack_from('<i', data, p)[0]
+    p += 4
+    for i in range(nRef):
+        p += 8 + struct.unpack_from('<i', data, p)[0]
+    return p, nRef
+
+
+def reg2bin(beg, end):
+    """
+    The bin of each of the intervals [beg, end), as in the SAM specification
+
+    >>> reg2bin(np.array([0, 16384, 100000, 0]), np.array([1, 16400, 120000, 1 << 29]))
+    array([4681, 4682,  585,    0])
+    """
+    beg = np.asarray(beg, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64) - 1
+    conditions = [beg >> s == end >> s for s in (14, 17, 20, 23, 26)]
+    choices = [((1 << 15) - 1) // 7 + (beg >> 14),
+               ((1 << 12) - 1) // 7 + (beg >> 17),
+               ((1 << 9) - 1) // 7 + (beg >> 20),
+               ((1 << 6) - 1) // 7 + (beg >> 23),
+               ((1 << 3) - 1) // 7 + (beg >> 26)]
+    return np.select(conditions, choices, 0)
+
+
+def _gather(arr, offsets, width):
+    """
+    The width bytes starting at each of offsets in arr, as a 2D array
+    """
+    return arr[offsets[:, None] + np.arange(width)]
+
+
+def _chunkIndex(data, voffset):
+    """
+    The information needed for the index from the alignments in data, with
+    the virtual offset of any position in data given by voffset(). Returns
+    None if the alignments aren't sorted.
+    """
+    starts = []
+    p = 0
+    n = len(data)
+    while p < n:
+        starts.append(p)
+        p += 4 + struct.unpack_from('<i', data, p)[0]
+    starts = np.array(starts, dtype=np.int64)
+    idx = {'nNoCoor': 0, 'first': None, 'last': None}
+    if len(starts) == 0:
+        return idx
+
+    arr = np.frombuffer(data, dtype=np.uint8)
+    fixed = _gather(arr, starts, 36)
+    tid = fixed[:, 4:8].copy().view('<i4').ravel().astype(np.int64)
+    pos = fixed[:, 8:12].copy().view('<i4').ravel().astype(np.int64)
+    lName = fixed[:, 12].astype(np.int64)
+    nCigar = fixed[:, 16:18].copy().view('<u2').ravel().astype(np.int64)
+    flag = fixed[:, 18:20].copy().view('<u2').ravel()
+
+    # Sorted by chromosome and position, with the unplaced reads at the end
+    key = (np.where(tid < 0, 1 << 31, tid) << 32) + pos + 1
+    if np.any(np.diff(key) < 0):
+        return None
+
+    # The reference length of each alignment from its CIGAR operations
+    recIdx = np.repeat(np.arange(len(starts)), nCigar)
+    opIdx = np.arange(len(recIdx)) - np.repeat(np.cumsum(nCigar) - nCigar, nCigar)
+    cigar = _gather(arr, starts[recIdx] + 36 + lName[recIdx] + 4 * opIdx, 4).copy().view('<u4').ravel()
+    consumed = np.where(REF_CONSUMING[cigar & 0xf], cigar >> 4, 0)
+    rLen = np.bincount(recIdx, weights=consumed, minlength=len(starts)).astype(np.int64)
+    # Unmapped reads and those without CIGAR occupy a single base
+    rLen[(flag & 4 != 0) | (rLen == 0)] = 1
+    end = pos + rLen
+
+    vBeg = voffset(starts)
+    vEnd = voffset(np.append(starts[1:], n))
+
+    placed = tid >= 0
+    idx['nNoCoor'] = int(np.sum(~placed))
+    idx['first'] = (int(tid[0]), int(pos[0]))
+    idx['last'] = (int(tid[-1]), int(pos[-1]))
+    tid, pos, end, flag, vBeg, vEnd = [x[placed] for x in (tid, pos, end, flag, vBeg, vEnd)]
+    if len(tid) == 0:
+        return idx
+
+    # Runs of consecutive alignments in the same bin
+    bins = reg2bin(pos, end)
+    runStart = np.flatnonzero(np.r_[True, (np.diff(tid) != 0) | (np.diff(bins) != 0)])
+    runEnd = np.r_[runStart[1:], len(tid)] - 1
+    idx['chunks'] = (tid[runStart], bins[runStart], vBeg[runStart], vEnd[runEnd])
+
+    # The smallest offset of an alignment overlapping each 16kb window
+    wBeg = pos >> LINEAR_SHIFT
+    nWin = ((end - 1) >> LINEAR_SHIFT) - wBeg + 1
+    recIdx = np.repeat(np.arange(len(tid)), nWin)
+    windows = wBeg[recIdx] + np.arange(len(recIdx)) - np.repeat(np.cumsum(nWin) - nWin, nWin)
+    idx['linear'] = (tid[recIdx], windows, vBeg[recIdx])
+
+    # The offsets and read counts per chromosome
+    chromStart = np.flatnonzero(np.r_[True, np.diff(tid) != 0])
+    chromEnd = np.r_[chromStart[1:], len(tid)] - 1
+    unmapped = np.add.reduceat((flag & 4 != 0).astype(np.int64), chromStart)
+    idx['meta'] = (tid[chromStart], vBeg[chromStart], vEnd[chromEnd],
+                   chromEnd - chromStart + 1 - unmapped, unmapped)
+    return idx
+
+
+def finishChunk(fname, level=6, index=False, numberOfThreads=1):
+    """
+    Replaces an uncompressed BAM file written by a worker with its
+    alignments compressed into BGZF blocks, without header or end of file
+    marker, so that it can be appended as is to other such files by
+    writeBAM(). If index is True, the index of the alignments is computed
+    as well.
+
+    Returns the file name and the index information (None if it wasn't
+    requested or the alignments aren't sorted).
+    """
+    data = bgzf.decompress(fname, numberOfProcessors=numberOfThreads)
+    data = data[_headerLength(data)[0]:]
+
+    pieces = [data[i:i + bgzf.BLOCK_SIZE] for i in range(0, len(data), bgzf.BLOCK_SIZE)]
+    if numberOfThreads > 1 and len(pieces) > 1:
+        pool = ThreadPool(numberOfThreads)
+        blocks = pool.map(partial(bgzf.compressBlock, level=level), pieces)
+        pool.close()
+        pool.join()
+    else:
+        blocks = [bgzf.compressBlock(x, level) for x in pieces]
+
+    idx = None
+    if index:
+        # One more entry for the end of the last block
+        cOffsets = np.zeros(len(blocks) + 1, dtype=np.uint64)
+        cOffsets[1:] = np.cumsum([len(x) for x in blocks])
+
+        def voffset(p):
+            return (cOffsets[p // bgzf.BLOCK_SIZE] << np.uint64(16)) | (p % bgzf.BLOCK_SIZE).astype(np.uint64)
+        idx = _chunkIndex(data, voffset)
+
+    with open(fname, 'wb') as fh:
+        for block in blocks:
+            fh.write(block)
+    return fname, idx
+
+
+def _shift(idx, base):
+    """
+    Moves the virtual offsets in idx, from finishChunk(), base bytes further
+    into the file
+    """
+    base = np.uint64(base << 16)
+    res = dict(idx)
+    if 'chunks' in idx:
+        t, b, beg, end = idx['chunks']
+        res['chunks'] = (t, b, beg + base, end + base)
+        t, w, off = idx['linear']
+        res['linear'] = (t, w, off + base)
+        t, beg, end, nMapped, nUnmapped = idx['meta']
+        res['meta'] = (t, beg + base, end + base, nMapped, nUnmapped)
+    return res
+
+
+def _isSorted(idxs):
+    """
+    Whether the chunks described by idxs are in order
+    """
+    last = None
+    for idx in idxs:
+        if idx is None:
+            return False
+        if idx['first'] is None:
+            continue
+        if last is not None:
+            # Unplaced reads (tid -1) must come last
+            if last[0] < 0 and idx['first'][0] >= 0:
+                return False
+            if idx['first'][0] >= 0 and last[0] >= 0 and idx['first'] < last:
+                return False
+        last = idx['last']
+    return True
+
+
+def _compressBins(binChunks):
+    """
+    Moves the chunks of small bins to their parent bin and merges chunks
+    starting in the block where the previous one ends, as htslib does
+    """
+    for level in range(5, 0, -1):
+        first = ((1 << 3 * level) - 1) // 7
+        for b in sorted(binChunks):
+            if b < first:
+                continue
+            chunks = sorted(binChunks[b])
+            binChunks[b] = chunks
+            parent = (b - 1) >> 3
+            if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < MIN_MARKER_DIST and parent in binChunks:
+                binChunks[parent].extend(chunks)
+                del binChunks[b]
+
+    for b, chunks in binChunks.items():
+        chunks.sort()
+        merged = [list(chunks[0])]
+        for beg, end in chunks[1:]:
+            if merged[-1][1] >> 16 >= beg >> 16:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([beg, end])
+        binChunks[b] = merged
+    return binChunks
+
+
+def writeBAI(fname, nRef, idxs):
+    """
+    Writes the .bai index from the (shifted) index information of the chunks
+    """
+    def concat(key, n):
+        parts = [idx[key] for idx in idxs if key in idx]
+        if not parts:
+            return [np.zeros(0, dtype=np.int64)] * n
+        return [np.concatenate([p[i] for p in parts]) for i in range(n)]
+
+    tid, bins, beg, end = concat('chunks', 4)
+    # Sorted by chromosome and bin, keeping the file order within each bin
+    order = np.lexsort((beg, bins, tid))
+    tid, bins, beg, end = tid[order], bins[order], beg[order], end[order]
+    # Merge chunks of a bin starting in the block where the previous one ends
+    newChunk = np.r_[True, (np.diff(tid) != 0) | (np.diff(bins) != 0) | ((end[:-1] >> np.uint64(16)) < (beg[1:] >> np.uint64(16)))]
+    first = np.flatnonzero(newChunk)
+    last = np.r_[first[1:], len(tid)] - 1
+    cTid, cBin, cBeg, cEnd = tid[first], bins[first], beg[first], end[last]
+
+    lTid, lWin, lOff = concat('linear', 3)
+    order = np.lexsort((lOff, lWin, lTid))
+    lTid, lWin, lOff = lTid[order], lWin[order], lOff[order]
+    keep = np.r_[True, (np.diff(lTid) != 0) | (np.diff(lWin) != 0)]
+    lTid, lWin, lOff = lTid[keep], lWin[keep], lOff[keep]
+
+    mTid, mBeg, mEnd, mMapped, mUnmapped = concat('meta', 5)
+    meta = {}
+    for t, b, e, m, u in zip(mTid, mBeg, mEnd, mMapped, mUnmapped):
+        if t in meta:
+            meta[t] = (meta[t][0], e, meta[t][2] + m, meta[t][3] + u)
+        else:
+            meta[t] = (b, e, m, u)
+
+    out = [b'BAI\x01', struct.pack('<i', nRef)]
+    cBounds = np.searchsorted(cTid, np.arange(nRef + 1))
+    lBounds = np.searchsorted(lTid, np.arange(nRef + 1))
+    for t in range(nRef):
+        if t not in meta:
+            out.append(struct.pack('<ii', 0, 0))
+            continue
+        binChunks = {}
+        for i in range(cBounds[t], cBounds[t + 1]):
+            binChunks.setdefault(int(cBin[i]), []).append((int(cBeg[i]), int(cEnd[i])))
+        binChunks = _compressBins(binChunks)
+        out.append(struct.pack('<i', len(binChunks) + 1))
+        for b in sorted(binChunks):
+            out.append(struct.pack('<Ii', b, len(binChunks[b])))
+            out.append(np.array(binChunks[b], dtype='<u8').tobytes())
+        b, e, m, u = meta[t]
+        out.append(struct.pack('<IiQQQQ', META_BIN, 2, b, e, m, u))
+
+        # Empty windows get the offset of the next window with alignments
+        win = lWin[lBounds[t]:lBounds[t + 1]]
+        linear = np.full(win[-1] + 1, np.iinfo(np.uint64).max, dtype=np.uint64)
+        linear[win] = lOff[lBounds[t]:lBounds[t + 1]]
+        linear = np.minimum.accumulate(linear[::-1])[::-1]
+        out.append(struct.pack('<i', len(linear)))
+        out.append(linear.astype('<u8').tobytes())
+    out.append(struct.pack('<Q', sum(idx['nNoCoor'] for idx in idxs)))
+
+    with open(fname, 'wb') as fh:
+        fh.write(b''.join(out))
+
+
+def writeBAM(oname, header, chunks, index=False):
+    """
+    Writes the BAM file oname from its binary header (see bamHeader()) and
+    the chunks, a list of the output of finishChunk() in the order in which
+    they should appear. The chunk files are deleted. If index is True, the
+    .bai index is written as well, using the index information of the
+    chunks if available and samtools otherwise.
+
+    >>> import os
+    >>> bam = pysam.AlignmentFile(os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/test2.bam")
+    >>> chunks = []
+    >>> for chrom in bam.references:
+    ...     fname = getTempFileName(suffix='.bam')
+    ...     fh = pysam.AlignmentFile(fname, 'wbu', template=bam)
+    ...     for read in bam.fetch(chrom):
+    ...         _ = fh.write(read)
+    ...     fh.close()
+    ...     chunks.append(finishChunk(fname, index=True))
+    >>> oname = getTempFileName(suffix='.bam')
+    >>> writeBAM(oname, bamHeader(bam), chunks, index=True)
+    >>> out = pysam.AlignmentFile(oname)
+    >>> [r.query_name for r in out.fetch('3R', 0, 200)] == [r.query_name for r in bam.fetch('3R', 0, 200)]
+    True
+    >>> out.mapped == bam.mapped
+    True
+    >>> os.remove(oname)
+    >>> os.remove(oname + '.bai')
+    """
+    nRef = _headerLength(header)[1]
+    idxs = []
+    with open(oname, 'wb') as fh:
+        fh.write(bgzf.compress(header))
+        for fname, idx in chunks:
+            if idx is not None:
+                idx = _shift(idx, fh.tell())
+            idxs.append(idx)
+            with open(fname, 'rb') as ifh:
+                shutil.copyfileobj(ifh, fh)
+            os.remove(fname)
+        fh.write(bgzf.EOF_BLOCK)
+
+    if not index:
+        return
+    if _isSorted(idxs):
+        writeBAI(oname + '.bai', nRef, idxs)
+    else:
+        pysam.index(oname)
@@ -0,0 +1,301 @@
+"""
+Reading and writing of gzip files, in parallel where their format allows it.
+
+A gzip file may consist of several concatenated members. In the BGZF format
+(used by BAM and tabix files and written by bgzip) each member additionally
+records its compressed size in its header, so the member boundaries can be
+found without decompressing anything and the members can then be
+decompressed independently. zlib releases the GIL, so threads suffice for
+that. Other gzip files are decompressed sequentially.
+
+Files are always written as BGZF, which remains readable by gzip, with the
+formatting and compression of blocks of data done by a pool of processes.
+"""
+import multiprocessing
+import struct
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# gzip header with FEXTRA set and a 6 byte extra field holding the BC subfield
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+
+# The most data put in a single block, as in htslib
+BLOCK_SIZE = 0xff00
+
+
+def compressBlock(data, level=6):
+    """
+    Compresses data (at most 64kb) into a single BGZF block
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = c.compress(data) + c.flush()
+    return b''.join([BGZF_HEADER,
+                     struct.pack('<H', len(BGZF_HEADER) + 2 + len(deflated) + 8 - 1),
+                     deflated,
+                     struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)])
+
+
+# An empty block marks the end of a BGZF file
+EOF_BLOCK = compressBlock(b'')
+
+
+def compress(data, level=6):
+    """
+    Compresses data into as many BGZF blocks as needed
+
+    >>> import gzip
+    >>> data = b'0123456789' * 20000
+    >>> len(blockOffsets(compress(data)))
+    4
+    >>> gzip.decompress(compress(data)) == data
+    True
+    """
+    return b''.join([compressBlock(data[i:i + BLOCK_SIZE], level) for i in range(0, len(data), BLOCK_SIZE)])
+
+
+def formatWrapper(args):
+    func, task, compressed = args
+    data = func(task)
+    if compressed:
+        return compress(data)
+    return data
+
+
+def writeBlocks(fh, func, tasks, numberOfProcessors=1, compressed=True, start=None):
+    """
+    Writes func(task), which must return bytes, for each of tasks to the
+    file handle fh in order, as BGZF blocks unless compressed is False. With
+    more than one processor the tasks are formatted and compressed by a
+    pool of processes, so func must be defined at the module level. Only a
+    few tasks per process are pending at any time, so memory use is bounded.
+
+    The BGZF end of file marker is not written, so more can be appended.
+    Returns the offset in fh at which the output of each task starts,
+    followed by the offset at which the output ends. The offsets are counted
+    from start, by default the current position in fh, so fh need not be
+    seekable.
+
+    >>> import io, gzip
+    >>> def double(x):
+    ...     return b'%d\\n' % (2 * x)
+    >>> fh = io.BytesIO()
+    >>> writeBlocks(fh, double, range(3))
+    [0, 30, 60, 90]
+    >>> gzip.decompress(fh.getvalue() + EOF_BLOCK)
+    b'0\\n2\\n4\\n'
+    """
+    if start is None:
+        start = fh.tell()
+    offsets = [start]
+
+    def write(data):
+        fh.write(data)
+        offsets.append(offsets[-1] + len(data))
+
+    if numberOfProcessors < 2:
+        for task in tasks:
+            write(formatWrapper((func, task, compressed)))
+        return offsets
+
+    pool = multiprocessing.Pool(numberOfProcessors)
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(formatWrapper, ((func, task, compressed),)))
+        if len(pending) >= 2 * numberOfProcessors:
+            write(pending.popleft().get(9999999))
+    while pending:
+        write(pending.popleft().get(9999999))
+    pool.close()
+    pool.join()
+    return offsets
+
+
+def blockOffsets(data):
+    """
+    Returns a list of the (start, end) offsets of each member in data if they
+    are all BGZF blocks, otherwise None.
+
+    >>> blockOffsets(compressBlock(b'foo') + compressBlock(b'bar'))
+    [(0, 31), (31, 62)]
+    >>> import gzip
+    >>> blockOffsets(gzip.compress(b'foo')) is None
+    True
+    """
+    offsets = []
+    pos = 0
+    while pos < len(data):
+        # The BC subfield need not be the first, but it is in practice
+        if data[pos:pos + 4] != b'\x1f\x8b\x08\x04' or data[pos + 12:pos + 14] != b'BC':
+            return None
+        bsize = struct.unpack('<H', data[pos + 16:pos + 18])[0] + 1
+        offsets.append((pos, pos + bsize))
+        pos += bsize
+    if pos != len(data):
+        return None
+    return offsets
+
+
+def _decompressBlocks(args):
+    """
+    Decompresses a list of BGZF blocks, checking their CRCs
+    """
+    data, offsets = args
+    res = []
+    for start, end in offsets:
+        xlen = struct.unpack('<H', data[start + 10:start + 12])[0]
+        block = zlib.decompress(data[start + 12 + xlen:end - 8], -15)
+        crc, isize = struct.unpack('<II', data[end - 8:end])
+        if isize != len(block) & 0xffffffff or crc != zlib.crc32(block) & 0xffffffff:
+            raise IOError("Corrupt BGZF block at offset {}".format(start))
+        res.append(block)
+    return b''.join(res)
+
+
+def _decompressMembers(data):
+    """
+    Sequentially decompresses all of the members of a gzip file
+    """
+    res = []
+    while data.startswith(GZIP_MAGIC):
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        res.append(d.decompress(data))
+        res.append(d.flush())
+        data = d.unused_data
+    return b''.join(res)
+
+
+def decompress(fname, numberOfProcessors=1, start=0, end=None):
+    """
+    Returns the decompressed contents of a gzip file. If the file is BGZF
+    then its blocks are decompressed with numberOfProcessors threads. Files
+    that aren't gzipped are returned as is. If start and/or end are given,
+    only that range of the (compressed) file is read, which must then begin
+    and end at block boundaries.
+
+    >>> import os, tempfile, gzip
+    >>> fd, fname = tempfile.mkstemp()
+    >>> with os.fdopen(fd, 'wb') as fh:
+    ...     _ = fh.write(b''.join(compressBlock(b'line %d\\n' % i) for i in range(10)))
+    >>> decompress(fname, numberOfProcessors=2).splitlines()[-1]
+    b'line 9'
+    >>> decompress(fname, start=len(compressBlock(b'line 0\\n')))[:6]
+    b'line 1'
+    >>> with gzip.open(fname, 'wb') as fh:
+    ...     _ = fh.write(b'foo')
+    >>> with gzip.open(fname, 'ab') as fh:
+    ...     _ = fh.write(b'bar')
+    >>> decompress(fname)
+    b'foobar'
+    >>> os.remove(fname)
+    """
+    with open(fname, 'rb') as fh:
+        fh.seek(start)
+        if end is None:
+            data = fh.read()
+        else:
+            data = fh.read(end - start)
+    if not data.startswith(GZIP_MAGIC):
+        return data
+    offsets = blockOffsets(data)
+    if offsets is None:
+        return _decompressMembers(data)
+    if numberOfProcessors < 2 or len(offsets) < 2:
+        return _decompressBlocks((data, offsets))
+
+    # A few chunks per thread, in the original order
+    nChunks = min(len(offsets), 4 * numberOfProcessors)
+    step = -(-len(offsets) // nChunks)
+    tasks = [(data, offsets[i:i + step]) for i in range(0, len(offsets), step)]
+    pool = ThreadPool(numberOfProcessors)
+    res = pool.map(_decompressBlocks, tasks)
+    pool.close()
+    pool.join()
+    return b''.join(res)
+
+
+def fileBlockOffsets(fname, start=0, end=None):
+    """
+    Returns the offsets of the BGZF blocks of a file from start to end (by
+    default, the end of the file), followed by end itself. Only the block
+    headers are read. None if the file (or that range of it) isn't BGZF.
+
+    >>> import os, tempfile, gzip
+    >>> fd, fname = tempfile.mkstemp()
+    >>> with os.fdopen(fd, 'wb') as fh:
+    ...     _ = fh.write(compressBlock(b'foo') + compressBlock(b'bar') + EOF_BLOCK)
+    >>> fileBlockOffsets(fname)
+    [0, 31, 62, 90]
+    >>> fileBlockOffsets(fname, start=31, end=62)
+    [31, 62]
+    >>> with gzip.open(fname, 'wb') as fh:
+    ...     _ = fh.write(b'foo')
+    >>> fileBlockOffsets(fname) is None
+    True
+    >>> os.remove(fname)
+    """
+    offsets = []
+    with open(fname, 'rb') as fh:
+        if end is None:
+            fh.seek(0, 2)
+            end = fh.tell()
+        pos = start
+        while pos < end:
+            fh.seek(pos)
+            header = fh.read(18)
+            # The BC subfield need not be the first, but it is in practice
+            if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+                return None
+            offsets.append(pos)
+            pos += struct.unpack('<H', header[16:18])[0] + 1
+    if pos != end:
+        return None
+    offsets.append(end)
+    return offsets
+
+
+def iterDecompress(fname, size=1 << 22):
+    """
+    Yields the decompressed contents of a (possibly multi-member) gzip file
+    in pieces of at most size bytes, reading the file as it goes. Files that
+    aren't gzipped are yielded as is.
+
+    >>> import os, tempfile, gzip
+    >>> fd, fname = tempfile.mkstemp()
+    >>> os.close(fd)
+    >>> with gzip.open(fname, 'wb') as fh:
+    ...     _ = fh.write(b'foo')
+    >>> with gzip.open(fname, 'ab') as fh:
+    ...     _ = fh.write(b'bar')
+    >>> pieces = list(iterDecompress(fname, size=2))
+    >>> b''.join(pieces), max([len(x) for x in pieces])
+    (b'foobar', 2)
+    >>> os.remove(fname)
+    """
+    with open(fname, 'rb') as fh:
+        data = fh.read(size)
+        if not data.startswith(GZIP_MAGIC):
+            while data:
+                yield data
+                data = fh.read(size)
+            return
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            if d.eof:
+                # The next member, if any
+                data = d.unused_data
+                if len(data) < len(GZIP_MAGIC):
+                    data += fh.read(size)
+                if not data.startswith(GZIP_MAGIC):
+                    break
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif not data:
+                data = fh.read(size)
+                if not data:
+                    break
+            out = d.decompress(data, size)
+            data = d.unconsumed_tail
+            if out:
+                yield out
@@ -0,0 +1,156 @@
+"""
+Clustering methods for large matrices, as used by heatmapper._matrix.hmcluster().
+
+Both methods avoid computing a full distance matrix: mini-batch k-means only
+ever looks at a small random batch of rows per iteration and hierarchical
+clustering is performed on a random subset of rows, with the remaining rows
+then assigned to the closest resulting cluster. The assignment of every row
+to its closest centroid is done in blocks of rows, in parallel.
+"""
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+# The number of rows per block when assigning rows to centroids
+BLOCK_ROWS = 10000
+
+
+def _assignBlock(args):
+    matrix, centroids, cNorm, start, end = args
+    block = np.asarray(matrix[start:end], dtype=np.float64)
+    # |x - c|^2 = |x|^2 - 2xc + |c|^2, |x|^2 doesn't affect the minimum
+    dist = cNorm[np.newaxis, :] - 2 * np.dot(block, centroids.T)
+    labels = np.argmin(dist, axis=1)
+    dist = dist[np.arange(len(labels)), labels] + np.einsum('ij,ij->i', block, block)
+    return labels, np.maximum(dist, 0)
+
+
+def assignClusters(matrix, centroids, numberOfProcessors=1, blockRows=BLOCK_ROWS):
+    """
+    Returns the index of the closest centroid for each row of matrix and the
+    squared distance to it. Blocks of rows are processed in parallel (numpy
+    releases the GIL for the matrix multiplication, so threads suffice and
+    nothing needs to be copied to other processes).
+
+    >>> m = np.array([[0, 0], [0, 1], [10, 10], [9, 10]])
+    >>> labels, dist = assignClusters(m, np.array([[0, 0.5], [9.5, 10]]), blockRows=3)
+    >>> labels
+    array([0, 0, 1, 1])
+    >>> dist
+    array([0.25, 0.25, 0.25, 0.25])
+    """
+    centroids = np.asarray(centroids, dtype=np.float64)
+    cNorm = np.einsum('ij,ij->i', centroids, centroids)
+    tasks = [(matrix, centroids, cNorm, start, min(start + blockRows, matrix.shape[0]))
+             for start in range(0, matrix.shape[0], blockRows)]
+    if numberOfProcessors > 1 and len(tasks) > 1:
+        pool = ThreadPool(numberOfProcessors)
+        res = pool.map(_assignBlock, tasks)
+        pool.close()
+        pool.join()
+    else:
+        res = list(map(_assignBlock, tasks))
+    if len(res) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    return np.concatenate([x[0] for x in res]), np.concatenate([x[1] for x in res])
+
+
+def _kmeansPlusPlus(sample, k, rng):
+    """
+    Choose k initial centroids from the rows of sample (k-means++)
+    """
+    centroids = [sample[rng.randint(sample.shape[0])]]
+    dist = np.sum((sample - centroids[0]) ** 2, axis=1)
+    for i in range(1, k):
+        total = dist.sum()
+        if total > 0:
+            idx = rng.choice(sample.shape[0], p=dist / total)
+        else:
+            idx = rng.randint(sample.shape[0])
+        centroids.append(sample[idx])
+        dist = np.minimum(dist, np.sum((sample - sample[idx]) ** 2, axis=1))
+    return np.array(centroids)
+
+
+def miniBatchKMeans(matrix, k, batchSize=1024, maxIter=100, tol=1e-4, seed=0, numberOfProcessors=1):
+    """
+    Mini-batch k-means (Sculley, 2010). Each iteration assigns a random batch
+    of rows to their closest centroid and moves each centroid towards the mean
+    of its rows, with a per-centroid learning rate that decreases with the
+    number of rows it has been assigned so far. Iteration stops once the
+    centroids move less than tol (relative to the data variance) or after
+    maxIter iterations. All rows are then assigned to their closest centroid.
+
+    Returns the centroids and the cluster label of each row.
+
+    >>> rng = np.random.RandomState(1)
+    >>> m = np.vstack([rng.normal(0, 1, (500, 5)), rng.normal(20, 1, (300, 5))])
+    >>> centroids, labels = miniBatchKMeans(m, 2, batchSize=100)
+    >>> sorted(np.bincount(labels))
+    [300, 500]
+    """
+    rng = np.random.RandomState(seed)
+    n = matrix.shape[0]
+    k = min(k, n)
+    batchSize = min(batchSize, n)
+
+    sampleIdx = np.sort(rng.choice(n, min(n, max(batchSize, 10 * k)), replace=False))
+    sample = np.asarray(matrix[sampleIdx], dtype=np.float64)
+    centroids = _kmeansPlusPlus(sample, k, rng)
+    scale = max(np.mean(np.var(sample, axis=0)), 1e-12)
+    counts = np.zeros(k)
+
+    for i in range(maxIter):
+        batch = np.asarray(matrix[np.sort(rng.choice(n, batchSize, replace=False))], dtype=np.float64)
+        labels, _ = assignClusters(batch, centroids)
+        nPerCluster = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, batch)
+        old = centroids.copy()
+        hit = nPerCluster > 0
+        counts[hit] += nPerCluster[hit]
+        centroids[hit] += (sums[hit] - nPerCluster[hit][:, np.newaxis] * centroids[hit]) / counts[hit][:, np.newaxis]
+        # Reseed any centroid that's never been used with a row far from its centroid
+        if i == 0 and not np.all(hit):
+            _, dist = assignClusters(batch, centroids)
+            far = np.argsort(dist)[::-1]
+            for j, c in enumerate(np.flatnonzero(~hit)):
+                centroids[c] = batch[far[j % len(far)]]
+        if np.sum((centroids - old) ** 2) / k < tol * scale:
+            break
+
+    labels, _ = assignClusters(matrix, centroids, numberOfProcessors=numberOfProcessors)
+    return centroids, labels
+
+
+def sampledHierarchical(matrix, k, sampleSize=5000, seed=0, numberOfProcessors=1):
+    """
+    Ward hierarchical clustering of (at most) sampleSize random rows of
+    matrix. The other rows are assigned to the cluster with the closest
+    centroid. If the matrix has no more than sampleSize rows then this is
+    simply Ward clustering of the whole matrix.
+
+    Returns the cluster label (0 to k - 1) of each row.
+
+    >>> rng = np.random.RandomState(1)
+    >>> m = np.vstack([rng.normal(0, 1, (500, 5)), rng.normal(20, 1, (300, 5))])
+    >>> sorted(np.bincount(sampledHierarchical(m, 2, sampleSize=100)))
+    [300, 500]
+    """
+    from scipy.cluster.hierarchy import fcluster, linkage
+
+    n = matrix.shape[0]
+    if n <= sampleSize:
+        Z = linkage(np.asarray(matrix, dtype=np.float64), method='ward', metric='euclidean')
+        return fcluster(Z, k, criterion='maxclust') - 1
+
+    rng = np.random.RandomState(seed)
+    sampleIdx = np.sort(rng.choice(n, sampleSize, replace=False))
+    sample = np.asarray(matrix[sampleIdx], dtype=np.float64)
+    Z = linkage(sample, method='ward', metric='euclidean')
+    sampleLabels = fcluster(Z, k, criterion='maxclust') - 1
+    nClusters = sampleLabels.max() + 1
+    centroids = np.array([sample[sampleLabels == c].mean(axis=0) for c in range(nClusters)])
+    labels, _ = assignClusters(matrix, centroids, numberOfProcessors=numberOfProcessors)
+    labels[sampleIdx] = sampleLabels
+    return labels
@@ -3,18 +3,24 @@
 
 import time
 
+import hashlib
+import json
 import multiprocessing
 import numpy as np
 import argparse
+import os
+import tempfile
 from scipy.stats import poisson
 import py2bit
 import sys
 
-from deeptoolsintervals import GTF
-from deeptools.utilities import tbitToBamChrName, getGC_content
+from deeptoolsintervals import loadIndex
+from deeptoolsintervals.index import privateDirectory
+from deeptools.utilities import tbitToBamChrName, getGC_contents
+from deeptools.computeGCTrack import openGCTrack
 from deeptools import parserCommon, mapReduce
 from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
-from deeptools import bamHandler
+from deeptools import bamHandler, bamStats
 
 debug = 0
 old_settings = np.seterr(all='ignore')
@@ -104,6 +110,17 @@ def getRequiredArgs():
                           type=argparse.FileType('r'),
                           metavar='BED file')
 
+    optional.add_argument('--GCtrack',
+                          help='GC track made by computeGCTrack for this genome '
+                          'and fragment length. The GC content of the sampled '
+                          'fragments is then looked up rather than computed '
+                          'from the genome sequence, and the expected GC '
+                          'distribution is cached (in $DEEPTOOLS_CACHE_DIR, '
+                          '~/.cache/deeptools by default) so that it is only computed '
+                          'once for a given genome, fragment length, sampling '
+                          'and set of blacklisted regions.',
+                          metavar='FILE')
+
     plot = parser.add_argument_group('Diagnostic plot options')
 
     plot.add_argument('--biasPlot',
@@ -149,12 +166,12 @@ def getPositionsToSample(chrom, start, end, stepSize):
     positions_to_sample = np.arange(start, end, stepSize)
 
     if global_vars['filter_out']:
-        filter_out_tree = GTF(global_vars['filter_out'])
+        filter_out_tree = loadIndex(global_vars['filter_out'])
     else:
         filter_out_tree = None
 
     if global_vars['extra_sampling_file']:
-        extra_tree = GTF(global_vars['extra_sampling_file'])
+        extra_tree = loadIndex(global_vars['extra_sampling_file'])
     else:
         extra_tree = None
 
@@ -211,6 +228,7 @@ def countReadsPerGC_worker(chromNameBam,
     sub_reads_per_gc = []
     positions_to_sample = getPositionsToSample(chromNameBit,
                                                start, end, stepSize)
+    gcs, valid = getGC_contents(tbit, chromNameBit, positions_to_sample, regionSize)
 
     for index in range(len(positions_to_sample)):
         i = positions_to_sample[index]
@@ -218,13 +236,11 @@ def countReadsPerGC_worker(chromNameBam,
         if tbit.chroms(chromNameBit) < i + regionSize:
             break
 
-        try:
-            gc = getGC_content(tbit, chromNameBit, int(i), int(i + regionSize))
-        except Exception as detail:
+        if not valid[index]:
             if verbose:
-                print("{}:{}-{}".format(chromNameBit, i, i + regionSize))
-                print(detail)
+                print("WARNING: too many NNNs present in {}:{}-{}".format(chromNameBit, i, i + regionSize))
             continue
+        gc = gcs[index]
         numberReads = bam.count(chromNameBam, i, i + regionSize)
         sub_reads_per_gc.append((numberReads, gc))
         c += 1
@@ -306,7 +322,6 @@ def tabulateGCcontent_worker(chromNameBam, start, end, stepSize,
 
     tbit = py2bit.open(global_vars['2bit'])
     bam = bamHandler.openBam(global_vars['bam'])
-    peak = 0
     startTime = time.time()
 
     if verbose:
@@ -316,81 +331,69 @@ def tabulateGCcontent_worker(chromNameBam, start, end, stepSize,
     positions_to_sample = getPositionsToSample(chromNameBit,
                                                start, end, stepSize)
 
-    read_counts = []
-    # Optimize IO.
-    # if the sample regions are far apart from each
-    # other is faster to go to each location and fetch
-    # the reads found there.
-    # Otherwise, if the regions to sample are close to
-    # each other, is faster to load all the reads in
-    # a large region into memory and consider only
-    # those falling into the positions to sample.
-    # The following code gets the reads
-    # that are at sampling positions that lie close together
-    if np.mean(np.diff(positions_to_sample)) < 1000:
-        start_pos = min(positions_to_sample)
-        end_pos = max(positions_to_sample)
-        if verbose:
-            print("[{:.3f}] caching reads".format(time.time() - startTime))
-
-        counts = np.bincount([r.pos - start_pos
-                              for r in bam.fetch(chromNameBam, start_pos,
-                                                 end_pos + 1)
-                              if not r.is_reverse and not r.is_unmapped and r.pos >= start_pos],
-                             minlength=end_pos - start_pos + 2)
-
-        read_counts = counts[positions_to_sample - min(positions_to_sample)]
-        if verbose:
-            print("[{:.3f}] finish caching reads.".format(
-                time.time() - startTime))
+    # The start positions of all forward reads in the sampled span, from a
+    # single pass over it. As the BAM file is sorted, these are sorted too and
+    # the number of reads starting at each sampled position is the difference
+    # of two binary searches.
+    if verbose:
+        print("[{:.3f}] caching reads".format(time.time() - startTime))
+    read_counts = np.zeros(len(positions_to_sample), dtype=np.int64)
+    if len(positions_to_sample) > 0:
+        start_pos = int(positions_to_sample[0])
+        end_pos = int(positions_to_sample[-1])
+        # flag 4: unmapped, 16: reverse
+        read_starts = np.fromiter((r.reference_start
+                                   for r in bam.fetch(chromNameBam, start_pos, end_pos + 1)
+                                   if not r.flag & 20),
+                                  dtype=np.int64)
+        read_counts = np.searchsorted(read_starts, positions_to_sample, side='right') - \
+            np.searchsorted(read_starts, positions_to_sample, side='left')
+    if verbose:
+        print("[{:.3f}] finish caching reads.".format(
+            time.time() - startTime))
 
     countTime = time.time()
 
-    c = 1
-    for index in range(len(positions_to_sample)):
-        i = positions_to_sample[index]
-        # stop if the end of the chromosome is reached
-        if i + fragmentLength['median'] > tbit.chroms(chromNameBit):
-            break
-
-        try:
-            gc = getGC_content(tbit, chromNameBit, int(i), int(i + fragmentLength['median']), fraction=False)
-        except Exception as detail:
-            if verbose:
-                print(detail)
-            continue
-
-        subN_gc[gc] += 1
+    # If N_gc is already known, only positions with reads matter
+    computeN = not global_vars.get('N_gc_cached', False)
+    needGC = np.ones(len(positions_to_sample), dtype=bool)
+    if not computeN:
+        needGC = read_counts > 0
+
+    # The GC content of all positions, from the GC track or a single fetch of the sequence
+    gcs = np.zeros(len(positions_to_sample), dtype=np.int64)
+    valid = np.zeros(len(positions_to_sample), dtype=bool)
+    if global_vars.get('gc_track'):
+        gcs[needGC], valid[needGC] = openGCTrack(global_vars['gc_track']).getGC_contents(chromNameBit, positions_to_sample[needGC])
+    else:
+        gcs[needGC], valid[needGC] = getGC_contents(tbit, chromNameBit, positions_to_sample[needGC],
+                                                    fragmentLength['median'], fraction=False)
 
-        # count all reads at position 'i'
-        if len(read_counts) == 0:  # case when no cache was done
-            num_reads = len([x.pos for x in bam.fetch(chromNameBam, i, i + 1)
-                             if x.is_reverse is False and x.pos == i])
-        else:
-            num_reads = read_counts[index]
+    # skip positions whose fragment would extend past the chromosome end
+    # or that have too many Ns
+    valid &= positions_to_sample + fragmentLength['median'] <= tbit.chroms(chromNameBit)
+    if verbose:
+        for i in positions_to_sample[needGC & ~valid]:
+            print("WARNING: too many NNNs present in {}:{}-{}".format(chromNameBit, i, i + fragmentLength['median']))
 
-        if num_reads >= global_vars['max_reads']:
-            peak += 1
-            continue
+    if computeN:
+        subN_gc += np.bincount(gcs[valid], minlength=len(subN_gc))
 
-        subF_gc[gc] += num_reads
-        if verbose:
-            if index % 50000 == 0:
-                endTime = time.time()
-                print("%s processing %d (%.1f per sec) @ %s:%s-%s %s" %
-                      (multiprocessing.current_process().name,
-                       index, index / (endTime - countTime),
-                       chromNameBit, start, end, stepSize))
-        c += 1
+    # positions with too many reads are likely artifacts
+    isPeak = valid & (read_counts >= global_vars['max_reads'])
+    peak = np.sum(isPeak)
+    counted = valid & ~isPeak
+    subF_gc += np.bincount(gcs[counted], weights=read_counts[counted], minlength=len(subF_gc)).astype(subF_gc.dtype)
 
     if verbose:
         endTime = time.time()
         print("%s processing %d (%.1f per sec) @ %s:%s-%s %s" %
               (multiprocessing.current_process().name,
-               index, index / (endTime - countTime),
+               len(positions_to_sample), len(positions_to_sample) / (endTime - countTime),
                chromNameBit, start, end, stepSize))
-        print("%s total time %.1f @ %s:%s-%s %s" % (multiprocessing.current_process().name,
-                                                    (endTime - startTime), chromNameBit, start, end, stepSize))
+        print("%s total time %.1f @ %s:%s-%s %s, %d peak positions skipped" %
+              (multiprocessing.current_process().name, (endTime - startTime),
+               chromNameBit, start, end, stepSize, peak))
 
     return(subN_gc, subF_gc)
 
@@ -425,6 +428,19 @@ def tabulateGCcontent(fragmentLength, chrNameBitToBam, stepSize,
     chunkSize = int(min(2e6, 4e5 / global_vars['reads_per_bp']))
     chromSizes = [(k, v) for k, v in chromSizes if k in list(chrNameBamToBit.keys())]
 
+    N_gc_cached = None
+    cacheFile = None
+    if global_vars.get('gc_track'):
+        cacheFile = N_gcCacheFile(fragmentLength['median'], stepSize, chunkSize,
+                                  chromSizes, chrNameBamToBit, region)
+        if cacheFile is not None and os.path.exists(cacheFile):
+            try:
+                N_gc_cached = np.load(cacheFile)
+            except (IOError, OSError, ValueError):
+                # A corrupt cache file is simply overwritten
+                pass
+    global_vars['N_gc_cached'] = N_gc_cached is not None
+
     imap_res = mapReduce.mapReduce((stepSize,
                                     fragmentLength, chrNameBamToBit,
                                     verbose),
@@ -442,6 +458,11 @@ def tabulateGCcontent(fragmentLength, chrNameBitToBam, stepSize,
             F_gc = subF_gc
             N_gc = subN_gc
 
+    if N_gc_cached is not None:
+        N_gc = N_gc_cached
+    elif cacheFile is not None:
+        saveN_gc(cacheFile, N_gc)
+
     if sum(F_gc) == 0:
         sys.exit("No fragments included in the sampling! Consider decreasing (or maybe increasing) the --sampleSize parameter")
     scaling = float(sum(N_gc)) / float(sum(F_gc))
@@ -454,6 +475,50 @@ def tabulateGCcontent(fragmentLength, chrNameBitToBam, stepSize,
     return data
 
 
+def N_gcCacheFile(fragmentLength, stepSize, chunkSize, chromSizes, chrNameBamToBit, region):
+    """
+    The file in which the expected GC distribution (N_gc) of a genome is
+    cached, in the "gc" subdirectory of $DEEPTOOLS_CACHE_DIR. It depends only
+    on the genome, the fragment length, the positions sampled and the regions
+    filtered out or sampled more. None if caching is disabled or the
+    directory isn't private to the current user.
+    """
+    key = [fragmentLength, stepSize, chunkSize, chromSizes,
+           sorted(chrNameBamToBit.items()), region]
+    fnames = [global_vars['2bit']]
+    if isinstance(global_vars['filter_out'], list):
+        fnames.extend(global_vars['filter_out'])
+    elif global_vars['filter_out']:
+        fnames.append(global_vars['filter_out'])
+    if global_vars['extra_sampling_file']:
+        fnames.append(global_vars['extra_sampling_file'])
+    for fname in fnames:
+        st = os.stat(fname)
+        key.append([os.path.abspath(fname), st.st_size, getattr(st, "st_mtime_ns", st.st_mtime), st.st_ino])
+    key = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+    cacheDir = bamStats.cacheDir()
+    if cacheDir is None:
+        return None
+    cacheDir = os.path.join(cacheDir, "gc")
+    if not privateDirectory(cacheDir):
+        return None
+    return os.path.join(cacheDir, key + ".npy")
+
+
+def saveN_gc(cacheFile, N_gc):
+    """
+    Atomically writes N_gc to cacheFile, which is skipped if that's not possible
+    """
+    try:
+        fd, tmpName = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(cacheFile))
+        with os.fdopen(fd, "wb") as fh:
+            np.save(fh, N_gc)
+        os.rename(tmpName, cacheFile)
+    except (IOError, OSError):
+        pass
+
+
 def countReadsPerGC(regionSize, chrNameBitToBam, stepSize,
                     chromSizes, numberOfProcessors=None, verbose=False,
                     region=None):
@@ -653,6 +718,7 @@ def main(args=None):
     global_vars['bam'] = args.bamfile
     global_vars['filter_out'] = args.blackListFileName
     global_vars['extra_sampling_file'] = extra_sampling_file
+    global_vars['gc_track'] = args.GCtrack
 
     tbit = py2bit.open(global_vars['2bit'])
     bam, mapped, unmapped, stats = bamHandler.openBam(global_vars['bam'], returnStats=True, nThreads=args.numberOfProcessors)
@@ -673,6 +739,9 @@ def main(args=None):
 
         fragment_len_dict = {'median': int(fragment_len_dict['median'])}
 
+    if args.GCtrack:
+        openGCTrack(args.GCtrack).check(tbit, fragment_len_dict['median'])
+
     chrNameBitToBam = tbitToBamChrName(list(tbit.chroms().keys()), bam.references)
 
     global_vars['genome_size'] = sum(tbit.chroms().values())
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A GC track holds, for every position i of a genome, the number of G/C bases
+in the window [i, i + fragmentLength). It's written once per genome and
+fragment length and then memory mapped by computeGCBias and correctGCBias,
+so that the GC content of a fragment is a lookup rather than a scan of the
+sequence.
+
+The file is a short JSON header followed by one array per chromosome, of
+uint8 (if the fragment length is below 255) or uint16 values. Windows with
+too many Ns (see utilities.getGC_contents()) hold the largest value of the
+type.
+"""
+import argparse
+import json
+import multiprocessing
+import struct
+import sys
+
+import numpy as np
+import py2bit
+
+from deeptools import parserCommon
+from deeptools.utilities import getGC_contents
+from deeptools._version import __version__
+
+MAGIC = b'DTGCTRAK'
+VERSION = 1
+
+# The number of positions processed at once
+CHUNK_SIZE = 2000000
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+This tool precomputes the GC content of every fragment of a given length in a
+genome. The resulting file can be given to computeGCBias and correctGCBias
+(with --GCtrack), which then look up the GC content of fragments rather than
+computing it from the genome sequence. The same file can be used for all
+samples with the same fragment length.
+
+Note that the file requires one (if the fragment length is below 255) or two
+bytes per base of the genome.
+""",
+        epilog='example usage:\n computeGCTrack -g mm9.2bit -l 200 -o mm9_200.gc\n\n',
+        add_help=False)
+
+    required = parser.add_argument_group('Required arguments')
+    required.add_argument('--genome', '-g',
+                          help='Genome in two bit format.',
+                          metavar='2bit FILE',
+                          required=True)
+
+    required.add_argument('--fragmentLength', '-l',
+                          help='Fragment length, as used for computeGCBias.',
+                          type=int,
+                          required=True)
+
+    required.add_argument('--outFileName', '-o',
+                          help='File name to save the GC track to.',
+                          metavar='FILE',
+                          required=True)
+
+    optional = parser.add_argument_group('Optional arguments')
+
+    optional.add_argument("--help", "-h", action="help",
+                          help="show this help message and exit")
+
+    optional.add_argument('--version', action='version',
+                          version='%(prog)s {}'.format(__version__))
+
+    optional.add_argument('--numberOfProcessors', '-p',
+                          help='Number of processors to use. Type "max/2" to '
+                          'use half the maximum number of processors or "max" '
+                          'to use all available processors.',
+                          metavar="INT",
+                          type=parserCommon.numberOfProcessors,
+                          default=1,
+                          required=False)
+
+    return parser
+
+
+def _align(x):
+    return x + (-x % 8)
+
+
+def _writeChunk(args):
+    """
+    Computes the GC track for positions [start, end) of a chromosome and
+    writes it to the (already allocated) file
+    """
+    fname, offset, dtype, tbitFile, chrom, start, end, fragmentLength = args
+    tbit = py2bit.open(tbitFile)
+    gc, valid = getGC_contents(tbit, chrom, np.arange(start, end), fragmentLength, fraction=False)
+    tbit.close()
+    gc[~valid] = np.iinfo(dtype).max
+    mm = np.memmap(fname, dtype=dtype, mode='r+', offset=offset, shape=(end - start,))
+    mm[:] = gc
+    mm.flush()
+    del mm
+
+
+def writeGCTrack(tbitFile, fragmentLength, fname, numberOfProcessors=1):
+    """
+    Writes the GC track of a 2bit file for fragments of length fragmentLength to fname
+    """
+    if fragmentLength < 1 or fragmentLength >= 65535:
+        raise ValueError("The fragment length must be between 1 and 65534")
+    dtype = np.dtype(np.uint8) if fragmentLength < 255 else np.dtype('<u2')
+    tbit = py2bit.open(tbitFile)
+    chromSizes = list(tbit.chroms().items())
+    tbit.close()
+
+    chroms = []
+    offset = 0
+    for chrom, size in chromSizes:
+        n = max(0, size - fragmentLength + 1)
+        chroms.append([chrom, size, n, offset])
+        offset = _align(offset + n * dtype.itemsize)
+    header = {'version': VERSION,
+              'fragmentLength': fragmentLength,
+              'dtype': dtype.str,
+              'chroms': chroms}
+    header = json.dumps(header).encode("utf-8")
+    dataStart = _align(len(MAGIC) + 8 + len(header))
+
+    with open(fname, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<Q", len(header)))
+        fh.write(header)
+        fh.truncate(dataStart + offset)
+
+    tasks = []
+    for chrom, size, n, offset in chroms:
+        for start in range(0, n, CHUNK_SIZE):
+            tasks.append((fname, dataStart + offset + start * dtype.itemsize, dtype,
+                          tbitFile, chrom, start, min(start + CHUNK_SIZE, n), fragmentLength))
+    if numberOfProcessors > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(numberOfProcessors)
+        pool.map_async(_writeChunk, tasks).get(9999999)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            _writeChunk(task)
+
+
+class GCTrack(object):
+    """
+    A GC track opened with openGCTrack()
+
+    >>> import os, tempfile
+    >>> tbitFile = os.path.dirname(os.path.abspath(__file__)) + "/test/test_corrGC/sequence.2bit"
+    >>> fd, fname = tempfile.mkstemp()
+    >>> os.close(fd)
+    >>> writeGCTrack(tbitFile, 3, fname)
+    >>> track = openGCTrack(fname)
+    >>> track.fragmentLength
+    3
+    >>> track.getGC_contents('chr2L', [0, 2, 4, 6, 997, 998])
+    (array([2, 1, 1, 2, 1, 0]), array([ True,  True,  True,  True,  True, False]))
+    >>> tbit = py2bit.open(tbitFile)
+    >>> track.check(tbit, 3)
+    >>> gc, valid = getGC_contents(tbit, 'chr2L', np.arange(1000), 3, fraction=False)
+    >>> np.array_equal(track.getGC_contents('chr2L', np.arange(1000))[0], gc)
+    True
+    >>> os.remove(fname)
+    """
+
+    def __init__(self, fname, header, dataStart):
+        self.fname = fname
+        self.fragmentLength = header['fragmentLength']
+        self.chromSizes = dict()
+        self.tracks = dict()
+        dtype = np.dtype(header['dtype'])
+        self.invalid = np.iinfo(dtype).max
+        mm = np.memmap(fname, dtype=np.uint8, mode='r')
+        for chrom, size, n, offset in header['chroms']:
+            self.chromSizes[chrom] = size
+            offset += dataStart
+            self.tracks[chrom] = mm[offset:offset + n * dtype.itemsize].view(dtype)
+
+    def check(self, tbit, fragmentLength):
+        """
+        Exits if the track wasn't made for this genome and fragment length
+        """
+        if fragmentLength != self.fragmentLength:
+            sys.exit("The GC track {} is for a fragment length of {}, not {}\n".format(self.fname, self.fragmentLength, fragmentLength))
+        if tbit.chroms() != self.chromSizes:
+            sys.exit("The GC track {} was made for a different genome\n".format(self.fname))
+
+    def getGC_contents(self, chrom, starts):
+        """
+        As utilities.getGC_contents(..., fraction=False) for windows of
+        length fragmentLength, but read from the track
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        track = self.tracks[chrom]
+        valid = (starts >= 0) & (starts < len(track))
+        gc = np.zeros(len(starts), dtype=np.int64)
+        gc[valid] = track[starts[valid]]
+        valid[valid] = gc[valid] != self.invalid
+        gc[~valid] = 0
+        return gc, valid
+
+    def getGC_content(self, chrom, start):
+        """
+        The GC count of a single window, or None if it's not valid
+        """
+        track = self.tracks[chrom]
+        if start < 0 or start >= len(track):
+            return None
+        gc = int(track[start])
+        if gc == self.invalid:
+            return None
+        return gc
+
+
+def openGCTrack(fname):
+    """
+    Opens a file written by writeGCTrack()
+    """
+    with open(fname, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            sys.exit("{} is not a GC track made by computeGCTrack\n".format(fname))
+        hLen = struct.unpack("<Q", fh.read(8))[0]
+        header = json.loads(fh.read(hLen).decode("utf-8"))
+    if header['version'] != VERSION:
+        sys.exit("{} has an unsupported version ({})\n".format(fname, header['version']))
+    return GCTrack(fname, header, _align(len(MAGIC) + 8 + hLen))
+
+
+def main(args=None):
+    args = parse_arguments().parse_args(args)
+    writeGCTrack(args.genome, args.fragmentLength, args.outFileName, args.numberOfProcessors)
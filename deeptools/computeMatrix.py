@@ -10,6 +10,7 @@ from deeptools.parserCommon import writableFile, numberOfProcessors
 from deeptools._version import __version__
 from deeptools import parserCommon
 from deeptools import heatmapper
+from deeptools import regionCache
 import deeptools.computeMatrixOperations as cmo
 import deeptools.deepBlue as db
 
@@ -112,12 +113,27 @@ def computeMatrixOutputArgs(args=None):
                         type=writableFile,
                         required=True)
 
+    output.add_argument('--matrixFormat',
+                        help='The format of the matrix file. "text" is the '
+                        'gzipped text format used by all previous versions of '
+                        'deepTools. "binary" stores the values as compressed '
+                        'float32 blocks, which is much faster to write and read '
+                        'for large matrices. "binary-uncompressed" is similar, '
+                        'but the values can be memory-mapped by plotHeatmap, '
+                        'plotProfile and computeMatrixOperations rather than being '
+                        'read into memory, at the cost of larger files. All three '
+                        'formats are recognized automatically by the other tools, '
+                        'and can be converted between with computeMatrixOperations convert.',
+                        choices=['text', 'binary', 'binary-uncompressed'],
+                        default='text')
+
     output.add_argument('--outFileNameMatrix',
                         help='If this option is given, then the matrix '
                         'of values underlying the heatmap will be saved '
                         'using the indicated name, e.g. IndividualValues.tab.'
                         'This matrix can easily be loaded into R or '
-                        'other programs.',
+                        'other programs. The file is gzipped if the '
+                        'name ends in .gz.',
                         metavar='FILE',
                         type=writableFile)
     output.add_argument('--outFileSortedRegions',
@@ -339,6 +355,35 @@ def computeMatrixOptArgs(case=['scale-regions', 'reference-point'][0]):
                           'this number.',
                           type=float,
                           default=1)
+
+    optional.add_argument('--regionCache',
+                          help='A directory in which the per-base values '
+                          'of each bigWig file around each region are cached. '
+                          'Subsequent runs with the same bigWig and regions '
+                          'files, but with the same or smaller upstream, '
+                          'downstream or body lengths and/or a different bin '
+                          'size, will then use the cached values rather than '
+                          'reading the bigWig files again. The cache is keyed '
+                          'on the path, size, modification time and inode of '
+                          'each bigWig file. (Default: %(default)s)',
+                          metavar='DIR',
+                          default=None)
+
+    optional.add_argument('--regionCacheSize',
+                          help='The maximum size, in megabytes, of the '
+                          '--regionCache directory. Once it is exceeded, the '
+                          'least recently used cached values are removed. '
+                          '(Default: %(default)s)',
+                          metavar='MB',
+                          type=int,
+                          default=regionCache.MAX_CACHE_SIZE)
+
+    optional.add_argument('--float32',
+                          help='If set, values are computed and held in memory '
+                          'as 32-bit floats, with missing values stored as NaN. '
+                          'This halves the memory needed for large matrices. '
+                          'The binary matrix formats always store 32-bit floats.',
+                          action='store_true')
     optional.add_argument('--numberOfProcessors', '-p',
                           help='Number of processors to use. Type "max/2" to '
                           'use half the maximum number of processors or "max" '
@@ -393,7 +438,7 @@ def main(args=None):
                   'unscaled 3 prime': args.unscaled3prime
                   }
 
-    hm = heatmapper.heatmapper()
+    hm = heatmapper.heatmapper(float32=args.float32)
 
     # Preload deepBlue files, which need to then be deleted
     deepBlueFiles = []
@@ -435,10 +480,10 @@ def main(args=None):
         hm.parameters["group_boundaries"] = hm.matrix.group_boundaries
         cmo.sortMatrix(hm, args.regionsFileName, args.transcriptID, args.transcript_id_designator, verbose=not args.quiet)
 
-    hm.save_matrix(args.outFileName)
+    hm.save_matrix(args.outFileName, file_format=args.matrixFormat, numberOfProcessors=args.numberOfProcessors)
 
     if args.outFileNameMatrix:
-        hm.save_matrix_values(args.outFileNameMatrix)
+        hm.save_matrix_values(args.outFileNameMatrix, numberOfProcessors=args.numberOfProcessors)
 
     if args.outFileSortedRegions:
         hm.save_BED(args.outFileSortedRegions)
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 import deeptools.heatmapper as heatmapper
+import deeptools.matrixContainer as matrixContainer
 import deeptoolsintervals.parse as dti
 import numpy as np
 import argparse
 import sys
 import os
 import csv
+import warnings
 from deeptools._version import __version__
 
 
@@ -46,6 +48,9 @@ or
 or
   computeMatrixOperations sort -h
 
+or
+  computeMatrixOperations convert -h
+
 """,
         epilog='example usages:\n'
                'computeMatrixOperations subset -m input.mat.gz -o output.mat.gz --group "group 1" "group 2" --samples "sample 3" "sample 10"\n\n'
@@ -126,6 +131,14 @@ or
         help='Sort a matrix file to correspond to the order of entries in the desired input file(s). The groups of regions designated by the files must be present in the order found in the output of computeMatrix (otherwise, use the subset command first). Note that this subcommand can also be used to remove unwanted regions, since regions not present in the input file(s) will be omitted from the output.',
         usage='Example usage:\n  computeMatrixOperations sort -m input.mat.gz -R regions1.bed regions2.bed regions3.gtf -o input.sorted.mat.gz\n\n')
 
+    # convert
+    subparsers.add_parser(
+        'convert',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        parents=[infoArgs(), convertArgs()],
+        help='Convert a matrix file between the gzipped text format and the binary format (see computeMatrix --matrixFormat).',
+        usage='Example usage:\n  computeMatrixOperations convert -m input.mat.gz -o output.mat --format binary\n\n')
+
     parser.add_argument('--version', action='version',
                         version='%(prog)s {}'.format(__version__))
 
@@ -239,6 +252,22 @@ def filterValuesArgs():
     return parser
 
 
+def convertArgs():
+    parser = argparse.ArgumentParser(add_help=False)
+    required = parser.add_argument_group('Required arguments')
+
+    required.add_argument('--outFileName', '-o',
+                          help='Output file name',
+                          required=True)
+
+    required.add_argument('--format',
+                          help='The format of the output file.',
+                          choices=['text', 'binary', 'binary-uncompressed'],
+                          required=True)
+
+    return parser
+
+
 def sortArgs():
     parser = argparse.ArgumentParser(add_help=False)
     required = parser.add_argument_group('Required arguments')
@@ -314,58 +343,26 @@ def relabelMatrix(matrix, args):
         matrix.matrix.sample_labels = args.sampleLabels
 
 
-def getGroupBounds(args, matrix):
+def getSubsetIndices(args, parameters):
     """
-    Given the group labels, return an indexing array and the resulting boundaries
+    Given the group and sample labels to keep, return lists of their indices
+    (or None, if all of the groups or samples are to be kept)
     """
-    bounds = matrix.parameters['group_boundaries']
-    if args.groups is None:
-        return range(0, matrix.matrix.matrix.shape[0]), np.array(bounds)
-    else:
-        o = list()
-        obounds = [0]
+    groups = None
+    if args.groups is not None:
+        groups = []
         for group in args.groups:
-            if group not in matrix.matrix.group_labels:
+            if group not in parameters['group_labels']:
                 sys.exit("Error: '{0}' is not a valid group\n".format(group))
-            idx = matrix.matrix.group_labels.index(group)
-            o.extend(range(bounds[idx], bounds[idx + 1]))
-            obounds.append(bounds[idx + 1] - bounds[idx])
-        return o, np.cumsum(obounds)
-
-
-def getSampleBounds(args, matrix):
-    """
-    Given the sample labels, return an indexing array
-    """
-    bounds = matrix.parameters['sample_boundaries']
-    if args.samples is None:
-        return np.arange(0, matrix.matrix.matrix.shape[1])
-    else:
-        o = list()
+            groups.append(parameters['group_labels'].index(group))
+    samples = None
+    if args.samples is not None:
+        samples = []
         for sample in args.samples:
-            if sample not in matrix.matrix.sample_labels:
+            if sample not in parameters['sample_labels']:
                 sys.exit("Error: '{0}' is not a valid sample\n".format(sample))
-            idx = matrix.matrix.sample_labels.index(sample)
-            o.extend(range(bounds[idx], bounds[idx + 1]))
-        return o
-
-
-def subsetRegions(hm, bounds):
-    out = []
-    for x in bounds:
-        reg = hm.matrix.regions[x]
-        # we need to add a list of [chrom, [(start, end), (start, end)], name, 0, strand, score)]
-        if isinstance(reg, dict):
-            # This happens on occasion
-            starts = reg["start"].split(",")
-            starts = [int(x) for x in starts]
-            ends = reg["end"].split(",")
-            ends = [int(x) for x in ends]
-            regs = [(x, y) for x, y in zip(starts, ends)]
-            out.append([reg["chrom"], regs, reg["name"], 0, reg["strand"], reg["score"]])
-        else:
-            out.append(reg)
-    return out
+            samples.append(parameters['sample_labels'].index(sample))
+    return groups, samples
 
 
 def filterHeatmap(hm, args):
@@ -665,7 +662,29 @@ def sortMatrix(hm, regionsFileName, transcriptID, transcript_id_designator, verb
     """
     Iterate through the files noted by regionsFileName and sort hm accordingly
     """
+    order, boundaries, labelsList = getSortOrder(hm.parameters['group_labels'],
+                                                 hm.parameters['group_boundaries'],
+                                                 [reg[2] for reg in hm.matrix.regions],
+                                                 regionsFileName, transcriptID,
+                                                 transcript_id_designator, verbose)
+    hm.matrix.regions = [hm.matrix.regions[i] for i in order]
+    order = np.array(order)
+    hm.matrix.matrix = hm.matrix.matrix[order, :]
+
+    # Update the parameters
+    hm.parameters["group_labels"] = labelsList
+    hm.matrix.group_labels = labelsList
+    hm.parameters["group_boundaries"] = boundaries
+    hm.matrix.group_boundaries = boundaries
+
 
+def getSortOrder(groupLabels, groupBoundaries, names, regionsFileName, transcriptID, transcript_id_designator, verbose=True):
+    """
+    Iterate through the files noted by regionsFileName and return the order
+    in which the rows of a matrix (with the given group labels/boundaries and
+    region names) should be output, the resulting group boundaries and the
+    resulting group labels.
+    """
     labels = dict()
     regions = []
     defaultGroup = None
@@ -698,7 +717,7 @@ def sortMatrix(hm, regionsFileName, transcriptID, transcript_id_designator, verb
         fp.close()
 
     # Do some sanity checking on the group labels and region names within them
-    s1 = set(hm.parameters['group_labels'])
+    s1 = set(groupLabels)
     if verbose:
         for e in labels:
             if e not in s1:
@@ -708,15 +727,15 @@ def sortMatrix(hm, regionsFileName, transcriptID, transcript_id_designator, verb
     d = dict()
     pos = 0
     groupSizes = dict()
-    for idx, label in enumerate(hm.parameters['group_labels']):
-        s = hm.parameters['group_boundaries'][idx]
-        e = hm.parameters['group_boundaries'][idx + 1]
+    for idx, label in enumerate(groupLabels):
+        s = groupBoundaries[idx]
+        e = groupBoundaries[idx + 1]
         if label not in labels:
             continue
         d[label] = dict()
         groupSize = 0
-        for reg in hm.matrix.regions[s:e]:
-            d[label][reg[2]] = pos
+        for name in names[s:e]:
+            d[label][name] = pos
             pos += 1
             groupSize += 1
         groupSizes[label] = groupSize
@@ -745,15 +764,284 @@ def sortMatrix(hm, regionsFileName, transcriptID, transcript_id_designator, verb
         if sz == 0 and verbose:
             sys.exit("The region group {} had no matching entries!\n".format(label))
         boundaries.append(sz + boundaries[-1])
-    hm.matrix.regions = [hm.matrix.regions[i] for i in order]
-    order = np.array(order)
-    hm.matrix.matrix = hm.matrix.matrix[order, :]
 
-    # Update the parameters
-    hm.parameters["group_labels"] = labelsList
-    hm.matrix.group_labels = labelsList
-    hm.parameters["group_boundaries"] = boundaries
-    hm.matrix.group_boundaries = boundaries
+    return order, boundaries, labelsList
+
+
+def streamRows(reader, writer, lines, rows, samples=None):
+    """
+    Copy a (start, end) range of rows from a binary matrix reader to a writer,
+    one block at a time
+    """
+    for s, e, values in reader.iterBlocks(samples=samples, rows=rows):
+        writer.writeLines(lines[s:e], values)
+
+
+def binaryWriter(reader, fname, sample_boundaries=None):
+    """
+    Returns a binary matrix writer using the same settings as reader
+    """
+    if sample_boundaries is None:
+        sample_boundaries = reader.sample_boundaries
+    return matrixContainer.MatrixWriter(fname, sample_boundaries, compression=reader.compression)
+
+
+def streamInfo(args):
+    reader = matrixContainer.MatrixReader(args.matrixFile)
+    print("Groups:")
+    for group in reader.parameters['group_labels']:
+        print("\t{0}".format(group))
+
+    print("Samples:")
+    for sample in reader.parameters['sample_labels']:
+        print("\t{0}".format(sample))
+    reader.close()
+
+
+def streamRelabel(args):
+    reader = matrixContainer.MatrixReader(args.matrixFile)
+    p = reader.parameters
+    if args.groupLabels:
+        if len(args.groupLabels) != len(p['group_labels']):
+            sys.exit("You specified {} group labels, but {} are required.\n".format(len(args.groupLabels), len(p['group_labels'])))
+        p['group_labels'] = args.groupLabels
+    if args.sampleLabels:
+        if len(args.sampleLabels) != len(p['sample_labels']):
+            sys.exit("You specified {} sample labels, but {} are required.\n".format(len(args.sampleLabels), len(p['sample_labels'])))
+        p['sample_labels'] = args.sampleLabels
+
+    lines = reader.regionLines()
+    writer = binaryWriter(reader, args.outFileName)
+    streamRows(reader, writer, lines, (0, reader.shape[0]))
+    writer.close(p)
+    reader.close()
+
+
+def streamSubset(args):
+    """
+    subset, reading only the requested groups and the tiles of the requested samples
+    """
+    reader = matrixContainer.MatrixReader(args.matrixFile)
+    p = reader.parameters
+    bounds = p['group_boundaries']
+    sBounds = p['sample_boundaries']
+
+    groups = args.groups
+    if groups is None:
+        groups = p['group_labels']
+    for group in groups:
+        if group not in p['group_labels']:
+            sys.exit("Error: '{0}' is not a valid group\n".format(group))
+    samples = args.samples
+    if samples is None:
+        samples = p['sample_labels']
+    for sample in samples:
+        if sample not in p['sample_labels']:
+            sys.exit("Error: '{0}' is not a valid sample\n".format(sample))
+    sIdx = [p['sample_labels'].index(x) for x in samples]
+    newSampleBounds = [0]
+    for idx in sIdx:
+        newSampleBounds.append(newSampleBounds[-1] + sBounds[idx + 1] - sBounds[idx])
+
+    lines = reader.regionLines()
+    writer = binaryWriter(reader, args.outFileName, newSampleBounds)
+    newGroupBounds = [0]
+    for group in groups:
+        idx = p['group_labels'].index(group)
+        streamRows(reader, writer, lines, (bounds[idx], bounds[idx + 1]), samples=sIdx)
+        newGroupBounds.append(newGroupBounds[-1] + bounds[idx + 1] - bounds[idx])
+
+    for param in heatmapper.heatmapper().special_params:
+        if param in p:
+            p[param] = [p[param][idx] for idx in sIdx]
+    p['sample_labels'] = list(samples)
+    p['sample_boundaries'] = newSampleBounds
+    p['group_labels'] = list(groups)
+    p['group_boundaries'] = newGroupBounds
+    writer.close(p)
+    reader.close()
+
+
+def streamFilter(reader, writer, lines, keepFunc):
+    """
+    Write the rows for which keepFunc(lines, values) is True. Returns the resulting group boundaries.
+    """
+    bounds = reader.parameters['group_boundaries']
+    newBounds = [0]
+    for idx in range(len(bounds) - 1):
+        n = 0
+        for s, e, values in reader.iterBlocks(rows=(bounds[idx], bounds[idx + 1])):
+            keep = keepFunc(lines[s:e], values)
+            writer.writeLines([x for x, k in zip(lines[s:e], keep) if k], values[keep])
+            n += int(np.sum(keep))
+        newBounds.append(newBounds[-1] + n)
+    return newBounds
+
+
+def streamFilterStrand(args):
+    reader = matrixContainer.MatrixReader(args.matrixFile)
+    lines = reader.regionLines()
+    writer = binaryWriter(reader, args.outFileName)
+
+    def keepFunc(lines, values):
+        return np.array([x.split("\t")[5] == args.strand for x in lines], dtype=bool)
+
+    reader.parameters['group_boundaries'] = streamFilter(reader, writer, lines, keepFunc)
+    writer.close(reader.parameters)
+    reader.close()
+
+
+def streamFilterValues(args):
+    reader = matrixContainer.MatrixReader(args.matrixFile)
+    lines = reader.regionLines()
+    writer = binaryWriter(reader, args.outFileName)
+    minVal = -np.inf if args.min is None else args.min
+    maxVal = np.inf if args.max is None else args.max
+
+    def keepFunc(lines, values):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            mins = np.nanmin(values, axis=1)
+            maxs = np.nanmax(values, axis=1)
+        # mins/maxs will be nan iff a row is entirely nan. Don't filter.
+        return np.isnan(mins) | ((mins >= minVal) & (maxs <= maxVal))
+
+    reader.parameters['group_boundaries'] = streamFilter(reader, writer, lines, keepFunc)
+    writer.close(reader.parameters)
+    reader.close()
+
+
+def streamRbind(args):
+    """
+    rbind, copying each group of each file block by block
+    """
+    readers = [matrixContainer.MatrixReader(x) for x in args.matrixFile]
+    lines = [x.regionLines() for x in readers]
+    p = readers[0].parameters
+
+    labels = []
+    for reader in readers:
+        for label in reader.parameters['group_labels']:
+            if label not in labels:
+                labels.append(label)
+
+    writer = binaryWriter(readers[0], args.outFileName)
+    bounds = [0]
+    for label in labels:
+        n = 0
+        for reader, _lines in zip(readers, lines):
+            if label not in reader.parameters['group_labels']:
+                continue
+            idx = reader.parameters['group_labels'].index(label)
+            s = reader.parameters['group_boundaries'][idx]
+            e = reader.parameters['group_boundaries'][idx + 1]
+            streamRows(reader, writer, _lines, (s, e))
+            n += e - s
+        bounds.append(bounds[-1] + n)
+
+    p['group_labels'] = labels
+    p['group_boundaries'] = bounds
+    writer.close(p)
+    for reader in readers:
+        reader.close()
+
+
+def regionKeys(reader, lines):
+    """
+    Returns a dictionary of (group label, region name): row index. As in
+    cbindMatrices(), the last row wins if a name occurs more than once.
+    """
+    d = dict()
+    p = reader.parameters
+    for idx, label in enumerate(p['group_labels']):
+        for row in range(p['group_boundaries'][idx], p['group_boundaries'][idx + 1]):
+            d[(label, lines[row].split("\t")[3])] = row
+    return d
+
+
+def streamCbind(args):
+    """
+    cbind, joining rows on a hash of (group label, region name). Only the first
+    matrix is read in order, the others are read by row index as needed.
+    """
+    readers = [matrixContainer.MatrixReader(x) for x in args.matrixFile]
+    lines = readers[0].regionLines()
+    p = readers[0].parameters
+    nRows = readers[0].shape[0]
+    d = regionKeys(readers[0], lines)
+
+    # For each subsequent matrix, the source row of each output row (or -1)
+    sources = []
+    sampleBounds = list(p['sample_boundaries'])
+    for reader in readers[1:]:
+        d2 = regionKeys(reader, reader.regionLines())
+        src = np.empty(nRows, dtype=np.int64)
+        src[:] = -1
+        for key, row in d.items():
+            if key in d2:
+                src[row] = d2[key]
+        sources.append(src)
+
+        p['sample_labels'].extend(reader.parameters['sample_labels'])
+        sampleBounds.extend([x + sampleBounds[-1] for x in reader.parameters['sample_boundaries'][1:]])
+        for param in heatmapper.heatmapper().special_params:
+            p[param].extend(reader.parameters[param])
+    p['sample_boundaries'] = sampleBounds
+
+    writer = binaryWriter(readers[0], args.outFileName, sampleBounds)
+    for s, e, values in readers[0].iterBlocks():
+        parts = [values]
+        for reader, src in zip(readers[1:], sources):
+            block = np.empty((e - s, reader.shape[1]), dtype=values.dtype)
+            block[:] = np.nan
+            mask = src[s:e] >= 0
+            block[mask] = reader.readRows(src[s:e][mask])
+            parts.append(block)
+        writer.writeLines(lines[s:e], np.hstack(parts))
+    writer.close(p)
+    for reader in readers:
+        reader.close()
+
+
+def streamSort(args):
+    reader = matrixContainer.MatrixReader(args.matrixFile)
+    p = reader.parameters
+    lines = reader.regionLines()
+    order, boundaries, labelsList = getSortOrder(p['group_labels'],
+                                                 p['group_boundaries'],
+                                                 [x.split("\t")[3] for x in lines],
+                                                 args.regionsFileName, args.transcriptID,
+                                                 args.transcript_id_designator)
+    writer = binaryWriter(reader, args.outFileName)
+    for start in range(0, len(order), writer.blockRows):
+        idx = order[start:start + writer.blockRows]
+        writer.writeLines([lines[i] for i in idx], reader.readRows(idx))
+    p['group_labels'] = labelsList
+    p['group_boundaries'] = boundaries
+    writer.close(p)
+    reader.close()
+
+
+def canStream(args):
+    """
+    Streaming is used if all of the input files are binary matrices
+    """
+    if args.command not in streamFunctions:
+        return False
+    fnames = args.matrixFile
+    if not isinstance(fnames, list):
+        fnames = [fnames]
+    return all([matrixContainer.isBinaryMatrix(x) for x in fnames])
+
+
+streamFunctions = {'info': streamInfo,
+                   'relabel': streamRelabel,
+                   'subset': streamSubset,
+                   'filterStrand': streamFilterStrand,
+                   'filterValues': streamFilterValues,
+                   'rbind': streamRbind,
+                   'cbind': streamCbind,
+                   'sort': streamSort}
 
 
 def main(args=None):
@@ -763,39 +1051,21 @@ def main(args=None):
         args = [sys.argv[1], "-h"]
     args = parse_arguments().parse_args(args)
 
+    if canStream(args):
+        streamFunctions[args.command](args)
+        return
+
     hm = heatmapper.heatmapper()
-    if not isinstance(args.matrixFile, list):
+    if args.command == 'subset':
+        # Only the requested groups and samples are read
+        groups, samples = getSubsetIndices(args, heatmapper.readMatrixParameters(args.matrixFile))
+        hm.read_matrix_file(args.matrixFile, groups=groups, samples=samples)
+    elif not isinstance(args.matrixFile, list):
         hm.read_matrix_file(args.matrixFile)
 
     if args.command == 'info':
         printInfo(hm)
     elif args.command == 'subset':
-        sIdx = getSampleBounds(args, hm)
-        gIdx, gBounds = getGroupBounds(args, hm)
-
-        # groups
-        hm.matrix.regions = subsetRegions(hm, gIdx)
-        # matrix
-        hm.matrix.matrix = hm.matrix.matrix[gIdx, :]
-        hm.matrix.matrix = hm.matrix.matrix[:, sIdx]
-        # boundaries
-        if args.samples is None:
-            args.samples = hm.matrix.sample_labels
-        hm.matrix.sample_boundaries = hm.matrix.sample_boundaries[0:len(args.samples) + 1]
-        hm.matrix.group_boundaries = gBounds.tolist()
-        # special params
-        keepIdx = set()
-        for _, sample in enumerate(hm.matrix.sample_labels):
-            if sample in args.samples:
-                keepIdx.add(_)
-        for param in hm.special_params:
-            hm.parameters[param] = [v for k, v in enumerate(hm.parameters[param]) if k in keepIdx]
-        # labels
-        hm.matrix.sample_labels = args.samples
-        if args.groups is None:
-            args.groups = hm.matrix.group_labels
-        hm.matrix.group_labels = args.groups
-        # save
         hm.save_matrix(args.outFileName)
     elif args.command == 'filterStrand':
         filterHeatmap(hm, args)
@@ -815,5 +1085,7 @@ def main(args=None):
     elif args.command == 'relabel':
         relabelMatrix(hm, args)
         hm.save_matrix(args.outFileName)
+    elif args.command == 'convert':
+        hm.save_matrix(args.outFileName, file_format=args.format)
     else:
         sys.exit("Unknown command {0}!\n".format(args.command))
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import heapq
+import itertools
 import os
 import shutil
 import time
 import subprocess
 import sys
+import zlib
 
 import py2bit
+import pyBigWig
 import pysam
 import multiprocessing
 import numpy as np
@@ -15,8 +19,9 @@ import argparse
 
 from scipy.stats import binom
 
-from deeptools.utilities import tbitToBamChrName, getGC_content
-from deeptools import writeBedGraph, parserCommon, mapReduce
+from deeptools.utilities import tbitToBamChrName, getGC_content, getGC_contents
+from deeptools.computeGCTrack import openGCTrack
+from deeptools import parserCommon, mapReduce, bamWriter
 from deeptools import utilities
 from deeptools.bamHandler import openBam
 
@@ -110,10 +115,18 @@ def getRequiredArgs():
     optional.add_argument("--help", "-h", action="help",
                           help="show this help message and exit")
 
+    optional.add_argument('--GCtrack',
+                          help='GC track made by computeGCTrack for this genome '
+                          'and the fragment length used by computeGCBias. The '
+                          'GC content of fragments of that length is then '
+                          'looked up rather than computed from the genome '
+                          'sequence.',
+                          metavar='FILE')
+
     return parser
 
 
-def getReadGCcontent(tbit, read, fragmentLength, chrNameBit):
+def getReadGCcontent(tbit, read, fragmentLength, chrNameBit, gcTrack=None):
     """
     The fragments for forward and reverse reads are defined as follows::
 
@@ -128,6 +141,8 @@ def getReadGCcontent(tbit, read, fragmentLength, chrNameBit):
            |-----------------------------------------|
                             read.tlen
 
+    If a GC track (for fragmentLength) is given, the GC content of fragments
+    of that length is read from it.
     """
     fragStart = None
     fragEnd = None
@@ -148,6 +163,9 @@ def getReadGCcontent(tbit, read, fragmentLength, chrNameBit):
             fragStart = read.pos
             fragEnd = fragStart + fragmentLength
     fragStart = max(0, fragStart)
+    if gcTrack is not None and fragEnd - fragStart == fragmentLength \
+            and fragEnd <= gcTrack.chromSizes[chrNameBit]:
+        return gcTrack.getGC_content(chrNameBit, fragStart)
     try:
         gc = getGC_content(tbit, chrNameBit, fragStart, fragEnd)
     except Exception:
@@ -160,6 +178,63 @@ def getReadGCcontent(tbit, read, fragmentLength, chrNameBit):
     return gc
 
 
+def getReadsGCcontent(tbit, reads, fragmentLength, chrNameBit, gcTrack=None):
+    """
+    getReadGCcontent() for many reads, given as a 2D array with the start,
+    end, flag, template length and aligned length of each read (see
+    readArrays()). The GC content of all fragments is computed at once from
+    the GC track or from a single fetch of the sequence.
+
+    Returns the GC content of each read's fragment, which is -1 if it can't
+    be determined.
+    """
+    pos, aend, flag, tlen, _, qlen = reads.T
+    isReverse = flag & 16 != 0
+    fragStart = np.zeros(len(pos), dtype=np.int64)
+    fragEnd = np.zeros(len(pos), dtype=np.int64)
+
+    paired = (flag & 3 == 3) & (np.abs(tlen) < 2 * fragmentLength)
+    rev = paired & isReverse & (tlen < 0)
+    fwd = paired & ~rev & (tlen >= qlen)
+    fragEnd[rev] = aend[rev]
+    fragStart[rev] = aend[rev] + tlen[rev]
+    fragStart[fwd] = pos[fwd]
+    fragEnd[fwd] = pos[fwd] + tlen[fwd]
+
+    # Fragments starting at 0 are also extended from the read, as in
+    # getReadGCcontent()
+    single = ~(rev | fwd) | (fragStart == 0)
+    fragEnd[single] = np.where(isReverse, aend, pos + fragmentLength)[single]
+    fragStart[single] = fragEnd[single] - fragmentLength
+    fragStart = np.maximum(fragStart, 0)
+
+    gc = np.full(len(pos), -1, dtype=np.int64)
+    chromSize = tbit.chroms(chrNameBit)
+    useTrack = np.zeros(len(pos), dtype=bool)
+    if gcTrack is not None:
+        useTrack = (fragEnd - fragStart == fragmentLength) & (fragEnd <= chromSize)
+        counts, valid = gcTrack.getGC_contents(chrNameBit, fragStart[useTrack])
+        gc[useTrack] = np.where(valid, counts, -1)
+
+    # Fragments extending beyond the chromosome are truncated
+    rest = ~useTrack
+    fractions, valid = getGC_contents(tbit, chrNameBit, fragStart[rest],
+                                      np.minimum(fragEnd[rest], chromSize) - fragStart[rest])
+    # match the gc to the given fragmentLength
+    gc[rest] = np.where(valid, np.round(fractions * fragmentLength), -1)
+    return gc
+
+
+def readArrays(reads):
+    """
+    The start, end, flag, template length, mate start and aligned length of
+    each of the reads, as columns of a 2D array
+    """
+    return np.array([(r.pos, r.reference_end, r.flag, r.template_length,
+                      r.next_reference_start, r.query_alignment_length)
+                     for r in reads], dtype=np.int64).reshape(-1, 6)
+
+
 def writeCorrected_wrapper(args):
     return writeCorrected_worker(*args)
 
@@ -174,65 +249,89 @@ def writeCorrected_worker(chrNameBam, chrNameBit, start, end, step):
     ['chr2L\t200\t225\t31.6\n', 'chr2L\t225\t250\t33.8\n', 'chr2L\t250\t275\t37.9\n', 'chr2L\t275\t300\t40.9\n']
     >>> os.remove(tempFile)
     """
-    global R_gc
-    fragmentLength = len(R_gc) - 1
+    res = getCorrectedCoverage(chrNameBam, chrNameBit, start, end, step)
+    if res is None:
+        return None
 
-    cvg_corr = np.zeros(end - start)
+    _file = open(utilities.getTempFileName(suffix='.bg'), 'w')
+    # save in bedgraph format
+    for writeStart, writeEnd, value in zip(*res):
+        _file.write("%s\t%d\t%d\t%.1f\n" % (chrNameBit, writeStart,
+                                            writeEnd, value))
+
+    tempFileName = _file.name
+    _file.close()
+    return tempFileName
 
-    i = 0
+
+def writeCorrectedRuns_wrapper(args):
+    """
+    As writeCorrected_worker(), but returns the chromosome and the starts,
+    ends and values of runs of bins with the same (rounded) value, which are
+    written directly to a bigWig file
+    """
+    chrNameBit = args[1]
+    res = getCorrectedCoverage(*args)
+    if res is None:
+        return None
+    starts, ends, values = res
+    # The same values as written to the bedGraph file
+    values = np.char.mod('%.1f', values).astype(float)
+    newRun = np.r_[True, (starts[1:] != ends[:-1]) | (values[1:] != values[:-1])]
+    first = np.flatnonzero(newRun)
+    last = np.r_[first[1:], len(starts)] - 1
+    return chrNameBit, starts[first], ends[last], values[first]
+
+
+def getCorrectedCoverage(chrNameBam, chrNameBit, start, end, step):
+    """
+    The GC corrected coverage of a region of the genome, as the starts, ends
+    and mean values of the bins of size step with a value above 0, or None
+    if no reads were used.
+    """
+    global R_gc
+    fragmentLength = len(R_gc) - 1
 
     tbit = py2bit.open(global_vars['2bit'])
+    gcTrack = None
+    if global_vars.get('gc_track'):
+        gcTrack = openGCTrack(global_vars['gc_track'])
     bam = openBam(global_vars['bam'])
-    read_repetitions = 0
-    removed_duplicated_reads = 0
     startTime = time.time()
 
-    # caching seems to be faster
     # r.flag & 4 == 0 is to skip unmapped
     # reads that nevertheless are asigned
     # to a genomic position
-    reads = [r for r in bam.fetch(chrNameBam, start, end)
-             if r.flag & 4 == 0]
-
+    reads = readArrays(r for r in bam.fetch(chrNameBam, start, end)
+                       if r.flag & 4 == 0 and r.reference_end is not None)
     bam.close()
-    r_index = -1
-    for read in reads:
-        r_index += 1
-        try:
-            # calculate GC content of read fragment
-            gc = getReadGCcontent(tbit, read, fragmentLength,
-                                  chrNameBit)
-        except Exception as detail:
-            print(detail)
-            """ this exception happens when the end of a
-            chromosome is reached """
-            continue
-        if not gc:
-            continue
-
-        # is this read in the same orientation and position as the previous?
-        if r_index > 0 and read.pos == reads[r_index - 1].pos and \
-                read.is_reverse == reads[r_index - 1].is_reverse \
-                and read.pnext == reads[r_index - 1].pnext:
-            read_repetitions += 1
-            if read_repetitions >= global_vars['max_dup_gc'][gc]:
-                removed_duplicated_reads += 1
-                continue
-        else:
-            read_repetitions = 0
-
-        try:
-            fragmentStart, fragmentEnd = getFragmentFromRead(read, fragmentLength, extendPairedEnds=True)
-            vectorStart = max(fragmentStart - start, 0)
-            vectorEnd = min(fragmentEnd - start, end - start)
-        except TypeError:
-            # the get_fragment_from_read functions returns None in some cases.
-            # Those cases are to be skipped, hence the continue line.
-            continue
-
-        cvg_corr[vectorStart:vectorEnd] += float(1) / R_gc[gc]
-        i += 1
 
+    gc = getReadsGCcontent(tbit, reads, fragmentLength, chrNameBit, gcTrack)
+    tbit.close()
+    pos, aend, flag, tlen, pnext, _ = reads.T
+    isReverse = flag & 16 != 0
+
+    # Reads without (or with 0) GC content are skipped. A read in the same
+    # orientation and position as the previous one is a repetition and the
+    # ones beyond max_dup_gc are removed.
+    use = gc > 0
+    dup = np.r_[False, (pos[1:] == pos[:-1]) & (isReverse[1:] == isReverse[:-1]) & (pnext[1:] == pnext[:-1])][use]
+    idx = np.arange(len(dup))
+    nDup = np.cumsum(dup)
+    lastNew = np.maximum.accumulate(np.where(dup, -1, idx))
+    read_repetitions = nDup - np.where(lastNew >= 0, nDup[np.maximum(lastNew, 0)], 0)
+    removed = dup & (read_repetitions >= np.asarray(global_vars['max_dup_gc'])[gc[use]])
+    use[use] = ~removed
+
+    # The fragments as in getFragmentFromRead()
+    pairedFrag = (flag & 1 != 0) & (np.abs(tlen) > 0) & (np.abs(tlen) < 1000)
+    extend = fragmentLength > aend - pos
+    fragmentStart = np.where(pairedFrag, np.where(isReverse, pnext, pos),
+                             np.where(extend & isReverse, aend - fragmentLength, pos))
+    fragmentEnd = np.where(pairedFrag, np.where(isReverse, aend, pos + tlen),
+                           np.where(extend & ~isReverse, pos + fragmentLength, aend))
+
+    i = int(np.sum(use))
     try:
         if debug:
             endTime = time.time()
@@ -246,27 +345,37 @@ def writeCorrected_worker(chrNameBam, chrNameBit, start, end, step):
     if i == 0:
         return None
 
-    _file = open(utilities.getTempFileName(suffix='.bg'), 'w')
-    # save in bedgraph format
-    for bin in range(0, len(cvg_corr), step):
-        value = np.mean(cvg_corr[bin:min(bin + step, end)])
-        if value > 0:
-            writeStart = start + bin
-            writeEnd = min(start + bin + step, end)
-            _file.write("%s\t%d\t%d\t%.1f\n" % (chrNameBit, writeStart,
-                                                writeEnd, value))
-
-    tempFileName = _file.name
-    _file.close()
-    return tempFileName
-
-
-def numCopiesOfRead(value):
+    # The coverage as the cumulative sum of the weights added at the
+    # fragment starts and removed at their ends
+    length = end - start
+    vectorStart = np.clip(fragmentStart[use] - start, 0, length)
+    vectorEnd = np.clip(fragmentEnd[use] - start, 0, length)
+    vectorEnd = np.maximum(vectorStart, vectorEnd)
+    weights = 1.0 / R_gc[gc[use]]
+    cvg_corr = np.cumsum(np.bincount(vectorStart, weights=weights, minlength=length + 1) -
+                         np.bincount(vectorEnd, weights=weights, minlength=length + 1))[:length]
+    # Rounding errors mustn't leave values where there are no fragments
+    depth = np.cumsum(np.bincount(vectorStart, minlength=length + 1) -
+                      np.bincount(vectorEnd, minlength=length + 1))[:length]
+    cvg_corr[depth == 0] = 0
+
+    nFull = length // step
+    values = cvg_corr[:nFull * step].reshape(nFull, step).mean(axis=1)
+    if nFull * step < length:
+        values = np.append(values, np.mean(cvg_corr[nFull * step:]))
+    starts = start + np.arange(len(values)) * step
+    ends = np.minimum(starts + step, end)
+    keep = values > 0
+    return starts[keep], ends[keep], values[keep]
+
+
+def numCopiesOfRead(value, rand=None):
     """
     Based int he R_gc value, decides
     whether to keep, duplicate, triplicate or delete the read.
     It returns an integer, that tells the number of copies of the read
-    that should be keep.
+    that should be keep. rand is a random number in [0, 1), which is drawn
+    if not given.
     >>> np.random.seed(1)
     >>> numCopiesOfRead(0.8)
     1
@@ -274,15 +383,34 @@ def numCopiesOfRead(value):
     2
     >>> numCopiesOfRead(None)
     1
+    >>> numCopiesOfRead(2.5, rand=0.2)
+    3
     """
     copies = 1
     if value:
-        copies = int(value) + (1 if np.random.rand() < value % 1 else 0)
+        if rand is None:
+            rand = np.random.rand()
+        copies = int(value) + (1 if rand < value % 1 else 0)
     return copies
 
 
+def readNameHash(name):
+    """
+    A 32 bit hash of a read name, which is the same in every process
+
+    >>> readNameHash('read1') == readNameHash('read1')
+    True
+    >>> 0 <= readNameHash('read2') < 2 ** 32
+    True
+    """
+    return zlib.crc32(name.encode('utf-8')) & 0xffffffff
+
+
 def writeCorrectedSam_wrapper(args):
-    return writeCorrectedSam_worker(*args)
+    # The chunk is compressed and indexed here, in parallel, so that the
+    # chunks only need to be appended to each other afterwards
+    return bamWriter.finishChunk(writeCorrectedSam_worker(*args), index=True,
+                                 numberOfThreads=global_vars.get('compression_threads', 1))
 
 
 def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
@@ -308,7 +436,7 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
     >>> sys.stdout = ostdout
     >>> bam = pysam.Samfile(tempFile)
     >>> [dict(r.tags)['YN'] for r in bam.fetch(args[0], 200, 250)]
-    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1]
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1]
     >>> res = os.remove(tempFile)
     >>> res = os.remove(tempFile+".bai")
     >>> tempFile = \
@@ -325,62 +453,94 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
     """
     global R_gc
     fragmentLength = len(R_gc) - 1
+    # The mates of the reads starting this far before the chunk are
+    # looked for in the chunk
+    maxPairedFragmentLength = max(1000, 4 * fragmentLength)
 
     if verbose:
         print("Sam for %s %s %s " % (chrNameBit, start, end))
     i = 0
 
     tbit = py2bit.open(global_vars['2bit'])
+    gcTrack = None
+    if global_vars.get('gc_track'):
+        gcTrack = openGCTrack(global_vars['gc_track'])
 
     bam = openBam(global_vars['bam'])
     tempFileName = utilities.getTempFileName(suffix='.bam')
 
-    outfile = pysam.Samfile(tempFileName, 'wb', template=bam)
+    outfile = pysam.Samfile(tempFileName, 'wbu', template=bam)
     startTime = time.time()
+    # The decisions for reads whose mate is still to come, keyed by the
+    # hash of the read name and the position of the mate, and a heap of
+    # the mate positions to drop the entries of mates that never came
     matePairs = {}
+    matePositions = []
     read_repetitions = 0
     removed_duplicated_reads = 0
-    # cache data
+    nReads = 0
+    prev = None
+
+    # The reads starting shortly before the chunk (which were written by
+    # the previous chunk) are processed again, without writing them, so
+    # their mates in this chunk get the same decisions.
     # r.flag & 4 == 0 is to filter unmapped reads that
     # have a genomic position
-    reads = [r for r in bam.fetch(chrNameBam, start, end)
-             if r.pos > start and r.flag & 4 == 0]
-
-    r_index = -1
-    for read in reads:
-        r_index += 1
-        copies = None
-        gc = None
+    lookBack = max(0, start - maxPairedFragmentLength)
+    reads = itertools.chain(
+        ((r, False) for r in bam.fetch(chrNameBam, lookBack, start)
+         if lookBack <= r.pos < start and r.flag & 4 == 0),
+        ((r, True) for r in bam.fetch(chrNameBam, start, end)
+         if r.pos >= start and r.flag & 4 == 0))
+
+    for read, write in reads:
+        readName = read.qname
+        nameHash = readNameHash(readName)
+        while matePositions and matePositions[0][0] < read.pos:
+            matePos, oldHash = heapq.heappop(matePositions)
+            matePairs.pop((oldHash, matePos), None)
 
         # check if a mate has already been procesed
         # to apply the same correction
-        try:
-            copies = matePairs[read.qname]['copies']
-            gc = matePairs[read.qname]['gc']
-            del(matePairs[read.qname])
-        except:
-            # this exception happens when a mate is
+        mate = matePairs.pop((nameHash, read.pos), None)
+        if mate is not None:
+            copies, gc = mate
+        else:
+            # this happens when a mate is
             # not present. This could
             # happen because of removal of the mate
             # by some filtering
             gc = getReadGCcontent(tbit, read, fragmentLength,
-                                  chrNameBit)
+                                  chrNameBit, gcTrack)
             if gc:
-                copies = numCopiesOfRead(float(1) / R_gc[gc])
+                # The random number is derived from the read name, so
+                # that mates in different chunks get the same one
+                copies = numCopiesOfRead(float(1) / R_gc[gc],
+                                         rand=nameHash / 4294967296.0)
             else:
                 copies = 1
         # is this read in the same orientation and position as the previous?
-        if gc and r_index > 0 and read.pos == reads[r_index - 1].pos \
-                and read.is_reverse == reads[r_index - 1].is_reverse \
-                and read.pnext == reads[r_index - 1].pnext:
+        current = (read.pos, read.is_reverse, read.pnext)
+        if gc and current == prev:
             read_repetitions += 1
             if read_repetitions >= global_vars['max_dup_gc'][gc]:
                 copies = 0  # in other words do not take into account this read
-                removed_duplicated_reads += 1
+                if write:
+                    removed_duplicated_reads += 1
         else:
             read_repetitions = 0
+        prev = current
+
+        if read.is_paired and read.is_proper_pair \
+                and not read.mate_is_unmapped \
+                and not read.is_reverse and read.pnext >= read.pos:
+            matePairs[(nameHash, read.pnext)] = (copies, gc)
+            heapq.heappush(matePositions, (read.pnext, nameHash))
+
+        if not write:
+            continue
+        nReads += 1
 
-        readName = read.qname
         # Each tag is a tuple of (tag name, value, type)
         # Note that get_tags() returns ord(type) rather than type and this must
         # be fixed!
@@ -411,15 +571,6 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
         if replace_tags:
             read.set_tags(readTag)
 
-        if read.is_paired and read.is_proper_pair \
-                and not read.mate_is_unmapped \
-                and not read.is_reverse:
-            matePairs[readName] = {'copies': copies,
-                                   'gc': gc}
-
-        """
-        outfile.write(read)
-        """
         if tag_but_not_change_number:
             outfile.write(read)
             continue
@@ -447,10 +598,10 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
               "@ {}:{}-{}".format(multiprocessing.current_process().name,
                                   i, i / (endTime - startTime),
                                   chrNameBit, start, end))
-        percentage = float(removed_duplicated_reads) * 100 / len(reads) \
-            if len(reads) > 0 else 0
+        percentage = float(removed_duplicated_reads) * 100 / nReads \
+            if nReads > 0 else 0
         print("duplicated reads removed %d of %d (%.2f) " %
-              (removed_duplicated_reads, len(reads), percentage))
+              (removed_duplicated_reads, nReads, percentage))
 
     return tempFileName
 
@@ -557,6 +708,7 @@ def main(args=None):
     global_vars = {}
     global_vars['2bit'] = args.genome
     global_vars['bam'] = args.bamfile
+    global_vars['gc_track'] = args.GCtrack
 
     # compute the probability to find more than one read (a redundant read)
     # at a certain position based on the gc of the read fragment
@@ -569,6 +721,8 @@ def main(args=None):
 
     tbit = py2bit.open(global_vars['2bit'])
     bam, mapped, unmapped, stats = openBam(args.bamfile, returnStats=True, nThreads=args.numberOfProcessors)
+    if args.GCtrack:
+        openGCTrack(args.GCtrack).check(tbit, len(R_gc) - 1)
 
     global_vars['genome_size'] = sum(tbit.chroms().values())
     global_vars['total_reads'] = mapped
@@ -615,6 +769,8 @@ def main(args=None):
                             bedGraphStep))
             c += 1
 
+    # Processors not needed for the tasks compress the BAM chunks
+    global_vars['compression_threads'] = max(1, args.numberOfProcessors // max(1, len(mp_args)))
     pool = multiprocessing.Pool(args.numberOfProcessors)
 
     if args.correctedFile.name.endswith('bam'):
@@ -628,30 +784,11 @@ def main(args=None):
         else:
             res = list(map(writeCorrectedSam_wrapper, mp_args))
 
-        if len(res) == 1:
-            command = "cp {} {}".format(res[0], args.correctedFile.name)
-            run_shell_command(command)
-        else:
-            print("concatenating (sorted) intermediate BAMs")
-            header = pysam.Samfile(res[0])
-            of = pysam.Samfile(args.correctedFile.name, "wb", template=header)
-            header.close()
-            for f in res:
-                f = pysam.Samfile(f)
-                for e in f.fetch(until_eof=True):
-                    of.write(e)
-                f.close()
-            of.close()
-
-        print("indexing BAM")
-        pysam.index(args.correctedFile.name)
-
-        for tempFileName in res:
-            os.remove(tempFileName)
-
-    if args.correctedFile.name.endswith('bg') or \
-            args.correctedFile.name.endswith('bw'):
+        print("concatenating (sorted) intermediate BAMs")
+        bamWriter.writeBAM(args.correctedFile.name, bamWriter.bamHeader(bam),
+                           res, index=True)
 
+    if args.correctedFile.name.endswith('bg'):
         if len(mp_args) > 1 and args.numberOfProcessors > 1:
 
             res = pool.map_async(writeCorrected_wrapper, mp_args).get(9999999)
@@ -660,16 +797,34 @@ def main(args=None):
 
         oname = args.correctedFile.name
         args.correctedFile.close()
-        if oname.endswith('bg'):
-            f = open(oname, 'wb')
-            for tempFileName in res:
-                if tempFileName:
-                    shutil.copyfileobj(open(tempFileName, 'rb'), f)
-                    os.remove(tempFileName)
-            f.close()
+        f = open(oname, 'wb')
+        for tempFileName in res:
+            if tempFileName:
+                shutil.copyfileobj(open(tempFileName, 'rb'), f)
+                os.remove(tempFileName)
+        f.close()
+
+    if args.correctedFile.name.endswith('bw'):
+        # The workers return the runs of values, which are added to the
+        # bigWig file in order as they arrive
+        if len(mp_args) > 1 and args.numberOfProcessors > 1:
+            res = pool.imap(writeCorrectedRuns_wrapper, mp_args)
         else:
-            chromSizes = [(k, v) for k, v in tbit.chroms().items()]
-            writeBedGraph.bedGraphToBigWig(chromSizes, res, oname)
+            res = map(writeCorrectedRuns_wrapper, mp_args)
+
+        oname = args.correctedFile.name
+        args.correctedFile.close()
+        bw = pyBigWig.open(oname, "w")
+        bw.addHeader([(k, v) for k, v in tbit.chroms().items()], maxZooms=10)
+        for runs in res:
+            if runs is not None:
+                chrom, starts, ends, values = runs
+                bw.addEntries([chrom] * len(starts), starts.tolist(),
+                              ends=ends.tolist(), values=values.tolist())
+        bw.close()
+
+    pool.close()
+    pool.join()
 
 
 class Tester():
@@ -9,7 +9,7 @@ import numpy as np
 import deeptools.utilities
 from deeptools import bamHandler
 from deeptools import mapReduce
-from deeptoolsintervals import GTF
+from deeptoolsintervals import loadIndex
 import pyBigWig
 
 debug = 0
@@ -449,7 +449,7 @@ class CountReadsPerBin(object):
 
         blackList = None
         if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+            blackList = loadIndex(self.blackListFileName)
 
         # A list of lists of tuples
         transcriptsToConsider = []
@@ -459,11 +459,10 @@ class CountReadsPerBin(object):
             if self.stepSize == self.binLength:
                 transcriptsToConsider.append([(start, end, self.binLength)])
             else:
-                for i in range(start, end, self.stepSize):
-                    if i + self.binLength > end:
-                        break
-                    if blackList is not None and blackList.findOverlaps(chrom, i, i + self.binLength):
-                        continue
+                binStarts = np.arange(start, end - self.binLength + 1, self.stepSize)
+                if blackList is not None:
+                    binStarts = binStarts[blackList.countOverlaps(chrom, binStarts, binStarts + self.binLength) == 0]
+                for i in binStarts.tolist():
                     transcriptsToConsider.append([(i, i + self.binLength)])
 
         if self.save_data:
@@ -564,7 +563,9 @@ class CountReadsPerBin(object):
 
         blackList = None
         if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+            blackList = loadIndex(self.blackListFileName)
+            # Blacklisted regions have a coverage of 0
+            blacklisted = blackList.countOverlaps(chrom, [reg[0] for reg in regions], [reg[1] for reg in regions]) > 0
 
         vector_start = 0
         for idx, reg in enumerate(regions):
@@ -575,8 +576,7 @@ class CountReadsPerBin(object):
                 nRegBins = 1
                 tileSize = int(reg[1] - reg[0])
 
-            # Blacklisted regions have a coverage of 0
-            if blackList and blackList.findOverlaps(chrom, reg[0], reg[1]):
+            if blackList and blacklisted[idx]:
                 continue
             regStart = int(max(0, reg[0] - extension))
             regEnd = reg[1] + int(extension)
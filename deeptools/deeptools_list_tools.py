@@ -43,6 +43,7 @@ Data Analysis." Nucleic Acids Research, April. doi:10.1093/nar/gkw257.
     plotFingerprint         plots the distribution of enriched regions
     bamPEFragmentSize       returns the read length and paired-end distance from a bam file
     computeGCBias           computes and plots the GC bias of a sample
+    computeGCTrack          precomputes the GC content of a genome for computeGCBias and correctGCBias
     plotCoverage            plots a histogram of read coverage
     estimateReadFiltering   estimates the number of reads that will be filtered from a BAM file or files given certain criteria
 
@@ -51,6 +52,7 @@ Data Analysis." Nucleic Acids Research, April. doi:10.1093/nar/gkw257.
     plotHeatmap             plots one or multiple heatmaps of user selected regions over different genomic scores
     plotProfile             plots the average profile of user selected regions over different genomic scores
     plotEnrichment          plots the read/fragment coverage of one or more sets of regions
+    plotBatch               runs plotHeatmap and/or plotProfile several times on one matrix
 
 [Miscellaneous]
     computeMatrixOperations Modifies the output of computeMatrix in a variety of ways.
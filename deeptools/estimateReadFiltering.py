@@ -2,7 +2,7 @@
 import argparse
 import sys
 
-from deeptools import parserCommon, bamHandler, utilities
+from deeptools import parserCommon, bamHandler, bamStats, utilities
 from deeptools.mapReduce import mapReduce
 from deeptools.utilities import smartLabels
 from deeptools._version import __version__
@@ -29,7 +29,7 @@ The following metrics are estimated according to the --binSize and --distanceBet
  * Singletons (paired-end reads with only one mate aligning)
  * Wrong strand (due to --filterRNAstrand)
 
-The sum of these may be more than the total number of reads. Note that alignments are sampled from bins of size --binSize spaced --distanceBetweenBins apart.
+The sum of these may be more than the total number of reads. Note that alignments are sampled from bins of size --binSize spaced --distanceBetweenBins apart, unless --exact is given.
 """,
         usage='Example usage: estimateReadFiltering.py -b sample1.bam sample2.bam > log.txt')
 
@@ -78,6 +78,13 @@ The sum of these may be more than the total number of reads. Note that alignment
                          default=10000,
                          type=int)
 
+    general.add_argument('--exact',
+                         action='store_true',
+                         help='Count all alignments rather than sampling them, so that the metrics are exact '
+                         'rather than estimated. This is slower, but the counts are cached (in $DEEPTOOLS_CACHE_DIR, '
+                         'by default ~/.cache/deeptools) and reused by later runs with the same filtering settings '
+                         'and by bamCoverage and bamCompare with --exactScaling.')
+
     general.add_argument('--numberOfProcessors', '-p',
                          help='Number of processors to use. Type "max/2" to '
                          'use half the maximum number of processors or "max" '
@@ -289,13 +296,21 @@ def main(args=None):
         x.close()
 
     # Get the remaining metrics
-    res = mapReduce([args],
-                    getFiltered_worker,
-                    chrom_sizes,
-                    genomeChunkLength=args.binSize + args.distanceBetweenBins,
-                    blackListFileName=args.blackListFileName,
-                    numberOfProcessors=args.numberOfProcessors,
-                    verbose=args.verbose)
+    if args.exact:
+        res = []
+        for fname in args.bamfiles:
+            counts = bamStats.sumFilterCounts(bamStats.exactFilterCounts(fname, args, args.numberOfProcessors, args.verbose))
+            res.append([counts[x] for x in ['total', 'filtered', 'minMappingQuality', 'samFlagInclude', 'samFlagExclude',
+                                            'internalDupes', 'externalDupes', 'singletons', 'filterRNAstrand']])
+        res = [res]
+    else:
+        res = mapReduce([args],
+                        getFiltered_worker,
+                        chrom_sizes,
+                        genomeChunkLength=args.binSize + args.distanceBetweenBins,
+                        blackListFileName=args.blackListFileName,
+                        numberOfProcessors=args.numberOfProcessors,
+                        verbose=args.verbose)
 
     totals = [0] * len(args.bamfiles)
     nFiltered = [0] * len(args.bamfiles)
@@ -326,46 +341,17 @@ def main(args=None):
         else:
             of.write(args.bamfiles[idx])
         of.write("\t{}\t{}\t{}".format(total[idx], mapped[idx], blacklisted[idx]))
-        # nFiltered
-        metric = 0.0
-        if totals[idx] > 0:
-            metric = blacklisted[idx] + float(nFiltered[idx]) / float(totals[idx]) * nFiltered[idx]
-        of.write("\t{}".format(round(metric, 1)))
-        # MAPQ
-        metric = 0.0
-        if totals[idx] > 0:
-            metric = float(MAPQs[idx]) / float(totals[idx]) * mapped[idx]
-        of.write("\t{}".format(round(metric, 1)))
-        # samFlagInclude
-        metric = 0.0
-        if totals[idx] > 0:
-            metric = float(flagIncludes[idx]) / float(totals[idx]) * mapped[idx]
-        of.write("\t{}".format(round(metric, 1)))
-        # samFlagExclude
-        metric = 0.0
-        if totals[idx] > 0:
-            metric = float(flagExcludes[idx]) / float(totals[idx]) * mapped[idx]
-        of.write("\t{}".format(round(metric, 1)))
-        # Internally determined duplicates
-        metric = 0.0
-        if totals[idx] > 0:
-            metric = float(internalDupes[idx]) / float(totals[idx]) * mapped[idx]
-        of.write("\t{}".format(round(metric, 1)))
-        # Externally marked duplicates
-        metric = 0.0
-        if totals[idx] > 0:
-            metric = float(externalDupes[idx]) / float(totals[idx]) * mapped[idx]
-        of.write("\t{}".format(round(metric, 1)))
-        # Singletons
-        metric = 0.0
-        if totals[idx] > 0:
-            metric = float(singletons[idx]) / float(totals[idx]) * mapped[idx]
-        of.write("\t{}".format(round(metric, 1)))
-        # filterRNAstrand
-        metric = 0.0
-        if totals[idx] > 0:
-            metric = float(rnaStrand[idx]) / float(totals[idx]) * mapped[idx]
-        of.write("\t{}".format(round(metric, 1)))
+        counts = [MAPQs[idx], flagIncludes[idx], flagExcludes[idx], internalDupes[idx], externalDupes[idx], singletons[idx], rnaStrand[idx]]
+        if args.exact:
+            metrics = [blacklisted[idx] + nFiltered[idx]] + counts
+        elif totals[idx] > 0:
+            # Extrapolate from the sampled alignments
+            metrics = [blacklisted[idx] + float(nFiltered[idx]) / float(totals[idx]) * nFiltered[idx]]
+            metrics.extend([float(x) / float(totals[idx]) * mapped[idx] for x in counts])
+        else:
+            metrics = [0.0] * 8
+        for metric in metrics:
+            of.write("\t{}".format(round(float(metric), 1)))
         of.write("\n")
 
     if args.outFile is not None:
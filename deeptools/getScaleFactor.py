@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
 import numpy as np
 import deeptools.mapReduce as mapReduce
 from deeptools import bamHandler
+from deeptools import bamStats
 from deeptools import utilities
 import sys
 
@@ -116,6 +118,9 @@ def fraction_kept(args, stats):
     The sampling works by dividing the genome into bins and only looking at the
     first 50000 bases. If this doesn't yield sufficient alignments then the bin
     size is halved.
+
+    With --exactScaling all alignments are counted instead, see
+    bamStats.exactFilterCounts().
     """
     # Do we even need to proceed?
     if (not args.minMappingQuality or args.minMappingQuality == 0) and \
@@ -129,6 +134,19 @@ def fraction_kept(args, stats):
         else:
             return 1.0
 
+    if args.exactScaling:
+        counts = bamStats.exactFilterCounts(args.bam, args, args.numberOfProcessors, args.verbose)
+        counts = bamStats.sumFilterCounts(counts, args.ignoreForNormalization)
+        if counts['total'] == 0:
+            return 1.0
+        return float(counts['kept']) / float(counts['total'])
+
+    # The sampled fraction is cached as well
+    key = 'fractionKept:' + bamStats.filterKey(args) + json.dumps(sorted(args.ignoreForNormalization or []))
+    cached = bamStats.getCached(args.bam, key)
+    if cached is not None:
+        return cached
+
     filtered = 0
     total = 0
     distanceBetweenBins = 2000000
@@ -141,8 +159,6 @@ def fraction_kept(args, stats):
             num_needed_to_sample = 0.1 * bam_mapped
         else:
             num_needed_to_sample = 1000000
-    if args.exactScaling:
-        num_needed_to_sample = bam_mapped
     if num_needed_to_sample == bam_mapped:
         distanceBetweenBins = 55000
     if args.ignoreForNormalization:
@@ -172,7 +188,9 @@ def fraction_kept(args, stats):
         # This should never happen
         total = 1
 
-    return 1.0 - float(filtered) / float(total)
+    fraction = 1.0 - float(filtered) / float(total)
+    bamStats.setCached(args.bam, key, fraction)
+    return fraction
 
 
 def get_num_kept_reads(args, stats):
@@ -1,18 +1,27 @@
 import sys
-import gzip
+import os
 from collections import OrderedDict
 import numpy as np
 from copy import deepcopy
 
 import pyBigWig
 from deeptools import getScorePerBigWigBin
+from deeptools import bgzf
 from deeptools import mapReduce
+from deeptools import matrixContainer
+from deeptools import regionCache
 from deeptools.utilities import toString, toBytes, smartLabels
 from deeptools.heatmapper_utilities import getProfileTicks
 
 
 old_settings = np.seterr(all='ignore')
 
+# The approximate number of values formatted per task when saving a matrix
+WRITE_BLOCK_VALUES = 1000000
+
+# The number of BGZF blocks (of up to 64kb of text each) parsed per task when reading a matrix
+MATRIX_READ_BLOCKS = 32
+
 
 def chopRegions(exonsInput, left=0, right=0):
     """
@@ -174,19 +183,260 @@ def compute_sub_matrix_wrapper(args):
     return heatmapper.compute_sub_matrix_worker(*args)
 
 
+def formatMatrixRows(args):
+    """
+    Formats rows of the matrix with their regions, as written by save_matrix()
+
+    >>> formatMatrixRows(([['chr1', [(1, 5), (8, 9)], 'foo', 1, '+', '.']], np.array([[1, np.nan]])))
+    b'chr1\\t1,8\\t5,9\\tfoo\\t.\\t+\\t1.000000\\tnan\\n'
+    """
+    regions, values = args
+    fmt = "\t".join(["%f"] * values.shape[1])
+    lines = []
+    for region, row in zip(regions, values.tolist()):
+        starts = ",".join(["{0}".format(x[0]) for x in region[1]])
+        ends = ",".join(["{0}".format(x[1]) for x in region[1]])
+        # BEDish format (we don't currently store the score)
+        lines.append('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n'.format(
+                     region[0],
+                     starts,
+                     ends,
+                     region[2],
+                     region[5],
+                     region[4],
+                     fmt % tuple(row)))
+    return toBytes("".join(lines))
+
+
+def formatValueRows(values):
+    """
+    Formats rows of the matrix values, as written by save_matrix_values()
+
+    >>> formatValueRows(np.array([[1.23456, np.nan]]))
+    b'1.235\\tnan\\n'
+    """
+    fmt = "\t".join(["%.4g"] * values.shape[1]) + "\n"
+    return toBytes("".join([fmt % tuple(row) for row in values.tolist()]))
+
+
+def setRegionGroups(regions, group_boundaries):
+    """
+    Sets the group field of each region, which holds the end boundary of its group
+    """
+    for idx in range(len(group_boundaries) - 1):
+        for region in regions[group_boundaries[idx]:group_boundaries[idx + 1]]:
+            region[3] = group_boundaries[idx + 1]
+
+
+def matrixHeader(parameters, index=None, nBlocks=0):
+    """
+    The header line of a text matrix file, which holds its parameters as
+    JSON. The index of the file (see readMatrixIndex()) is the last field
+    and is padded with spaces to a length that only depends on the number of
+    blocks (nBlocks), so that save_matrix() can write the header before the
+    index is known and fill it in afterwards.
+
+    >>> import json
+    >>> header = matrixHeader({'a': 1}, nBlocks=1)
+    >>> json.loads(header[1:].decode())
+    {'a': 1, 'index': None}
+    >>> len(matrixHeader({'a': 1}, {'rows': [0, 10], 'offsets': [100, 2000], 'size': 2028}, 1)) == len(header)
+    True
+    """
+    import json
+    params = json.dumps(parameters, separators=(',', ':'))
+    index = json.dumps(index, separators=(',', ':'))
+    # Room for nBlocks + 1 rows and offsets of up to 20 digits each, and the file size
+    padding = 64 + 2 * 21 * (nBlocks + 1) - len(index)
+    if padding < 0:
+        raise ValueError("The index of the matrix file doesn't fit into its header")
+    return toBytes('@{}{}"index":{}{}}}\n'.format(params[:-1], ',' if len(parameters) else '', index, ' ' * padding))
+
+
+def readMatrixIndex(matrix_file, parameters):
+    """
+    Returns the index of a BGZF text matrix file, as stored in its
+    parameters by save_matrix(), or None if there's none or it isn't valid
+    for this file (e.g., because the parameters were copied from another
+    file). The index holds the first row of each block of rows (and the
+    total number of rows), the offset of each block in the file (and of
+    the end of file marker) and the size of the file.
+    """
+    index = parameters.get('index')
+    try:
+        if len(index['rows']) != len(index['offsets']) or index['size'] != os.path.getsize(matrix_file):
+            return None
+        # Every offset must be the start of a BGZF block
+        with open(matrix_file, 'rb') as fh:
+            for offset in index['offsets']:
+                fh.seek(offset)
+                if fh.read(4) != b'\x1f\x8b\x08\x04':
+                    return None
+    except (IOError, OSError, TypeError, KeyError):
+        return None
+    return index
+
+
+def readMatrixParameters(matrix_file, withIndex=False):
+    """
+    Returns the parameters of a matrix file, reading only its header. The
+    index of text matrices (see readMatrixIndex()) is removed from them,
+    unless withIndex is True.
+    """
+    import json
+    if matrixContainer.isBinaryMatrix(matrix_file):
+        reader = matrixContainer.MatrixReader(matrix_file)
+        reader.close()
+        return reader.parameters
+    import gzip
+    with open(matrix_file, 'rb') as fh:
+        compressed = fh.read(2) == bgzf.GZIP_MAGIC
+    with (gzip.open(matrix_file) if compressed else open(matrix_file, 'rb')) as fh:
+        line = toString(fh.readline())
+    parameters = json.loads(line[1:].strip())
+    if not withIndex:
+        parameters.pop('index', None)
+    return parameters
+
+
+def parseMatrixLines(lines, nCols, dtype=np.float64):
+    """
+    Parses complete lines of a text matrix file, skipping the header and
+    empty lines. Returns the regions (with their group yet to be set) and
+    the values of the rows, which are parsed together by numpy's C parser.
+
+    >>> regions, values = parseMatrixLines([b'@{}', b'chr1\\t1,5\\t3,8\\tx\\t0\\t+\\t1\\t2.5', b'chr2\\t1\\t2\\ty\\t0\\t-\\tnan\\t-1e3'], 2)
+    >>> regions[0]
+    ['chr1', [(1, 3), (5, 8)], 'x', None, '+', '0']
+    >>> values
+    array([[    1. ,     2.5],
+           [    nan, -1000. ]])
+    """
+    regions = []
+    values = []
+    for line in lines:
+        if line.startswith(b"@") or not line.strip():
+            continue
+
+        # split the line into bed interval and matrix values
+        region = line.split(b'\t', 6)
+        chrom, start, end, name, score, strand = toString(b'\t'.join(region[0:6])).split('\t')
+        values.append(region[6] if len(region) > 6 else b'')
+        starts = start.split(",")
+        ends = end.split(",")
+        regs = [(int(x), int(y)) for x, y in zip(starts, ends)]
+        regions.append([chrom, regs, name, None, strand, score])
+    if not regions:
+        return regions, np.zeros((0, nCols), dtype=dtype)
+    matrix = np.fromstring(b'\t'.join(values), dtype=dtype, sep='\t')
+    if matrix.size != len(values) * nCols:
+        raise ValueError("The matrix file is corrupt, its rows don't all have {} numeric values.".format(nCols))
+    return regions, matrix.reshape((len(values), nCols))
+
+
+def parseMatrixText(text, nCols, dtype=np.float64):
+    """
+    Parses a piece of a text matrix file. Its first and last lines may be
+    incomplete, so they're returned unparsed, along with the regions and
+    values of the lines in between. If there's no complete line, then the
+    first line is None.
+
+    >>> parseMatrixText(b'\\t5\\nchr1\\t1\\t3\\tx\\t0\\t+\\t1\\nchr', 1)
+    (b'\\t5', [['chr1', [(1, 3)], 'x', None, '+', '0']], array([[1.]]), b'chr')
+    >>> parseMatrixText(b'chr', 1)[0] is None
+    True
+    """
+    lines = text.split(b'\n')
+    if len(lines) == 1:
+        return None, [], np.zeros((0, nCols), dtype=dtype), text
+    regions, values = parseMatrixLines(lines[1:-1], nCols, dtype)
+    return lines[0], regions, values, lines[-1]
+
+
+def parseMatrixBlocks(args):
+    """
+    Decompresses a range of BGZF blocks of a text matrix and parses them
+    with parseMatrixText()
+    """
+    matrix_file, start, end, nCols, dtype = args
+    return parseMatrixText(bgzf.decompress(matrix_file, start=start, end=end), nCols, dtype)
+
+
+def iterMatrixRows(matrix_file, nCols, dtype=np.float64, start=0, end=None, pool=None, numberOfProcessors=1):
+    """
+    Yields the regions and values of the rows of a text matrix file in
+    order, in batches of about MATRIX_READ_BLOCKS BGZF blocks, so only a few
+    batches of the decompressed text are held in memory at any time. If
+    start and/or end are given, then only that range of the (BGZF) file is
+    read, which must then begin and end at the start of a row. The batches
+    are decompressed and parsed in a pool of processes if one is given,
+    which are only sent the offsets of their blocks. Files that aren't BGZF
+    are decompressed and parsed sequentially.
+    """
+    offsets = bgzf.fileBlockOffsets(matrix_file, start, end)
+    if offsets is None:
+        if start != 0 or end is not None:
+            raise ValueError("Only BGZF matrix files can be read in part.")
+        pieces = (parseMatrixText(x, nCols, dtype) for x in bgzf.iterDecompress(matrix_file))
+    else:
+        tasks = [(matrix_file, offsets[i], offsets[min(i + MATRIX_READ_BLOCKS, len(offsets) - 1)], nCols, dtype)
+                 for i in range(0, len(offsets) - 1, MATRIX_READ_BLOCKS)]
+        if pool is None:
+            pieces = (parseMatrixBlocks(x) for x in tasks)
+        else:
+            pieces = _imapBounded(pool, parseMatrixBlocks, tasks, 2 * numberOfProcessors)
+
+    # Lines spanning batches are put together and parsed here
+    partial = b''
+    for first, regions, values, last in pieces:
+        if first is None:
+            partial += last
+            continue
+        line = partial + first
+        if line.strip() and not line.startswith(b'@'):
+            yield parseMatrixLines([line], nCols, dtype)
+        yield regions, values
+        partial = last
+    if partial.strip() and not partial.startswith(b'@'):
+        yield parseMatrixLines([partial], nCols, dtype)
+
+
+def _imapBounded(pool, func, tasks, nPending):
+    """
+    Like pool.imap(func, tasks), but with at most nPending tasks submitted
+    and not yet consumed, so finished results don't pile up in memory
+    """
+    from collections import deque
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= nPending:
+            yield pending.popleft().get(9999999)
+    while pending:
+        yield pending.popleft().get(9999999)
+
+
 class heatmapper(object):
     """
     Class to handle the reading and
     plotting of matrices.
     """
 
-    def __init__(self):
+    def __init__(self, float32=False):
         self.parameters = None
         self.lengthDict = None
         self.matrix = None
         self.regions = None
         self.blackList = None
         self.quiet = True
+        # The format of the matrix file that was read, which is also used when saving
+        self.matrix_format = 'text'
+        # If True, matrices are float32 with NaN for missing values rather than float64 masked arrays
+        self.float32 = float32
+        # An optional directory in which base-resolution bigWig values are cached (see deeptools.regionCache)
+        self.cacheDir = None
+        # The maximum size of that directory, in megabytes
+        self.cacheSize = regionCache.MAX_CACHE_SIZE
         # These are parameters that were single values in versions <3 but are now internally lists. See issue #614
         self.special_params = set(['unscaled 5 prime', 'unscaled 3 prime', 'body', 'downstream', 'upstream', 'ref point', 'bin size'])
 
@@ -247,6 +497,8 @@ class heatmapper(object):
             transcript_id_designator = allArgs.get("transcript_id_designator", transcript_id_designator)
             keepExons = allArgs.get("keepExons", keepExons)
             self.quiet = allArgs.get("quiet", self.quiet)
+            self.cacheDir = allArgs.get("regionCache", self.cacheDir)
+            self.cacheSize = allArgs.get("regionCacheSize", self.cacheSize)
 
         chromSizes, _ = getScorePerBigWigBin.getChromSizes(score_file_list)
         res, labels = mapReduce.mapReduce([score_file_list, parameters],
@@ -262,6 +514,8 @@ class heatmapper(object):
                                           transcript_id_designator=transcript_id_designator,
                                           keepExons=keepExons,
                                           verbose=verbose)
+        if self.cacheDir:
+            regionCache.trimCache(self.cacheDir, self.cacheSize * 1024 * 1024)
         # each worker in the pool returns a tuple containing
         # the submatrix data, the regions that correspond to the
         # submatrix, and the number of regions lacking scores
@@ -282,7 +536,8 @@ class heatmapper(object):
         matrix = matrix[sortIdx]
 
         # mask invalid (nan) values
-        matrix = np.ma.masked_invalid(matrix)
+        if not self.float32:
+            matrix = np.ma.masked_invalid(matrix)
 
         assert matrix.shape[0] == len(regions), \
             "matrix length does not match regions length"
@@ -366,6 +621,14 @@ class heatmapper(object):
         for sc_file in score_file_list:
             score_file_handles.append(pyBigWig.open(sc_file))
 
+        # The value caches of this chunk, if requested
+        caches = [None] * len(score_file_list)
+        if self.cacheDir:
+            for idx, sc_file in enumerate(score_file_list):
+                key = regionCache.bigWigKey(sc_file)
+                if key is not None:
+                    caches[idx] = regionCache.RegionCache(self.cacheDir, key, chrom, start, end)
+
         # determine the number of matrix columns based on the lengths
         # given by the user, times the number of score files
         matrix_cols = len(score_file_list) * \
@@ -375,7 +638,7 @@ class heatmapper(object):
              parameters['bin size'])
 
         # create an empty matrix to store the values
-        sub_matrix = np.zeros((len(regions), matrix_cols))
+        sub_matrix = np.zeros((len(regions), matrix_cols), dtype=np.float32 if self.float32 else np.float64)
         sub_matrix[:] = np.NAN
 
         j = 0
@@ -528,14 +791,15 @@ class heatmapper(object):
                 coverage = []
                 # compute the values for each of the files being processed.
                 # "cov" is a numpy array of bins
-                for sc_handler in score_file_handles:
+                for sc_handler, cache in zip(score_file_handles, caches):
                     # We're only supporting bigWig files at this point
                     cov = heatmapper.coverage_from_big_wig(
                         sc_handler, feature_chrom, zones,
                         parameters['bin size'],
                         parameters['bin avg type'],
                         parameters['missing data as zero'],
-                        not self.quiet)
+                        not self.quiet,
+                        cache=cache)
 
                     if padLeftNaN > 0:
                         cov = np.concatenate([[np.nan] * padLeftNaN, cov])
@@ -587,6 +851,10 @@ class heatmapper(object):
             sub_regions.append(transcript)
             j += 1
 
+        for cache in caches:
+            if cache is not None:
+                cache.save()
+
         # remove empty rows
         sub_matrix = sub_matrix[0:j, :]
         if len(sub_regions) != len(sub_matrix[:, 0]):
@@ -652,7 +920,7 @@ class heatmapper(object):
         return chrom
 
     @staticmethod
-    def coverage_from_big_wig(bigwig, chrom, zones, binSize, avgType, nansAsZeros=False, verbose=True):
+    def coverage_from_big_wig(bigwig, chrom, zones, binSize, avgType, nansAsZeros=False, verbose=True, cache=None):
 
         """
         uses pyBigWig
@@ -679,6 +947,10 @@ class heatmapper(object):
         This is useful if several matrices wants to be merged
         or if the sorted BED output of one computeMatrix operation
         needs to be used for other cases
+
+        If a regionCache.RegionCache is given as cache, then the values
+        spanning all of the zones are fetched from it in one go, rather than
+        querying the bigWig file for each zone.
         """
         nVals = 0
         for zone, _ in zones:
@@ -702,6 +974,11 @@ class heatmapper(object):
                 return heatmapper.coverage_from_array(values_array, zones, binSize, avgType)
 
         maxLen = bigwig.chroms(chrom)
+        if cache is not None:
+            spanStart = max(0, min([region[0] for zone, _ in zones for region in zone] + [maxLen]))
+            spanEnd = min(maxLen, max([region[1] for zone, _ in zones for region in zone] + [0]))
+            if spanStart < spanEnd:
+                spanValues = cache.values(bigwig, chrom, spanStart, spanEnd)
         startIdx = 0
         endIdx = 0
         for zone, _ in zones:
@@ -714,7 +991,9 @@ class heatmapper(object):
                 start = max(0, region[0])
                 end = min(maxLen, region[1])
                 endIdx += end - start
-                if start < end:
+                if start < end and cache is not None:
+                    values_array[startIdx:endIdx] = spanValues[start - spanStart:end - spanStart]
+                elif start < end:
                     # This won't be the case if we extend off the front of a chromosome, such as (-100, 0)
                     values_array[startIdx:endIdx] = bigwig.values(chrom, start, end)
                 if end < region[1]:
@@ -749,46 +1028,151 @@ class heatmapper(object):
         self.lengthDict = OrderedDict()
         self.matrixAvgsDict = OrderedDict()
 
-    def read_matrix_file(self, matrix_file):
-        # reads a bed file containing the position
-        # of genomic intervals
-        # In case a hash sign '#' is found in the
-        # file, this is considered as a delimiter
-        # to split the heatmap into groups
-
-        import json
+    def read_matrix_file(self, matrix_file, numberOfProcessors=1, groups=None, samples=None):
+        """
+        Reads a matrix file, in either the text or binary format. If lists of
+        group and/or sample indices are given, then only those are kept, in
+        the given order. Only the blocks holding the requested groups are
+        decompressed if the file is binary or an indexed text file (see
+        save_matrix()).
+        """
+        if matrixContainer.isBinaryMatrix(matrix_file):
+            return self.read_binary_matrix_file(matrix_file, groups=groups, samples=samples)
+        self.matrix_format = 'text'
+
+        self.parameters = readMatrixParameters(matrix_file, withIndex=True)
+        nRows = self.parameters['group_boundaries'][-1]
+        nCols = self.parameters['sample_boundaries'][-1]
+        dtype = np.float32 if self.float32 else np.float64
+
+        index = None
+        if groups is not None:
+            index = readMatrixIndex(matrix_file, self.parameters)
+        self.parameters.pop('index', None)
+        if index is None:
+            # (start, end) of the compressed file, the rows to skip and the rows to read
+            ranges = [(0, None, 0, nRows)]
+        else:
+            # Only the blocks holding the rows of the requested groups
+            import bisect
+            ranges = []
+            bounds = self.parameters['group_boundaries']
+            rows = index['rows']
+            for group in groups:
+                start, end = bounds[group], bounds[group + 1]
+                first = bisect.bisect_right(rows, start) - 1
+                last = bisect.bisect_left(rows, end)
+                ranges.append((index['offsets'][first], index['offsets'][last], start - rows[first], end - start))
+
+        # The rows are parsed in batches straight into the matrix
+        pool = None
+        if numberOfProcessors > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(numberOfProcessors)
+        matrix = np.empty((sum([x[3] for x in ranges]), nCols), dtype=dtype)
         regions = []
-        matrix_rows = []
-        current_group_index = 0
-        max_group_bound = None
-
-        fh = gzip.open(matrix_file)
-        for line in fh:
-            line = toString(line).strip()
-            # read the header file containing the parameters
-            # used
-            if line.startswith("@"):
-                # the parameters used are saved using
-                # json
-                self.parameters = json.loads(line[1:].strip())
-                max_group_bound = self.parameters['group_boundaries'][1]
-                continue
+        for start, end, skip, nRead in ranges:
+            for _regions, values in iterMatrixRows(matrix_file, nCols, dtype, start=start, end=end,
+                                                   pool=pool, numberOfProcessors=numberOfProcessors):
+                lo = min(skip, len(_regions))
+                skip -= lo
+                hi = min(len(_regions), lo + nRead)
+                matrix[len(regions):len(regions) + hi - lo] = values[lo:hi]
+                regions.extend(_regions[lo:hi])
+                nRead -= hi - lo
+                if index is None and hi < len(_regions):
+                    nRead = -1
+                    break
+            if nRead != 0:
+                if pool is not None:
+                    pool.terminate()
+                raise ValueError("The matrix file {} is corrupt, it doesn't have the {} rows of its header.".format(matrix_file, nRows))
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if groups is not None or samples is not None:
+            rows, cols = self.subset_parameters(groups, samples)
+            if index is None and groups is not None:
+                regions = [regions[i] for i in rows]
+                matrix = matrix[rows, :]
+            if samples is not None:
+                matrix = matrix[:, cols]
+        setRegionGroups(regions, self.parameters['group_boundaries'])
+        if not self.float32:
+            # NaNs are masked later, by get_matrix()
+            matrix = np.ma.array(matrix, copy=False)
+        self.set_matrix_from_parameters(regions, matrix)
+
+    def read_binary_matrix_file(self, matrix_file, groups=None, samples=None):
+        """
+        Like read_matrix_file(), but for files written with
+        save_matrix(file_format='binary'). Uncompressed files are memory-mapped
+        rather than read into memory, unless only some groups or samples are
+        requested.
+        """
+        self.matrix_format = 'binary'
+        reader = matrixContainer.MatrixReader(matrix_file)
+        self.parameters = reader.parameters
+        regions = reader.regions()
+        if groups is None and samples is None:
+            matrix = reader.memmap()
+            if matrix is None:
+                matrix = reader.read()
+        else:
+            bounds = self.parameters['group_boundaries']
+            if groups is None:
+                groups = range(len(bounds) - 1)
+            blocks = [reader.read(rows=(bounds[group], bounds[group + 1]), samples=samples) for group in groups]
+            rows, cols = self.subset_parameters(groups, samples)
+            if len(blocks):
+                matrix = np.vstack(blocks)
+            else:
+                matrix = np.zeros((0, len(cols)), dtype=reader.dtype)
+            regions = [regions[i] for i in rows]
+            setRegionGroups(regions, self.parameters['group_boundaries'])
+        reader.close()
+        self.set_matrix_from_parameters(regions, matrix)
 
-            # split the line into bed interval and matrix values
-            region = line.split('\t')
-            chrom, start, end, name, score, strand = region[0:6]
-            matrix_row = np.ma.masked_invalid(np.fromiter(region[6:], np.float))
-            matrix_rows.append(matrix_row)
-            starts = start.split(",")
-            ends = end.split(",")
-            regs = [(int(x), int(y)) for x, y in zip(starts, ends)]
-            # get the group index
-            if len(regions) >= max_group_bound:
-                current_group_index += 1
-                max_group_bound = self.parameters['group_boundaries'][current_group_index + 1]
-            regions.append([chrom, regs, name, max_group_bound, strand, score])
-
-        matrix = np.vstack(matrix_rows)
+    def subset_parameters(self, groups=None, samples=None):
+        """
+        Restricts self.parameters to the given lists of group and sample
+        indices (by default, all of them). Returns the indices of the rows and
+        columns to keep, in order.
+        """
+        p = self.parameters
+        gBounds = p['group_boundaries']
+        sBounds = p['sample_boundaries']
+        nSamples = len(p['sample_labels'])
+        if groups is None:
+            groups = range(len(gBounds) - 1)
+        if samples is None:
+            samples = range(nSamples)
+        rows = []
+        newGroupBounds = [0]
+        for group in groups:
+            rows.extend(range(gBounds[group], gBounds[group + 1]))
+            newGroupBounds.append(len(rows))
+        cols = []
+        newSampleBounds = [0]
+        for sample in samples:
+            cols.extend(range(sBounds[sample], sBounds[sample + 1]))
+            newSampleBounds.append(len(cols))
+
+        for param in self.special_params:
+            if isinstance(p.get(param), list) and len(p[param]) == nSamples:
+                p[param] = [p[param][x] for x in samples]
+        p['group_labels'] = [p['group_labels'][x] for x in groups]
+        p['group_boundaries'] = newGroupBounds
+        p['sample_labels'] = [p['sample_labels'][x] for x in samples]
+        p['sample_boundaries'] = newSampleBounds
+        return rows, cols
+
+    def set_matrix_from_parameters(self, regions, matrix):
+        """
+        Create the _matrix object from a set of regions, their values and
+        self.parameters, as read from a matrix file
+        """
         self.matrix = _matrix(regions, matrix, self.parameters['group_boundaries'],
                               self.parameters['sample_boundaries'],
                               group_labels=self.parameters['group_labels'],
@@ -811,7 +1195,7 @@ class heatmapper(object):
 
         return
 
-    def save_matrix(self, file_name):
+    def save_matrix(self, file_name, file_format=None, numberOfProcessors=1):
         """
         saves the data required to reconstruct the matrix
         the format is:
@@ -825,9 +1209,74 @@ class heatmapper(object):
         Groups are separated by adding a line starting with a hash (#)
         and followed by the group name.
 
-        The file is gzipped.
+        The file is gzipped, as BGZF. Blocks of rows are formatted and
+        compressed in parallel by numberOfProcessors processes. The offset
+        of each block in the file is stored in an index in the header (see
+        matrixHeader()), such that groups of regions can later be read
+        without decompressing the whole file (see read_matrix_file()).
+
+        If file_format is 'binary' (or 'binary-uncompressed'), then a binary
+        container is written instead (see deeptools.matrixContainer). By
+        default the format of the file that was read is used, or 'text' for
+        a newly computed matrix.
+        """
+        if file_format is None:
+            file_format = self.matrix_format
+        if isinstance(self.matrix.matrix, np.memmap) and self.matrix.matrix.filename == os.path.abspath(file_name):
+            # Don't overwrite a file that's still memory-mapped
+            self.matrix.matrix = np.array(self.matrix.matrix)
+        if file_format.startswith('binary'):
+            return self.save_binary_matrix(file_name, compression='none' if file_format == 'binary-uncompressed' else 'zlib')
+
+        h = self.get_matrix_parameters()
+        rows = self.row_block_starts() + [self.matrix.matrix.shape[0]]
+        fh = open(file_name, 'wb')
+        # The header isn't compressed, so its size doesn't change once the index is filled in
+        header = bgzf.compress(matrixHeader(h, None, len(rows)), level=0)
+        fh.write(header)
+        offsets = bgzf.writeBlocks(fh, formatMatrixRows, self.row_blocks(self.matrix.regions),
+                                   numberOfProcessors=numberOfProcessors, start=len(header))
+        fh.write(bgzf.EOF_BLOCK)
+        index = {'rows': rows, 'offsets': offsets, 'size': offsets[-1] + len(bgzf.EOF_BLOCK)}
+        try:
+            fh.seek(0)
+            fh.write(bgzf.compress(matrixHeader(h, index, len(rows)), level=0))
+        except (IOError, OSError):
+            # The output isn't seekable (e.g., a pipe), so it has no index
+            pass
+        fh.close()
+
+    def row_block_starts(self):
+        """
+        The first row of each of the blocks yielded by row_blocks(). Blocks
+        hold about WRITE_BLOCK_VALUES values and never span groups.
+        """
+        nRows = max(1, WRITE_BLOCK_VALUES // max(1, self.matrix.matrix.shape[1]))
+        bounds = self.matrix.group_boundaries
+        starts = []
+        for idx in range(len(bounds) - 1):
+            starts.extend(range(bounds[idx], bounds[idx + 1], nRows))
+        return starts
+
+    def row_blocks(self, regions=None):
+        """
+        Yields the matrix values (as a plain array) in blocks, together with
+        the corresponding regions if those are given, for writing with
+        bgzf.writeBlocks()
+        """
+        starts = self.row_block_starts()
+        ends = starts[1:] + [self.matrix.matrix.shape[0]]
+        for start, end in zip(starts, ends):
+            values = np.asarray(self.matrix.matrix[start:end])
+            if regions is None:
+                yield values
+            else:
+                yield regions[start:end], values
+
+    def get_matrix_parameters(self):
+        """
+        Returns the parameters, as stored in a matrix file header
         """
-        import json
         self.parameters['sample_labels'] = self.matrix.sample_labels
         self.parameters['group_labels'] = self.matrix.group_labels
         self.parameters['sample_boundaries'] = self.matrix.sample_boundaries
@@ -844,37 +1293,27 @@ class heatmapper(object):
                 if len(v) == 0:
                     v = [None] * nSamples
             h[k] = v
-        fh = gzip.open(file_name, 'wb')
-        params_str = json.dumps(h, separators=(',', ':'))
-        fh.write(toBytes("@" + params_str + "\n"))
-        score_list = np.ma.masked_invalid(np.mean(self.matrix.matrix, axis=1))
-        for idx, region in enumerate(self.matrix.regions):
-            # join np_array values
-            # keeping nans while converting them to strings
-            if not np.ma.is_masked(score_list[idx]):
-                np.float(score_list[idx])
-            matrix_values = "\t".join(
-                np.char.mod('%f', self.matrix.matrix[idx, :]))
-            starts = ["{0}".format(x[0]) for x in region[1]]
-            ends = ["{0}".format(x[1]) for x in region[1]]
-            starts = ",".join(starts)
-            ends = ",".join(ends)
-            # BEDish format (we don't currently store the score)
-            fh.write(
-                toBytes('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n'.format(
-                        region[0],
-                        starts,
-                        ends,
-                        region[2],
-                        region[5],
-                        region[4],
-                        matrix_values)))
-        fh.close()
+        return h
+
+    def save_binary_matrix(self, file_name, compression='zlib'):
+        """
+        Saves the matrix in the binary container format (see deeptools.matrixContainer).
+        The values are stored as float32.
+        """
+        h = self.get_matrix_parameters()
+        h['group_boundaries'] = [int(x) for x in h['group_boundaries']]
+        h['sample_boundaries'] = [int(x) for x in h['sample_boundaries']]
+        writer = matrixContainer.MatrixWriter(file_name, h['sample_boundaries'], compression=compression)
+        blockRows = writer.blockRows
+        for start in range(0, len(self.matrix.regions), blockRows):
+            end = min(start + blockRows, len(self.matrix.regions))
+            writer.write(self.matrix.regions[start:end], np.ma.filled(self.matrix.matrix[start:end, :], np.nan))
+        writer.close(h)
 
     def save_tabulated_values(self, file_handle, reference_point_label='TSS', start_label='TSS', end_label='TES', averagetype='mean'):
         """
         Saves the values averaged by col using the avg_type
-        given
+        given. The file is gzipped (as BGZF) if its name ends in .gz.
 
         Args:
             file_handle: file name to save the file
@@ -949,43 +1388,58 @@ class heatmapper(object):
             else:
                 labs.append("")
 
-        with open(file_handle, 'w') as fh:
-            # write labels
-            fh.write("bin labels\t\t{}\n".format("\t".join(labs)))
-            fh.write('bins\t\t{}\n'.format("\t".join([str(x) for x in x_axis])))
+        # write labels
+        lines = ["bin labels\t\t{}\n".format("\t".join(labs)),
+                 'bins\t\t{}\n'.format("\t".join([str(x) for x in x_axis]))]
+
+        for sample_idx in range(self.matrix.get_num_samples()):
+            for group_idx in range(self.matrix.get_num_groups()):
+                sub_matrix = self.matrix.get_matrix(group_idx, sample_idx)
+                values = [str(x) for x in np.ma.__getattribute__(averagetype)(sub_matrix['matrix'], axis=0)]
+                lines.append("{}\t{}\t{}\n".format(sub_matrix['sample'], sub_matrix['group'], "\t".join(values)))
 
-            for sample_idx in range(self.matrix.get_num_samples()):
-                for group_idx in range(self.matrix.get_num_groups()):
-                    sub_matrix = self.matrix.get_matrix(group_idx, sample_idx)
-                    values = [str(x) for x in np.ma.__getattribute__(averagetype)(sub_matrix['matrix'], axis=0)]
-                    fh.write("{}\t{}\t{}\n".format(sub_matrix['sample'], sub_matrix['group'], "\t".join(values)))
+        if file_handle.endswith(".gz"):
+            with open(file_handle, 'wb') as fh:
+                fh.write(bgzf.compress(toBytes("".join(lines))))
+                fh.write(bgzf.EOF_BLOCK)
+        else:
+            with open(file_handle, 'w') as fh:
+                fh.write("".join(lines))
 
-    def save_matrix_values(self, file_name):
+    def save_matrix_values(self, file_name, numberOfProcessors=1):
+        """
+        Saves the matrix values as tab-separated text, gzipped (as BGZF) if
+        file_name ends in .gz. Blocks of rows are formatted (and compressed)
+        in parallel by numberOfProcessors processes.
+        """
+        compressed = file_name.endswith(".gz")
         # print a header telling the group names and their length
-        fh = open(file_name, 'wb')
+        header = []
         info = []
         groups_len = np.diff(self.matrix.group_boundaries)
         for i in range(len(self.matrix.group_labels)):
             info.append("{}:{}".format(self.matrix.group_labels[i],
                                        groups_len[i]))
-        fh.write(toBytes("#{}\n".format("\t".join(info))))
+        header.append("#{}\n".format("\t".join(info)))
         # add to header the x axis values
-        fh.write(toBytes("#downstream:{}\tupstream:{}\tbody:{}\tbin size:{}\tunscaled 5 prime:{}\tunscaled 3 prime:{}\n".format(
-                 self.parameters['downstream'],
-                 self.parameters['upstream'],
-                 self.parameters['body'],
-                 self.parameters['bin size'],
-                 self.parameters.get('unscaled 5 prime', 0),
-                 self.parameters.get('unscaled 3 prime', 0))))
+        header.append("#downstream:{}\tupstream:{}\tbody:{}\tbin size:{}\tunscaled 5 prime:{}\tunscaled 3 prime:{}\n".format(
+                      self.parameters['downstream'],
+                      self.parameters['upstream'],
+                      self.parameters['body'],
+                      self.parameters['bin size'],
+                      self.parameters.get('unscaled 5 prime', 0),
+                      self.parameters.get('unscaled 3 prime', 0)))
         sample_len = np.diff(self.matrix.sample_boundaries)
         for i in range(len(self.matrix.sample_labels)):
             info.extend([self.matrix.sample_labels[i]] * sample_len[i])
-        fh.write(toBytes("{}\n".format("\t".join(info))))
+        header.append("{}\n".format("\t".join(info)))
+        header = toBytes("".join(header))
 
-        fh.close()
-        # reopen again using append mode
-        fh = open(file_name, 'ab')
-        np.savetxt(fh, self.matrix.matrix, fmt="%.4g", delimiter="\t")
+        fh = open(file_name, 'wb')
+        fh.write(bgzf.compress(header) if compressed else header)
+        bgzf.writeBlocks(fh, formatValueRows, self.row_blocks(), numberOfProcessors=numberOfProcessors, compressed=compressed)
+        if compressed:
+            fh.write(bgzf.EOF_BLOCK)
         fh.close()
 
     def save_BED(self, file_handle):
@@ -1116,7 +1570,8 @@ class _matrix(object):
         sample_start = self.sample_boundaries[sample]
         sample_end = self.sample_boundaries[sample + 1]
 
-        return {'matrix': np.ma.masked_invalid(self.matrix[group_start:group_end, :][:, sample_start:sample_end]),
+        # Only a mask is created, the values are not copied
+        return {'matrix': np.ma.masked_invalid(self.matrix[group_start:group_end, :][:, sample_start:sample_end], copy=False),
                 'group': self.group_labels[group],
                 'sample': self.sample_labels[sample]}
 
@@ -1225,15 +1680,28 @@ class _matrix(object):
         self.regions = _sorted_regions
         self.set_sorting_method(sort_method, sort_using)
 
-    def hmcluster(self, k, method='kmeans'):
-
+    def hmcluster(self, k, method='kmeans', fast=False, numberOfProcessors=1):
+        """
+        Clusters the regions into k groups, using either 'kmeans' or
+        'hierarchical' clustering. If fast is True, mini-batch k-means or
+        hierarchical clustering of a subset of the regions is used instead
+        (see deeptools.clustering), which is much faster and uses bounded
+        memory for large matrices.
+        """
         matrix = np.asarray(self.matrix)
         if np.any(np.isnan(matrix)):
             # replace nans for 0 otherwise kmeans produces a weird behaviour
             sys.stderr.write("*Warning* For clustering nan values have to be replaced by zeros \n")
             matrix[np.isnan(matrix)] = 0
 
-        if method == 'kmeans':
+        if fast:
+            from deeptools import clustering
+            if method == 'kmeans':
+                _, cluster_labels = clustering.miniBatchKMeans(matrix, k, numberOfProcessors=numberOfProcessors)
+            else:
+                cluster_labels = clustering.sampledHierarchical(matrix, k, numberOfProcessors=numberOfProcessors)
+
+        elif method == 'kmeans':
             from scipy.cluster.vq import vq, kmeans
 
             centroids, _ = kmeans(matrix, k)
@@ -1241,7 +1709,7 @@ class _matrix(object):
             # get the same cluster order
             cluster_labels, _ = vq(matrix, centroids)
 
-        if method == 'hierarchical':
+        elif method == 'hierarchical':
             # normally too slow for large data sets
             from scipy.cluster.hierarchy import fcluster, linkage
             Z = linkage(matrix, method='ward', metric='euclidean')
@@ -1287,7 +1755,8 @@ class _matrix(object):
         removes matrix rows containing only zeros or nans
         """
         to_keep = []
-        score_list = np.ma.masked_invalid(np.mean(self.matrix, axis=1))
+        # NaNs are ignored, also if the matrix isn't a masked array (e.g., with float32=True)
+        score_list = np.ma.masked_invalid(np.mean(np.ma.masked_invalid(self.matrix, copy=False), axis=1))
         for idx, region in enumerate(self.regions):
             if np.ma.is_masked(score_list[idx]) or np.float(score_list[idx]) == 0:
                 continue
@@ -1,3 +1,4 @@
+import warnings
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -9,7 +10,7 @@ import plotly.graph_objs as go
 old_settings = np.seterr(all='ignore')
 
 
-def plot_single(ax, ma, average_type, color, label, plot_type='simple'):
+def plot_single(ax, ma, average_type, color, label, plot_type='simple', summary=None, error=None):
     """
     Adds a line to the plot in the given ax using the specified method
 
@@ -32,6 +33,11 @@ def plot_single(ax, ma, average_type, color, label, plot_type='simple'):
         standard deviation, 'overlapped_lines' to plot each line of the matrix,
         fill to plot the area between the x axis and the value or None, just to
         plot the average line.
+    summary : numpy array
+        optional, the precomputed `average_type` summary of ma
+    error : numpy array
+        optional, the precomputed standard error or deviation of ma,
+        according to `plot_type`
 
     Returns
     -------
@@ -62,7 +68,8 @@ def plot_single(ax, ma, average_type, color, label, plot_type='simple'):
 
 
     """
-    summary = np.ma.__getattribute__(average_type)(ma, axis=0)
+    if summary is None:
+        summary = np.ma.__getattribute__(average_type)(ma, axis=0)
     # only plot the average profiles without error regions
     x = np.arange(len(summary))
     if isinstance(color, np.ndarray):
@@ -73,7 +80,9 @@ def plot_single(ax, ma, average_type, color, label, plot_type='simple'):
         ax.fill_between(x, summary, facecolor=color, alpha=0.6, edgecolor='none')
 
     if plot_type in ['se', 'std']:
-        if plot_type == 'se':  # standard error
+        if error is not None:
+            std = error
+        elif plot_type == 'se':  # standard error
             std = np.std(ma, axis=0) / np.sqrt(ma.shape[0])
         else:
             std = np.std(ma, axis=0)
@@ -91,9 +100,11 @@ def plot_single(ax, ma, average_type, color, label, plot_type='simple'):
     return ax
 
 
-def plotly_single(ma, average_type, color, label, plot_type='simple'):
+def plotly_single(ma, average_type, color, label, plot_type='simple', summary=None, error=None):
     """A plotly version of plot_single. Returns a list of traces"""
-    summary = list(np.ma.__getattribute__(average_type)(ma, axis=0))
+    if summary is None:
+        summary = np.ma.__getattribute__(average_type)(ma, axis=0)
+    summary = list(summary)
     x = list(np.arange(len(summary)))
     if isinstance(color, str):
         color = list(matplotlib.colors.to_rgb(color))
@@ -102,7 +113,9 @@ def plotly_single(ma, average_type, color, label, plot_type='simple'):
         traces[0].update(fill='tozeroy', fillcolor=color)
 
     if plot_type in ['se', 'std']:
-        if plot_type == 'se':  # standard error
+        if error is not None:
+            std = error
+        elif plot_type == 'se':  # standard error
             std = np.std(ma, axis=0) / np.sqrt(ma.shape[0])
         else:
             std = np.std(ma, axis=0)
@@ -199,3 +212,117 @@ def getProfileTicks(hm, referencePointLabel, startLabel, endLabel, idx):
     xticks = [max(x, 0.5) for x in xticks]
 
     return xticks, xtickslabel
+
+
+def downsampleRows(ma, nRows, method='mean'):
+    """
+    Reduces the number of rows in a matrix to nRows by pooling consecutive
+    rows, with either their mean or their maximum. NaNs are ignored, unless a
+    pooled column is entirely NaN. Matrices with no more than nRows rows are
+    returned as is.
+
+    Examples
+    --------
+
+    >>> m = np.array([[1, 2], [3, np.nan], [5, 6], [7, 8], [9, 10]])
+    >>> downsampleRows(m, 2)
+    array([[2., 2.],
+           [7., 8.]])
+    >>> downsampleRows(m, 2, method='max')
+    array([[ 3.,  2.],
+           [ 9., 10.]])
+    """
+    ma = np.ma.filled(ma, np.nan) if np.ma.isMaskedArray(ma) else np.asarray(ma)
+    if ma.shape[0] <= nRows:
+        return ma
+    edges = np.linspace(0, ma.shape[0], nRows, endpoint=False).astype(int)
+    if method == 'max':
+        return np.fmax.reduceat(ma, edges, axis=0)
+    isnan = np.isnan(ma)
+    sums = np.add.reduceat(np.where(isnan, 0, ma), edges, axis=0)
+    counts = np.add.reduceat(~isnan, edges, axis=0)
+    return sums / counts
+
+
+def approximatePercentiles(ma, percentiles, sketchSize=1000000, blockRows=10000):
+    """
+    Returns the given percentiles of the non-NaN values in a matrix, without
+    making a flattened copy of it. The matrix is read in blocks of rows, from
+    each of which an evenly spaced subset of the values is kept, such that at
+    most roughly sketchSize values are retained. If the matrix holds no more
+    than sketchSize non-NaN values, the result is exact.
+
+    Examples
+    --------
+
+    >>> m = np.arange(100, dtype=float).reshape(10, 10)
+    >>> m[0, 0] = np.nan
+    >>> approximatePercentiles(m, [1.0, 98.0], blockRows=3) == np.percentile(m[~np.isnan(m)], [1.0, 98.0])
+    array([ True,  True])
+    """
+    ma = np.ma.filled(ma, np.nan) if np.ma.isMaskedArray(ma) else ma
+    nValid = 0
+    for start in range(0, ma.shape[0], blockRows):
+        nValid += np.count_nonzero(~np.isnan(ma[start:start + blockRows]))
+    if nValid == 0:
+        return [np.nan] * len(percentiles)
+
+    step = max(1, int(np.ceil(nValid / float(sketchSize))))
+    offset = 0
+    sample = []
+    for start in range(0, ma.shape[0], blockRows):
+        block = np.asarray(ma[start:start + blockRows])
+        block = block[~np.isnan(block)]
+        sample.append(block[offset::step])
+        # continue the stride into the next block
+        offset = (offset - len(block)) % step
+    return np.percentile(np.concatenate(sample), percentiles)
+
+
+def summarizeMatrix(ma, group_boundaries, sample_boundaries):
+    """
+    Computes the per-column mean, median, max, min, std, sum and standard
+    error (stderr, the std divided by the square root of the number of rows)
+    of every group/sample sub-matrix. Each statistic is computed once per
+    group over all of its columns and the result is then split by sample.
+    NaNs are ignored, columns that are entirely NaN summarize to NaN.
+
+    Returns a dictionary, keyed by (group, sample), of dictionaries keyed by
+    statistic.
+
+    Examples
+    --------
+
+    >>> m = np.array([[1, 2, 0], [3, np.nan, 1], [5, 6, np.nan], [7, 8, np.nan]])
+    >>> s = summarizeMatrix(m, [0, 2, 4], [0, 2, 3])
+    >>> sorted(s.keys())
+    [(0, 0), (0, 1), (1, 0), (1, 1)]
+    >>> s[(0, 0)]['mean']
+    array([2., 2.])
+    >>> s[(0, 1)]['sum']
+    array([1.])
+    >>> s[(1, 1)]['sum']
+    array([nan])
+    >>> s[(1, 0)]['stderr']
+    array([0.70710678, 0.70710678])
+    """
+    summaries = dict()
+    with warnings.catch_warnings():
+        # Columns that are entirely NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for group in range(len(group_boundaries) - 1):
+            block = ma[group_boundaries[group]:group_boundaries[group + 1], :]
+            block = np.ma.filled(block, np.nan) if np.ma.isMaskedArray(block) else np.asarray(block)
+            counts = np.sum(~np.isnan(block), axis=0)
+            stats = {'mean': np.nanmean(block, axis=0),
+                     'median': np.nanmedian(block, axis=0),
+                     'max': np.nanmax(block, axis=0),
+                     'min': np.nanmin(block, axis=0),
+                     'std': np.nanstd(block, axis=0),
+                     'sum': np.where(counts > 0, np.nansum(block, axis=0), np.nan)}
+            stats['stderr'] = stats['std'] / np.sqrt(block.shape[0])
+            for sample in range(len(sample_boundaries) - 1):
+                start = sample_boundaries[sample]
+                end = sample_boundaries[sample + 1]
+                summaries[(group, sample)] = dict((k, v[start:end]) for k, v in stats.items())
+    return summaries
@@ -1,5 +1,5 @@
 import multiprocessing
-from deeptoolsintervals import GTF
+from deeptoolsintervals import loadIndex
 import random
 
 debug = 0
@@ -82,10 +82,10 @@ def mapReduce(staticArgs, func, chromSize,
         defaultGroup = None
         if len(bedFile) == 1:
             defaultGroup = "genes"
-        bed_interval_tree = GTF(bedFile, defaultGroup=defaultGroup, transcriptID=transcriptID, exonID=exonID, transcript_id_designator=transcript_id_designator, keepExons=keepExons)
+        bed_interval_tree = loadIndex(bedFile, defaultGroup=defaultGroup, transcriptID=transcriptID, exonID=exonID, transcript_id_designator=transcript_id_designator, keepExons=keepExons)
 
     if blackListFileName:
-        blackList = GTF(blackListFileName)
+        blackList = loadIndex(blackListFileName)
 
     TASKS = []
     # iterate over all chromosomes
@@ -0,0 +1,394 @@
+"""
+A binary container for the matrices produced by computeMatrix.
+
+The gzipped text format written by heatmapper.save_matrix() stores every value
+as a formatted string, which makes large matrices slow to write and to parse.
+This module stores the same information (parameters, regions and values) as:
+
+ * a fixed size header: magic bytes, format version and the position of the footer
+ * the matrix values as float32 tiles, one tile per block of rows and per sample,
+   each tile optionally zlib compressed
+ * the regions table, as zlib compressed BED-like text (the first 6 columns of
+   the text format)
+ * a JSON footer containing the parameters and the position of every tile
+
+Since each tile holds a single sample for a block of rows, reading a subset of
+rows or samples only requires decompressing the tiles that overlap them. If no
+compression is used the values are instead written as one contiguous C-ordered
+array, which can then be memory-mapped.
+"""
+import json
+import struct
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from deeptools.utilities import toString, toBytes
+
+MAGIC = b"DTMATRIX"
+VERSION = 1
+# magic, version, footer offset, footer length
+HEADER = struct.Struct("<8sIQQ")
+DTYPE = np.dtype("<f4")
+# aim for uncompressed tiles of roughly this many bytes
+TILE_BYTES = 4 << 20
+
+
+def isBinaryMatrix(fname):
+    """
+    Returns True if fname is a binary matrix file (rather than a gzipped text one)
+    """
+    try:
+        with open(fname, "rb") as fh:
+            return fh.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def regionToString(region):
+    """
+    Convert a heatmapper region ([chrom, [(start, end), ...], name, group, strand, score])
+    to the first 6 columns of the text matrix format.
+
+    >>> regionToString(['chr1', [(0, 10), (20, 30)], 'foo', 0, '+', '.'])
+    'chr1\\t0,20\\t10,30\\tfoo\\t.\\t+'
+    """
+    starts = ",".join(["{0}".format(x[0]) for x in region[1]])
+    ends = ",".join(["{0}".format(x[1]) for x in region[1]])
+    return "{0}\t{1}\t{2}\t{3}\t{4}\t{5}".format(region[0], starts, ends, region[2], region[5], region[4])
+
+
+def stringToRegion(line, group=None):
+    """
+    The inverse of regionToString(). The group index is not stored in the
+    file and is therefore supplied by the caller.
+
+    >>> stringToRegion('chr1\\t0,20\\t10,30\\tfoo\\t.\\t+', 0)
+    ['chr1', [(0, 10), (20, 30)], 'foo', 0, '+', '.']
+    """
+    chrom, start, end, name, score, strand = line.split("\t")[0:6]
+    regs = [(int(x), int(y)) for x, y in zip(start.split(","), end.split(","))]
+    return [chrom, regs, name, group, strand, score]
+
+
+def defaultBlockRows(ncols):
+    """
+    The number of rows per block such that a block is roughly TILE_BYTES
+    """
+    return max(1, TILE_BYTES // (DTYPE.itemsize * max(1, ncols)))
+
+
+class MatrixWriter(object):
+    """
+    Write a binary matrix incrementally. Rows are added with write(), which
+    accepts any number of rows at a time, and the parameters are written by
+    close(). As the parameters are only needed at the end, things like the
+    group boundaries can be computed while rows are being written.
+
+    >>> import tempfile, os
+    >>> fname = tempfile.NamedTemporaryFile(suffix=".mat", delete=False).name
+    >>> w = MatrixWriter(fname, [0, 2, 3], blockRows=2)
+    >>> w.write([['chr1', [(0, 10)], 'a', 0, '+', '.'], ['chr1', [(10, 20)], 'b', 0, '-', '.'], ['chr2', [(5, 8)], 'c', 0, '.', '.']],
+    ...         np.arange(9).reshape(3, 3))
+    >>> w.close({'group_boundaries': [0, 3], 'sample_boundaries': [0, 2, 3]})
+    >>> r = MatrixReader(fname)
+    >>> r.shape
+    (3, 3)
+    >>> r.read(samples=[1]).tolist()
+    [[2.0], [5.0], [8.0]]
+    >>> r.read(rows=(1, 3)).tolist()
+    [[3.0, 4.0, 5.0], [6.0, 7.0, 8.0]]
+    >>> [x[2] for x in r.regions()]
+    ['a', 'b', 'c']
+    >>> r.close()
+    >>> os.remove(fname)
+    """
+
+    def __init__(self, fname, sample_boundaries, compression="zlib", compressionLevel=6, blockRows=None):
+        self.fname = fname
+        self.sample_boundaries = [int(x) for x in sample_boundaries]
+        self.ncols = self.sample_boundaries[-1]
+        self.compression = compression
+        self.compressionLevel = compressionLevel
+        if blockRows is None:
+            blockRows = defaultBlockRows(self.ncols)
+        self.blockRows = blockRows
+        self.nrows = 0
+        self.row_blocks = []
+        self.tiles = []
+        self.regions = []
+        self.buf = []
+        self.nbuf = 0
+
+        self.fh = open(fname, "wb")
+        self.fh.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        self.dataOffset = self.fh.tell()
+
+    def write(self, regions, rows):
+        """
+        Append rows (a 2D array) and their corresponding regions
+        """
+        self.writeLines([regionToString(x) for x in regions], rows)
+
+    def writeLines(self, lines, rows):
+        """
+        Like write(), but the regions are already formatted by regionToString()
+        """
+        rows = np.asarray(rows, dtype=DTYPE)
+        if rows.ndim == 1:
+            rows = rows.reshape(1, -1)
+        assert rows.shape[0] == len(lines), "the number of regions and rows differ"
+        assert rows.shape[1] == self.ncols, "the number of columns doesn't match the sample boundaries"
+        self.regions.extend(lines)
+        self.buf.append(rows)
+        self.nbuf += rows.shape[0]
+        while self.nbuf >= self.blockRows:
+            self.flush(self.blockRows)
+
+    def writeBlock(self, regions, rows):
+        """
+        Like write(), but the rows form a block of their own. This is used to
+        align blocks to group boundaries.
+        """
+        self.write(regions, rows)
+        if self.nbuf:
+            self.flush(self.nbuf)
+
+    def flush(self, n):
+        """
+        Write the first n buffered rows as a block of tiles
+        """
+        buf = np.concatenate(self.buf, axis=0) if len(self.buf) > 1 else self.buf[0]
+        block = buf[:n]
+        rest = buf[n:]
+        self.buf = [rest] if rest.shape[0] else []
+        self.nbuf = rest.shape[0]
+
+        tiles = []
+        if self.compression == "zlib":
+            for sIdx in range(len(self.sample_boundaries) - 1):
+                tile = np.ascontiguousarray(block[:, self.sample_boundaries[sIdx]:self.sample_boundaries[sIdx + 1]])
+                payload = zlib.compress(tile.tobytes(), self.compressionLevel)
+                tiles.append([self.fh.tell(), len(payload)])
+                self.fh.write(payload)
+        else:
+            payload = np.ascontiguousarray(block).tobytes()
+            tiles.append([self.fh.tell(), len(payload)])
+            self.fh.write(payload)
+        self.row_blocks.append([self.nrows, self.nrows + block.shape[0]])
+        self.tiles.append(tiles)
+        self.nrows += block.shape[0]
+
+    def close(self, parameters):
+        """
+        Flush any remaining rows and write the regions and footer
+        """
+        if self.nbuf:
+            self.flush(self.nbuf)
+
+        payload = zlib.compress(toBytes("\n".join(self.regions)), self.compressionLevel)
+        regionsOffset = self.fh.tell()
+        self.fh.write(payload)
+
+        footer = {"parameters": parameters,
+                  "shape": [self.nrows, self.ncols],
+                  "dtype": DTYPE.str,
+                  "compression": self.compression,
+                  "sample_boundaries": self.sample_boundaries,
+                  "row_blocks": self.row_blocks,
+                  "tiles": self.tiles,
+                  "data": self.dataOffset,
+                  "regions": [regionsOffset, len(payload)]}
+        footer = toBytes(json.dumps(footer, separators=(',', ':')))
+        footerOffset = self.fh.tell()
+        self.fh.write(footer)
+        self.fh.seek(0)
+        self.fh.write(HEADER.pack(MAGIC, VERSION, footerOffset, len(footer)))
+        self.fh.close()
+
+
+class MatrixReader(object):
+    """
+    Lazily read a binary matrix. Only the header and footer are read when the
+    file is opened; values are read on request.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.fh = open(fname, "rb")
+        magic, version, footerOffset, footerLength = HEADER.unpack(self.fh.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a binary matrix file".format(fname))
+        if version > VERSION:
+            raise ValueError("{} was written by a newer version of deepTools (format version {})".format(fname, version))
+        self.fh.seek(footerOffset)
+        footer = json.loads(toString(self.fh.read(footerLength)))
+        self.parameters = footer["parameters"]
+        self.shape = tuple(footer["shape"])
+        self.dtype = np.dtype(footer["dtype"])
+        self.compression = footer["compression"]
+        self.sample_boundaries = footer["sample_boundaries"]
+        self.row_blocks = footer["row_blocks"]
+        self.tiles = footer["tiles"]
+        self.dataOffset = footer["data"]
+        self.regionsPos = footer["regions"]
+        self._mmap = None
+        # recently decompressed blocks, used by readRows()
+        self._cache = OrderedDict()
+        self.cacheSize = 8
+
+    def close(self):
+        self.fh.close()
+        self._mmap = None
+
+    def memmap(self):
+        """
+        Return the whole matrix as a copy-on-write memory map. This is only
+        possible for uncompressed files.
+        """
+        if self.compression != "none":
+            return None
+        if self._mmap is None:
+            if self.shape[0] == 0:
+                return np.zeros(self.shape, dtype=self.dtype)
+            self._mmap = np.memmap(self.fname, dtype=self.dtype, mode='c', offset=self.dataOffset, shape=self.shape)
+        return self._mmap
+
+    def regionLines(self):
+        """
+        The regions as a list of BED-like lines (see regionToString())
+        """
+        self.fh.seek(self.regionsPos[0])
+        lines = toString(zlib.decompress(self.fh.read(self.regionsPos[1])))
+        if len(lines) == 0:
+            return []
+        return lines.split("\n")
+
+    def regions(self):
+        """
+        Returns the regions in the same format as heatmapper.read_matrix_file()
+        """
+        bounds = self.parameters['group_boundaries']
+        out = []
+        gIdx = 0
+        for idx, line in enumerate(self.regionLines()):
+            while idx >= bounds[gIdx + 1]:
+                gIdx += 1
+            out.append(stringToRegion(line, bounds[gIdx + 1]))
+        return out
+
+    def sampleColumns(self, samples):
+        """
+        Given a list of sample indices, return the corresponding column indices
+        """
+        cols = []
+        for sIdx in samples:
+            cols.extend(range(self.sample_boundaries[sIdx], self.sample_boundaries[sIdx + 1]))
+        return cols
+
+    def readTile(self, bIdx, sIdx):
+        """
+        Return the values of sample sIdx in row block bIdx
+        """
+        start, end = self.row_blocks[bIdx]
+        if self.compression == "none":
+            return self.memmap()[start:end, self.sample_boundaries[sIdx]:self.sample_boundaries[sIdx + 1]]
+        offset, length = self.tiles[bIdx][sIdx]
+        self.fh.seek(offset)
+        ncols = self.sample_boundaries[sIdx + 1] - self.sample_boundaries[sIdx]
+        return np.frombuffer(zlib.decompress(self.fh.read(length)), dtype=self.dtype).reshape(end - start, ncols)
+
+    def readBlock(self, bIdx, samples=None):
+        """
+        Return the values of a row block, possibly only for some samples
+        """
+        if samples is None:
+            samples = range(len(self.sample_boundaries) - 1)
+        samples = list(samples)
+        start, end = self.row_blocks[bIdx]
+        if self.compression == "none":
+            mm = self.memmap()[start:end]
+            if len(samples) == len(self.sample_boundaries) - 1 and samples == sorted(samples):
+                return np.array(mm)
+            return mm[:, self.sampleColumns(samples)]
+        if len(samples) == 0:
+            return np.zeros((end - start, 0), dtype=self.dtype)
+        return np.hstack([self.readTile(bIdx, sIdx) for sIdx in samples])
+
+    def iterBlocks(self, samples=None, rows=None):
+        """
+        Yields (start row, end row, values) for each row block, possibly
+        restricted to a (start, end) range of rows
+        """
+        if rows is None:
+            rows = (0, self.shape[0])
+        for bIdx, (start, end) in enumerate(self.row_blocks):
+            if end <= rows[0] or start >= rows[1]:
+                continue
+            block = self.readBlock(bIdx, samples)
+            s = max(start, rows[0])
+            e = min(end, rows[1])
+            yield s, e, block[s - start:e - start]
+
+    def blockIndex(self, rows):
+        """
+        Return the row block index of each of the given row indices
+        """
+        ends = np.array([x[1] for x in self.row_blocks], dtype=np.int64)
+        return np.searchsorted(ends, rows, side='right')
+
+    def readRows(self, rows, samples=None):
+        """
+        Return the values for an arbitrary list of row indices, in the order
+        given. Each needed block is decompressed once and the most recently
+        used blocks are cached, so reading rows in approximately ascending
+        order only decompresses each block about once.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        ncols = self.shape[1] if samples is None else len(self.sampleColumns(samples))
+        out = np.empty((len(rows), ncols), dtype=self.dtype)
+        if len(rows) == 0:
+            return out
+        if self.compression == "none":
+            mm = self.memmap()
+            if samples is None:
+                out[:] = mm[rows]
+            else:
+                out[:] = mm[rows][:, self.sampleColumns(samples)]
+            return out
+        key = None if samples is None else tuple(samples)
+        bIdxs = self.blockIndex(rows)
+        for bIdx in np.unique(bIdxs):
+            if (bIdx, key) in self._cache:
+                block = self._cache.pop((bIdx, key))
+            else:
+                block = self.readBlock(bIdx, samples)
+            self._cache[(bIdx, key)] = block
+            while len(self._cache) > self.cacheSize:
+                self._cache.popitem(last=False)
+            mask = bIdxs == bIdx
+            out[mask] = block[rows[mask] - self.row_blocks[bIdx][0]]
+        return out
+
+    def read(self, rows=None, samples=None):
+        """
+        Read a range of rows (a (start, end) tuple, default: all) and possibly
+        only some samples (a list of sample indices, default: all)
+        """
+        if rows is None:
+            rows = (0, self.shape[0])
+        start, end = rows
+        if self.compression == "none" and samples is None:
+            return self.memmap()[start:end]
+
+        out = []
+        for bIdx, (bStart, bEnd) in enumerate(self.row_blocks):
+            if bEnd <= start or bStart >= end:
+                continue
+            block = self.readBlock(bIdx, samples)
+            out.append(block[max(start, bStart) - bStart:min(end, bEnd) - bStart])
+        if len(out) == 0:
+            ncols = self.shape[1] if samples is None else len(self.sampleColumns(samples))
+            return np.zeros((0, ncols), dtype=self.dtype)
+        return np.concatenate(out, axis=0)
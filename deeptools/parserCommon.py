@@ -253,7 +253,9 @@ def normalization_options():
                        'the output. This requires significantly more time to compute, but will '
                        'produce more accurate scaling factors in cases where alignments that are '
                        'being filtered are rare and lumped together. In other words, this is only '
-                       'needed when region-based sampling is expected to produce incorrect results.',
+                       'needed when region-based sampling is expected to produce incorrect results. '
+                       'The counts are cached (in $DEEPTOOLS_CACHE_DIR, by default ~/.cache/deeptools) '
+                       'for the filtering settings, so later runs on the same file are fast.',
                        action='store_true')
 
     group.add_argument('--ignoreForNormalization', '-ignore',
@@ -444,7 +446,8 @@ def heatmapperOutputArgs(args=None,
         output.add_argument('--outFileNameMatrix',
                             help='If this option is given, then the matrix '
                             'of values underlying the heatmap will be saved '
-                            'using this name, e.g. MyMatrix.tab.',
+                            'using this name, e.g. MyMatrix.tab. The file is '
+                            'gzipped if the name ends in .gz.',
                             metavar='FILE',
                             type=writableFile)
 
@@ -460,11 +463,23 @@ def heatmapperOutputArgs(args=None,
                             choices=['auto', 'nearest', 'bilinear', 'bicubic', 'gaussian'],
                             metavar='STR',
                             default='auto')
+
+        output.add_argument('--downsampleRows',
+                            help='For heatmaps with many more regions than there are pixels '
+                            'to show them, pool consecutive rows by their "mean" or "max" '
+                            'down to the height of each heatmap in pixels before drawing it. '
+                            'The default color limits (--zMin/--zMax) are then computed from a '
+                            'subsample of the values, rather than from a copy of the whole matrix. '
+                            'This makes plotting large matrices much faster and uses less memory. '
+                            '(Default: %(default)s)',
+                            choices=['none', 'mean', 'max'],
+                            default='none')
     elif mode == 'profile':
         output.add_argument('--outFileNameData',
                             help='File name to save the data '
                             'underlying data for the average profile, e.g. '
-                            'myProfile.tab.',
+                            'myProfile.tab. The file is gzipped if the name '
+                            'ends in .gz.',
                             type=writableFile)
     output.add_argument(
         '--dpi',
@@ -505,6 +520,14 @@ def heatmapperOptionalArgs(mode=['heatmap', 'profile'][0]):
         'fail with an error if a cluster has very few members compared to the '
         'total number of regions.',
         type=int)
+    cluster.add_argument(
+        '--fastClustering',
+        help='If set, --kmeans uses mini-batch k-means and --hclust clusters '
+        'a random subset of 5000 regions, after which the remaining regions '
+        'are assigned to the cluster with the closest centroid. This is much '
+        'faster and uses far less memory for large numbers of regions, but '
+        'the results are approximate.',
+        action='store_true')
 
     optional = parser.add_argument_group('Optional arguments')
 
@@ -512,6 +535,19 @@ def heatmapperOptionalArgs(mode=['heatmap', 'profile'][0]):
                           help="show this help message and exit")
     optional.add_argument('--version', action='version',
                           version='%(prog)s {}'.format(__version__))
+    if mode == 'heatmap':
+        numberOfProcessorsHelp = 'Number of processors to use when reading the matrix, when clustering with ' \
+            '--fastClustering and to render the individual heatmaps in parallel. '
+    else:
+        numberOfProcessorsHelp = 'Number of processors to use when reading the matrix and when clustering ' \
+            'with --fastClustering. '
+    optional.add_argument('--numberOfProcessors', '-p',
+                          help=numberOfProcessorsHelp +
+                          'Type "max/2" to use half the maximum number of '
+                          'processors or "max" to use all available processors. (Default: %(default)s)',
+                          metavar="INT",
+                          type=numberOfProcessors,
+                          default=1)
     if mode == 'profile':
         optional.add_argument(
             '--averageType',
@@ -815,6 +851,12 @@ def heatmapperOptionalArgs(mode=['heatmap', 'profile'][0]):
                           help='If set, warning messages and '
                           'additional information are given.',
                           action='store_true')
+
+    optional.add_argument('--float32',
+                          help='If set, the matrix is held in memory as 32-bit '
+                          'floats, with missing values stored as NaN. This '
+                          'halves the memory needed for large matrices.',
+                          action='store_true')
     return parser
 
 
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import copy
+import json
+import shlex
+import sys
+
+from deeptools import plotHeatmap
+from deeptools import plotProfile
+from deeptools._version import __version__
+
+TOOLS = {'plotHeatmap': plotHeatmap,
+         'plotProfile': plotProfile}
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+This tool runs plotHeatmap and/or plotProfile several times on the same
+matrix, which is only read once. Runs that cluster, sort and relabel the
+matrix in the same way share the resulting matrix.
+
+The plots are specified in a JSON file (or YAML, if PyYAML is installed)
+containing a list of entries, each with the name of the tool and its
+command line arguments, but without --matrixFile. For example:
+
+[{"tool": "plotHeatmap", "args": "-o heatmap.png --kmeans 3 --outFileSortedRegions clusters.bed"},
+ {"tool": "plotHeatmap", "args": "-o heatmap_blue.png --kmeans 3 --colorMap Blues"},
+ {"tool": "plotProfile", "args": ["-o", "profile.png", "--perGroup"]}]
+""",
+        epilog='example usage:\n plotBatch -m matrix.mat.gz --plots plots.json\n\n',
+        add_help=False)
+
+    required = parser.add_argument_group('Required arguments')
+    required.add_argument('--matrixFile', '-m',
+                          help='Matrix file from the computeMatrix tool.',
+                          required=True)
+
+    required.add_argument('--plots',
+                          help='A JSON or YAML file listing the plots to make.',
+                          metavar='FILE',
+                          required=True)
+
+    optional = parser.add_argument_group('Optional arguments')
+
+    optional.add_argument("--help", "-h", action="help",
+                          help="show this help message and exit")
+
+    optional.add_argument('--version', action='version',
+                          version='%(prog)s {}'.format(__version__))
+
+    optional.add_argument('--float32',
+                          help='If set, the matrix is held in memory as 32-bit '
+                          'floats, with missing values stored as NaN.',
+                          action='store_true')
+
+    return parser
+
+
+def loadPlots(fname):
+    """
+    Returns a list of (tool name, argument list) tuples from a JSON/YAML file
+    """
+    with open(fname) as fh:
+        s = fh.read()
+    if fname.endswith(".yaml") or fname.endswith(".yml"):
+        try:
+            import yaml
+        except ImportError:
+            sys.exit("PyYAML must be installed to read {}\n".format(fname))
+        plots = yaml.safe_load(s)
+    else:
+        plots = json.loads(s)
+
+    res = []
+    for plot in plots:
+        if plot.get('tool') not in TOOLS:
+            sys.exit("Each entry in {} must have a 'tool' of either {}\n".format(fname, " or ".join(sorted(TOOLS))))
+        args = plot.get('args', [])
+        if not isinstance(args, list):
+            args = shlex.split(args)
+        res.append((plot['tool'], [str(x) for x in args]))
+    return res
+
+
+def matrixKey(args):
+    """
+    Runs with the same key result in the same clustered/sorted/relabeled matrix
+    """
+    sortRegions = getattr(args, 'sortRegions', 'no')
+    if sortRegions == 'keep':
+        sortRegions = 'no'
+    key = [args.kmeans, args.hclust, args.regionsLabel, args.samplesLabel, sortRegions]
+    if args.kmeans is not None or args.hclust is not None:
+        key.append(args.fastClustering)
+    if sortRegions != 'no':
+        key.extend([args.sortUsing, args.sortUsingSamples])
+    return json.dumps(key)
+
+
+def main(args=None):
+    args = parse_arguments().parse_args(args)
+    plots = loadPlots(args.plots)
+
+    # Parse everything before doing anything
+    toRun = []
+    for tool, toolArgs in plots:
+        toRun.append((tool, TOOLS[tool].process_args(toolArgs)))
+
+    numberOfProcessors = max([toolArgs.numberOfProcessors for _, toolArgs in toRun] + [1])
+    hm = plotHeatmap.loadMatrix(args.matrixFile, args.float32, numberOfProcessors)
+    matrices = dict()
+    matrices[matrixKey(argparse.Namespace(kmeans=None, hclust=None, regionsLabel=None, samplesLabel=None))] = hm
+    for tool, toolArgs in toRun:
+        key = matrixKey(toolArgs)
+        if key not in matrices:
+            # clustering can modify the values of the matrix, so always start from a copy
+            matrices[key] = copy.deepcopy(hm)
+            TOOLS[tool].prepareMatrix(matrices[key], toolArgs)
+        TOOLS[tool].plot(matrices[key], toolArgs)
@@ -18,7 +18,7 @@ from deeptools.mapReduce import mapReduce, getUserRegion, blSubtract
 from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
 from deeptools.utilities import getCommonChrNames, mungeChromosome, getTLen, smartLabels
 from deeptools.bamHandler import openBam
-from deeptoolsintervals import Enrichment, GTF
+from deeptoolsintervals import Enrichment, loadIndex
 from deeptools.countReadsPerBin import CountReadsPerBin as cr
 from deeptools import parserCommon
 
@@ -282,8 +282,9 @@ def getEnrichment_worker(arglist):
     This is the worker function of plotEnrichment.
 
     In short, given a region, iterate over all reads **starting** in it.
-    Filter/extend them as requested and check each for an overlap with
-    findOverlaps. For each overlap, increment the counter for that feature.
+    Filter/extend them as requested and collect their blocks. The overlaps of
+    all of these with the features are then counted in a single batch query,
+    with each read counted at most once per feature.
     """
     chrom, start, end, args, defaultFragmentLength = arglist
     if args.verbose:
@@ -292,15 +293,15 @@ def getEnrichment_worker(arglist):
     olist = []
     total = [0] * len(args.bamfiles)
     for idx, f in enumerate(args.bamfiles):
-        odict = dict()
-        for x in gtf.features:
-            odict[x] = 0
         fh = openBam(f)
 
         chrom = mungeChromosome(chrom, fh.references)
 
         lpos = None
         prev_pos = set()
+        blockStarts = []
+        blockEnds = []
+        blockReads = []
         for read in fh.fetch(chrom, start, end):
             # Filter
             if read.pos < start:
@@ -339,11 +340,18 @@ def getEnrichment_worker(arglist):
             total[idx] += 1
 
             # Get blocks, possibly extending
-            features = gtf.findOverlaps(chrom, getBAMBlocks(read, defaultFragmentLength, args.centerReads, args.Offset))
+            for block in getBAMBlocks(read, defaultFragmentLength, args.centerReads, args.Offset):
+                if block[0] is None:
+                    continue
+                blockStarts.append(int(block[0]))
+                blockEnds.append(int(block[1]))
+                blockReads.append(total[idx])
 
-            if features is not None and len(features) > 0:
-                for x in features:
-                    odict[x] += 1
+        counts = gtf.featureCounts(chrom, blockStarts, blockEnds, blockReads)
+        # The features are the first entries of the feature table
+        odict = dict()
+        for x, c in zip(gtf.features, counts):
+            odict[x] = int(c)
         olist.append(odict)
     return olist, gtf.features, total
 
@@ -462,7 +470,7 @@ def getChunkLength(args, chromSize):
 
     bl = None
     if args.blackListFileName:
-        bl = GTF(args.blackListFileName)
+        bl = loadIndex(args.blackListFileName)
 
     lengths = []
     for k, v in chromSize:
@@ -498,7 +506,7 @@ def main(args=None):
     global gtf
     if not args.regionLabels and args.smartLabels:
         args.regionLabels = smartLabels(args.BED)
-    gtf = Enrichment(args.BED, keepExons=args.keepExons, labels=args.regionLabels)
+    gtf = loadIndex(args.BED, Enrichment, keepExons=args.keepExons, labels=args.regionLabels)
 
     # Get fragment size and chromosome dict
     fhs = [openBam(x) for x in args.bamfiles]
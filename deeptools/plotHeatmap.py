@@ -13,15 +13,17 @@ import matplotlib.pyplot as plt
 from matplotlib.font_manager import FontProperties
 import matplotlib.gridspec as gridspec
 from matplotlib import ticker
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 import sys
+import multiprocessing
 import plotly.offline as py
 import plotly.graph_objs as go
 
 # own modules
 from deeptools import parserCommon
 from deeptools import heatmapper
-from deeptools.heatmapper_utilities import plot_single, plotly_single
+from deeptools.heatmapper_utilities import plot_single, plotly_single, downsampleRows, approximatePercentiles
 from deeptools.utilities import convertCmap
 from deeptools.computeMatrixOperations import filterHeatmapValues
 
@@ -59,6 +61,34 @@ def process_args(args=None):
     return args
 
 
+def renderHeatmap(args):
+    """
+    Renders a single heatmap to an RGBA array of the given size in pixels,
+    using the same settings as imshow() in plotMatrix(). This is run in worker
+    processes, so plotMatrix() then only needs to place the resulting images.
+
+    >>> m = np.arange(20000, dtype=float).reshape(10000, 2)
+    >>> renderHeatmap((m, 30, 50, 'nearest', 0, 20000, plt.get_cmap('RdYlBu'))).shape
+    (50, 30, 4)
+    """
+    matrix, width, height, interpolation, vmin, vmax, cmap = args
+    fig = matplotlib.figure.Figure(figsize=(width / 100.0, height / 100.0), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    rows, cols = matrix.shape
+    ax.imshow(matrix,
+              aspect='auto',
+              interpolation=interpolation,
+              origin='upper',
+              vmin=vmin,
+              vmax=vmax,
+              cmap=cmap,
+              extent=[0, cols, rows, 0])
+    canvas.draw()
+    return np.array(canvas.buffer_rgba())
+
+
 def prepare_layout(hm_matrix, heatmapsize, showSummaryPlot, showColorbar, perGroup, colorbar_position):
     """
     prepare the plot layout
@@ -386,7 +416,9 @@ def plotMatrix(hm, outFileName,
                box_around_heatmaps=True,
                label_rotation=0.0,
                dpi=200,
-               interpolation_method='auto'):
+               interpolation_method='auto',
+               downsample_rows='none',
+               numberOfProcessors=1):
 
     hm.reference_point_label = hm.parameters['ref point']
     if reference_point_label is not None:
@@ -395,6 +427,18 @@ def plotMatrix(hm, outFileName,
     hm.endLabel = endLabel
 
     matrix_flatten = None
+    if downsample_rows != 'none' and (zMin is None or zMax is None):
+        # avoid making a flattened copy of the matrix
+        matrix_flatten = approximatePercentiles(hm.matrix.matrix, [1.0, 98.0])
+        if zMin is None:
+            zMin = [None] if np.isnan(matrix_flatten[0]) else [matrix_flatten[0]]
+        if zMax is None:
+            zMax = matrix_flatten[1]
+            if np.isnan(zMax) or (zMin[0] is not None and zMax <= zMin[0]):
+                zMax = [None]
+            else:
+                zMax = [zMax]
+
     if zMin is None:
         matrix_flatten = hm.matrix.flatten()
         # try to avoid outliers by using np.percentile
@@ -560,6 +604,9 @@ def plotMatrix(hm, outFileName,
             ax_list[-1].legend(loc=legend_location.replace('-', ' '), ncol=1, prop=fontP,
                                frameon=False, markerscale=0.5)
 
+    # With more than one processor the heatmaps are only drawn at the end,
+    # after being rendered in parallel
+    panels = []
     first_group = 0  # helper variable to place the title per sample/group
     for sample in range(hm.matrix.get_num_samples()):
         sample_idx = sample
@@ -603,10 +650,17 @@ def plotMatrix(hm, outFileName,
                 ax.spines['bottom'].set_visible(False)
                 ax.spines['left'].set_visible(False)
             rows, cols = sub_matrix['matrix'].shape
+            if downsample_rows != 'none':
+                # pool the rows down to the number of pixels available for them
+                if perGroup:
+                    panel_height = heatmapHeight / 2.54 / numsamples
+                else:
+                    panel_height = heatmapHeight / 2.54 * rows / float(hm.matrix.group_boundaries[-1])
+                sub_matrix['matrix'] = downsampleRows(sub_matrix['matrix'], max(1, int(np.ceil(panel_height * dpi))), method=downsample_rows)
             # if the number of rows is too large, then the 'nearest' method simply
             # drops rows. A better solution is to relate the threshold to the DPI of the image
             if interpolation_method == 'auto':
-                if rows >= 1000:
+                if sub_matrix['matrix'].shape[0] >= 1000:
                     interpolation_method = 'bilinear'
                 else:
                     interpolation_method = 'nearest'
@@ -616,16 +670,27 @@ def plotMatrix(hm, outFileName,
             # the default behaviour produces images full of large highlighted dots.
             # If interpolation='nearest' is used, this has no effect
             sub_matrix['matrix'] = np.clip(sub_matrix['matrix'], zMin[zmin_idx], zMax[zmax_idx])
-            img = ax.imshow(sub_matrix['matrix'],
-                            aspect='auto',
-                            interpolation=interpolation_method,
-                            origin='upper',
-                            vmin=zMin[zmin_idx],
-                            vmax=zMax[zmax_idx],
-                            cmap=cmap[cmap_idx],
-                            alpha=alpha,
-                            extent=[0, cols, rows, 0])
-            img.set_rasterized(True)
+            if numberOfProcessors > 1:
+                ax.set_xlim(0, cols)
+                ax.set_ylim(rows, 0)
+                # rows and cols are from before downsampling, as for the axis limits
+                panels.append([ax, sub_matrix['matrix'], interpolation_method,
+                               zMin[zmin_idx], zMax[zmax_idx], cmap[cmap_idx], rows, cols])
+                # used for the color bars
+                img = matplotlib.cm.ScalarMappable(norm=matplotlib.colors.Normalize(zMin[zmin_idx], zMax[zmax_idx]),
+                                                   cmap=cmap[cmap_idx])
+                img.set_array(sub_matrix['matrix'])
+            else:
+                img = ax.imshow(sub_matrix['matrix'],
+                                aspect='auto',
+                                interpolation=interpolation_method,
+                                origin='upper',
+                                vmin=zMin[zmin_idx],
+                                vmax=zMax[zmax_idx],
+                                cmap=cmap[cmap_idx],
+                                alpha=alpha,
+                                extent=[0, cols, rows, 0])
+                img.set_rasterized(True)
             # plot border at the end of the regions
             # if ordered by length
             if regions_length_in_bins[sample] is not None:
@@ -718,6 +783,28 @@ def plotMatrix(hm, outFileName,
         #  When no box is plotted the space between heatmaps is reduced
         plt.subplots_adjust(wspace=0.05, hspace=0.01, top=0.85, bottom=0, left=0.04, right=0.96)
 
+    if len(panels):
+        # render each heatmap at its final size in pixels
+        tasks = []
+        for ax, matrix, interpolation, vmin, vmax, _cmap, _, _ in panels:
+            bbox = ax.get_position()
+            width = max(1, int(round(bbox.width * total_figwidth * dpi)))
+            height = max(1, int(round(bbox.height * figheight * dpi)))
+            tasks.append((matrix, width, height, interpolation, vmin, vmax, _cmap))
+        pool = multiprocessing.Pool(numberOfProcessors)
+        images = pool.map(renderHeatmap, tasks)
+        pool.close()
+        pool.join()
+        for (ax, _, _, _, _, _, rows, cols), image in zip(panels, images):
+            img = ax.imshow(image,
+                            aspect='auto',
+                            interpolation='nearest',
+                            origin='upper',
+                            alpha=alpha,
+                            extent=[0, cols, rows, 0],
+                            zorder=0)
+            img.set_rasterized(True)
+
     plt.savefig(outFileName, bbox_inches='tight', pdd_inches=0, dpi=dpi, format=image_format)
     plt.close()
 
@@ -758,26 +845,44 @@ def mergeSmallGroups(matrixDict):
     return _mergedHeatMapDict
 
 
+def loadMatrix(matrix_file, float32=False, numberOfProcessors=1):
+    """
+    Reads a matrix file, applying any thresholds that were used when it was created
+    """
+    hm = heatmapper.heatmapper(float32=float32)
+    hm.read_matrix_file(matrix_file, numberOfProcessors=numberOfProcessors)
+
+    if hm.parameters['min threshold'] is not None or hm.parameters['max threshold'] is not None:
+        filterHeatmapValues(hm, hm.parameters['min threshold'], hm.parameters['max threshold'])
+
+    return hm
+
+
 def main(args=None):
     args = process_args(args)
-    hm = heatmapper.heatmapper()
     matrix_file = args.matrixFile.name
     args.matrixFile.close()
-    hm.read_matrix_file(matrix_file)
+    hm = loadMatrix(matrix_file, args.float32, args.numberOfProcessors)
 
-    if hm.parameters['min threshold'] is not None or hm.parameters['max threshold'] is not None:
-        filterHeatmapValues(hm, hm.parameters['min threshold'], hm.parameters['max threshold'])
+    prepareMatrix(hm, args)
+    plot(hm, args)
 
+
+def prepareMatrix(hm, args):
+    """
+    Clusters, relabels and sorts the matrix as specified by args
+    """
     if args.sortRegions == 'keep':
         args.sortRegions = 'no'  # These are the same thing
 
     if args.kmeans is not None:
-        hm.matrix.hmcluster(args.kmeans, method='kmeans')
+        hm.matrix.hmcluster(args.kmeans, method='kmeans', fast=args.fastClustering, numberOfProcessors=args.numberOfProcessors)
     else:
         if args.hclust is not None:
-            print("Performing hierarchical clustering."
-                  "Please note that it might be very slow for large datasets.\n")
-            hm.matrix.hmcluster(args.hclust, method='hierarchical')
+            if not args.fastClustering:
+                print("Performing hierarchical clustering."
+                      "Please note that it might be very slow for large datasets.\n")
+            hm.matrix.hmcluster(args.hclust, method='hierarchical', fast=args.fastClustering, numberOfProcessors=args.numberOfProcessors)
 
     group_len_ratio = np.diff(hm.matrix.group_boundaries) / len(hm.matrix.regions)
     if np.any(group_len_ratio < 5.0 / 1000):
@@ -806,8 +911,13 @@ def main(args=None):
                               sort_method=args.sortRegions,
                               sample_list=sortUsingSamples)
 
+
+def plot(hm, args):
+    """
+    Saves the requested outputs of a prepared matrix
+    """
     if args.outFileNameMatrix:
-        hm.save_matrix_values(args.outFileNameMatrix)
+        hm.save_matrix_values(args.outFileNameMatrix, numberOfProcessors=args.numberOfProcessors)
 
     if args.outFileSortedRegions:
         hm.save_BED(args.outFileSortedRegions)
@@ -837,4 +947,6 @@ def main(args=None):
                box_around_heatmaps=args.boxAroundHeatmaps,
                label_rotation=args.label_rotation,
                dpi=args.dpi,
-               interpolation_method=args.interpolationMethod)
+               interpolation_method=args.interpolationMethod,
+               downsample_rows=args.downsampleRows,
+               numberOfProcessors=args.numberOfProcessors)
@@ -21,7 +21,7 @@ import plotly.graph_objs as go
 # own modules
 from deeptools import parserCommon
 from deeptools import heatmapper
-from deeptools.heatmapper_utilities import plot_single, plotly_single, getProfileTicks
+from deeptools.heatmapper_utilities import plot_single, plotly_single, getProfileTicks, summarizeMatrix
 from deeptools.computeMatrixOperations import filterHeatmapValues
 
 
@@ -150,6 +150,7 @@ class Profile(object):
         self.plots_per_row = plots_per_row
         self.label_rotation = label_rotation
         self.dpi = dpi
+        self.summaries = None
 
         # Honor reference point labels from computeMatrix
         if reference_point_label is None:
@@ -196,6 +197,27 @@ class Profile(object):
         xticks, xtickslabel = getProfileTicks(self.hm, self.reference_point_label[idx], self.start_label[idx], self.end_label[idx], idx)
         return xticks, xtickslabel
 
+    def getSummary(self, group, sample, stat=None):
+        """
+        Returns the per-column summary (by default, averagetype) of a group/sample sub-matrix.
+        All of the summaries are computed on first use (see summarizeMatrix).
+        """
+        if self.summaries is None:
+            self.summaries = summarizeMatrix(self.hm.matrix.matrix,
+                                             self.hm.matrix.group_boundaries,
+                                             self.hm.matrix.sample_boundaries)
+        return self.summaries[(group, sample)][stat or self.averagetype]
+
+    def getError(self, group, sample):
+        """
+        Returns the standard error or deviation to plot around the summary, if plot_type needs one
+        """
+        if self.plot_type == 'se':
+            return self.getSummary(group, sample, 'stderr')
+        elif self.plot_type == 'std':
+            return self.getSummary(group, sample, 'std')
+        return None
+
     @staticmethod
     def cm2inch(*tupl):
         inch = 2.54
@@ -387,11 +409,12 @@ class Profile(object):
                 else:
                     _row, _col = j, i
 
-                ma = self.hm.matrix.get_matrix(_row, _col)['matrix']
-                if np.min(ma) < yMin:
-                    yMin = np.min(ma)
-                if np.max(ma) > yMax:
-                    yMax = np.max(ma)
+                _yMin = np.nanmin(self.getSummary(_row, _col, 'min'))
+                _yMax = np.nanmax(self.getSummary(_row, _col, 'max'))
+                if _yMin < yMin:
+                    yMin = _yMin
+                if _yMax > yMax:
+                    yMax = _yMax
             if self.y_min[i % len(self.y_min)] is not None:
                 yMin = self.y_min[i % len(self.y_min)]
             if self.y_max[i % len(self.y_max)] is not None:
@@ -517,14 +540,12 @@ class Profile(object):
                 if localYMax is None or self.y_max[col % len(self.y_max)] > localYMax:
                     localYMax = self.y_max[col % len(self.y_max)]
 
-                sub_matrix = self.hm.matrix.get_matrix(row, col)
-
                 if self.per_group:
-                    label = sub_matrix['sample']
+                    label = self.hm.matrix.sample_labels[col]
                 else:
-                    label = sub_matrix['group']
+                    label = self.hm.matrix.group_labels[row]
                 labels.append(label)
-                mat.append(np.ma.__getattribute__(self.averagetype)(sub_matrix['matrix'], axis=0))
+                mat.append(self.getSummary(row, col))
 
             img = ax.imshow(np.vstack(mat), interpolation='nearest',
                             cmap='RdYlBu_r', aspect='auto', vmin=localYMin, vmax=localYMax)
@@ -622,18 +643,16 @@ class Profile(object):
                 else:
                     row, col = j, i
 
-                sub_matrix = self.hm.matrix.get_matrix(row, col)
-
                 if self.per_group:
-                    label = sub_matrix['sample']
+                    label = self.hm.matrix.sample_labels[col]
                 else:
-                    label = sub_matrix['group']
+                    label = self.hm.matrix.group_labels[row]
                 labels.append(label)
-                mat.append(np.ma.__getattribute__(self.averagetype)(sub_matrix['matrix'], axis=0))
-                if np.min(mat[-1]) < zmin:
-                    zmin = np.min(mat[-1])
-                if np.max(mat[-1]) > zmax:
-                    zmax = np.max(mat[-1])
+                mat.append(self.getSummary(row, col))
+                if np.nanmin(mat[-1]) < zmin:
+                    zmin = np.nanmin(mat[-1])
+                if np.nanmax(mat[-1]) > zmax:
+                    zmax = np.nanmax(mat[-1])
             totalWidth = len(mat[-1])
             trace = go.Heatmap(name=title, z=mat, x=range(totalWidth + 1), y=labels, xaxis=xanchor, yaxis=yanchor)
             data.append(trace)
@@ -737,7 +756,9 @@ class Profile(object):
                             self.averagetype,
                             self.color_list[coloridx],
                             label,
-                            plot_type=self.plot_type)
+                            plot_type=self.plot_type,
+                            summary=self.getSummary(_row, _col),
+                            error=self.getError(_row, _col))
 
             # remove the numbers of the y axis for all plots
             plt.setp(ax.get_yticklabels(), visible=False)
@@ -865,7 +886,9 @@ class Profile(object):
                                        self.averagetype,
                                        color,
                                        label,
-                                       plot_type=self.plot_type)
+                                       plot_type=self.plot_type,
+                                       summary=self.getSummary(_row, _col),
+                                       error=self.getError(_row, _col))
                 for trace in traces:
                     trace.update(xaxis=xanchor, yaxis=yanchor)
                     if yMin is None or min(trace['y']) < yMin:
@@ -900,23 +923,41 @@ class Profile(object):
         py.plot(fig, filename=self.out_file_name, auto_open=False)
 
 
+def loadMatrix(matrix_file, float32=False, numberOfProcessors=1):
+    """
+    Reads a matrix file, applying any thresholds that were used when it was created
+    """
+    hm = heatmapper.heatmapper(float32=float32)
+    hm.read_matrix_file(matrix_file, numberOfProcessors=numberOfProcessors)
+
+    if hm.parameters['min threshold'] is not None or hm.parameters['max threshold'] is not None:
+        filterHeatmapValues(hm, hm.parameters['min threshold'], hm.parameters['max threshold'])
+
+    return hm
+
+
 def main(args=None):
     args = process_args(args)
-    hm = heatmapper.heatmapper()
     matrix_file = args.matrixFile.name
     args.matrixFile.close()
-    hm.read_matrix_file(matrix_file)
+    hm = loadMatrix(matrix_file, args.float32, args.numberOfProcessors)
 
-    if hm.parameters['min threshold'] is not None or hm.parameters['max threshold'] is not None:
-        filterHeatmapValues(hm, hm.parameters['min threshold'], hm.parameters['max threshold'])
+    prepareMatrix(hm, args)
+    plot(hm, args)
 
+
+def prepareMatrix(hm, args):
+    """
+    Clusters and relabels the matrix as specified by args
+    """
     if args.kmeans is not None:
-        hm.matrix.hmcluster(args.kmeans, method='kmeans')
+        hm.matrix.hmcluster(args.kmeans, method='kmeans', fast=args.fastClustering, numberOfProcessors=args.numberOfProcessors)
     else:
         if args.hclust is not None:
-            print("Performing hierarchical clustering."
-                  "Please note that it might be very slow for large datasets.\n")
-            hm.matrix.hmcluster(args.hclust, method='hierarchical')
+            if not args.fastClustering:
+                print("Performing hierarchical clustering."
+                      "Please note that it might be very slow for large datasets.\n")
+            hm.matrix.hmcluster(args.hclust, method='hierarchical', fast=args.fastClustering, numberOfProcessors=args.numberOfProcessors)
 
     group_len_ratio = np.diff(hm.matrix.group_boundaries) / float(len(hm.matrix.regions))
     if np.any(group_len_ratio < 5.0 / 1000):
@@ -929,6 +970,11 @@ def main(args=None):
     if args.samplesLabel and len(args.samplesLabel):
         hm.matrix.set_sample_labels(args.samplesLabel)
 
+
+def plot(hm, args):
+    """
+    Saves the requested outputs of a prepared matrix
+    """
     if args.outFileNameData:
         hm.save_tabulated_values(args.outFileNameData, reference_point_label=args.refPointLabel,
                                  start_label=args.startLabel,
@@ -0,0 +1,214 @@
+"""
+An on-disk cache of base-resolution bigWig values, used by computeMatrix.
+
+computeMatrix is often run repeatedly on the same bigWig and regions files,
+changing only the upstream/downstream lengths or the bin size. For each region
+and bigWig, the values of the span covering all of the requested zones are
+stored at base resolution, so a later run whose zones fall within an
+already-cached span is computed from the cache rather than from the bigWig.
+
+The cache is organized as one directory per bigWig file (keyed on its path,
+size, modification time and inode) with one file per genomic chunk processed
+by a computeMatrix worker. Since a chunk is only processed by a single worker,
+no locking is needed. Once the whole directory grows beyond a given size, the
+least recently used files are removed (see trimCache).
+"""
+import bisect
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from deeptools.bamStats import fileSignature
+
+# The default maximum size of a cache directory, in megabytes
+MAX_CACHE_SIZE = 1000
+
+
+def bigWigKey(fname):
+    """
+    Returns a key for a bigWig file that changes if the file is modified, or
+    None if the file isn't local (e.g., a URL).
+    """
+    if not os.path.isfile(fname):
+        return None
+    fname = os.path.abspath(fname)
+    key = "\t".join([fname] + [str(x) for x in fileSignature(fname)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class RegionCache(object):
+    """
+    The cached values of a single bigWig file within a single genomic chunk.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> class BW(object):
+    ...     def values(self, chrom, start, end):
+    ...         return [float(x) for x in range(start, end)]
+    >>> c = RegionCache(d, "foo", "chr1", 0, 100000)
+    >>> c.values(BW(), "chr1", 10, 20)[:3]
+    array([10., 11., 12.], dtype=float32)
+    >>> c.save()
+    >>> c = RegionCache(d, "foo", "chr1", 0, 100000)
+    >>> c.values(None, "chr1", 12, 14)  # served from the cache
+    array([12., 13.], dtype=float32)
+    >>> _ = c.values(BW(), "chr1", 5, 50)
+    >>> _ = c.values(BW(), "chr2", 30, 40)
+    >>> c.values(None, "chr1", 30, 40)[[0, -1]]
+    array([30., 39.], dtype=float32)
+    >>> shutil.rmtree(d)
+    """
+
+    def __init__(self, cacheDir, key, chrom, start, end):
+        self.dirName = os.path.join(cacheDir, key)
+        self.fname = os.path.join(self.dirName, "{0}_{1}_{2}.npz".format(chrom, start, end))
+        self.starts = []
+        self.ends = []
+        self.chroms = []
+        self.arrays = []
+        # Per chromosome, the sorted starts of the cached spans and their indices
+        self.index = {}
+        # Per chromosome, the length of the longest cached span
+        self.maxLen = {}
+        self.dirty = False
+        if os.path.exists(self.fname):
+            try:
+                with np.load(self.fname) as fh:
+                    offsets = fh["offsets"]
+                    values = fh["values"]
+                    starts = fh["starts"].tolist()
+                    ends = fh["ends"].tolist()
+                    chroms = fh["chroms"].tolist()
+                for i in range(len(starts)):
+                    self.add(chroms[i], starts[i], ends[i], values[offsets[i]:offsets[i + 1]])
+                # Mark the file as recently used, see trimCache()
+                os.utime(self.fname, None)
+            except Exception:
+                # A corrupt cache file is simply regenerated
+                self.starts = []
+                self.ends = []
+                self.chroms = []
+                self.arrays = []
+                self.index = {}
+                self.maxLen = {}
+
+    def add(self, chrom, start, end, vals):
+        """
+        Add the values of chrom:start-end to the cache
+        """
+        idx = len(self.starts)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.chroms.append(chrom)
+        self.arrays.append(vals)
+        starts, idxs = self.index.setdefault(chrom, ([], []))
+        i = bisect.bisect_right(starts, start)
+        starts.insert(i, start)
+        idxs.insert(i, idx)
+        self.maxLen[chrom] = max(self.maxLen.get(chrom, 0), end - start)
+
+    def values(self, bigwig, chrom, start, end):
+        """
+        Returns the values (as float32) from start to end, reading them from
+        bigwig only if they're not already cached.
+        """
+        if chrom in self.index:
+            starts, idxs = self.index[chrom]
+            # Only a span starting at most maxLen before start can cover start-end
+            lo = bisect.bisect_left(starts, start - self.maxLen[chrom])
+            for i in range(bisect.bisect_right(starts, start) - 1, lo - 1, -1):
+                idx = idxs[i]
+                if self.ends[idx] >= end:
+                    s = self.starts[idx]
+                    return self.arrays[idx][start - s:end - s]
+
+        vals = np.array(bigwig.values(chrom, start, end), dtype=np.float32)
+        self.add(chrom, start, end, vals)
+        self.dirty = True
+        return vals
+
+    def save(self):
+        """
+        Write the cache to disk if anything was added to it. The file is
+        written under a temporary name and then renamed.
+        """
+        if not self.dirty:
+            return
+        if not os.path.exists(self.dirName):
+            try:
+                os.makedirs(self.dirName)
+            except OSError:
+                # Another process may have created it
+                pass
+        offsets = np.cumsum([0] + [len(x) for x in self.arrays])
+        if len(self.arrays):
+            values = np.concatenate(self.arrays)
+        else:
+            values = np.zeros(0, dtype=np.float32)
+        fd, tmpName = tempfile.mkstemp(suffix=".npz", dir=self.dirName)
+        with os.fdopen(fd, "wb") as fh:
+            np.savez(fh,
+                     starts=np.array(self.starts, dtype=np.int64),
+                     ends=np.array(self.ends, dtype=np.int64),
+                     chroms=np.array(self.chroms),
+                     offsets=offsets,
+                     values=values)
+        os.rename(tmpName, self.fname)
+        self.dirty = False
+
+
+def trimCache(cacheDir, maxSize):
+    """
+    Removes the least recently used files of a cache directory until its
+    total size is at most maxSize bytes. The directories of bigWig files
+    that are left without any cached values are removed as well.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> for i, key in enumerate(["a", "b", "c"]):
+    ...     os.mkdir(os.path.join(d, key))
+    ...     fname = os.path.join(d, key, "chr1_0_10.npz")
+    ...     with open(fname, "wb") as fh:
+    ...         _ = fh.write(b"x" * 100)
+    ...     os.utime(fname, (i, i))
+    >>> trimCache(d, 250)
+    >>> sorted(os.listdir(d))
+    ['b', 'c']
+    >>> trimCache(d, 0)
+    >>> os.listdir(d)
+    []
+    >>> shutil.rmtree(d)
+    """
+    if not os.path.isdir(cacheDir):
+        return
+    files = []
+    total = 0
+    for key in os.listdir(cacheDir):
+        dirName = os.path.join(cacheDir, key)
+        if not os.path.isdir(dirName):
+            continue
+        for fname in os.listdir(dirName):
+            fname = os.path.join(dirName, fname)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            files.append((st.st_mtime, fname, st.st_size))
+            total += st.st_size
+
+    files.sort()
+    for _, fname, size in files:
+        if total <= maxSize:
+            break
+        try:
+            os.remove(fname)
+        except OSError:
+            continue
+        total -= size
+        try:
+            # Only succeeds once the directory is empty
+            os.rmdir(os.path.dirname(fname))
+        except OSError:
+            pass
@@ -4,7 +4,7 @@ import time
 
 from deeptools import countReadsPerBin
 from deeptools.utilities import getTLen
-from deeptoolsintervals import GTF
+from deeptoolsintervals import loadIndex
 
 
 class SumCoveragePerBin(countReadsPerBin.CountReadsPerBin):
@@ -53,7 +53,9 @@ class SumCoveragePerBin(countReadsPerBin.CountReadsPerBin):
 
         blackList = None
         if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+            blackList = loadIndex(self.blackListFileName)
+            # Blacklisted regions have a coverage of 0
+            blacklisted = blackList.countOverlaps(chrom, [reg[0] for reg in regions], [reg[1] for reg in regions]) > 0
 
         vector_start = 0
         for idx, reg in enumerate(regions):
@@ -64,8 +66,7 @@ class SumCoveragePerBin(countReadsPerBin.CountReadsPerBin):
                 nRegBins = 1
                 tileSize = int(reg[1] - reg[0])
 
-            # Blacklisted regions have a coverage of 0
-            if blackList and blackList.findOverlaps(chrom, reg[0], reg[1]):
+            if blackList and blacklisted[idx]:
                 continue
             regStart = int(max(0, reg[0] - extension))
             regEnd = reg[1] + int(extension)
@@ -178,6 +178,69 @@ def test_get_num_kept_reads():
         assert num_kept_reads == 1, "num_kept_reads is wrong"
 
 
+def test_get_num_kept_reads_cached():
+    """
+    The mapping statistics, blacklisted reads and fraction kept are cached
+    and give the same results when reused
+    """
+    import deeptools.bamStats as bs
+    for fname in [BAMFILE_FILTER1, CRAMFILE_FILTER1]:
+        args = "--bam {} -o /tmp/test --minMappingQuality 5 --blackListFileName {}".format(fname, BEDFILE_FILTER).split()
+        args = bam_cov.process_args(args)
+        res = [gs.get_num_kept_reads(args, None) for i in range(2)]
+        assert_equal(res[0], res[1])
+        keys = set([x.split(':')[0] for x in bs.loadCache(fname).keys()])
+        assert 'blacklisted' in keys
+        assert 'fractionKept' in keys
+        # The mapping statistics of BAM files come from the index
+        assert_equal('mappingStats' in keys, fname == CRAMFILE_FILTER1)
+
+
+def test_cached_statistics_outdated():
+    """
+    Cached statistics are discarded once the BAM file is touched, even within
+    the same second
+    """
+    import shutil
+    import tempfile
+    import deeptools.bamStats as bs
+    d = tempfile.mkdtemp()
+    fname = os.path.join(d, "test.bam")
+    shutil.copy(BAMFILE_FILTER1, fname)
+    bs.setCached(fname, 'foo', [1, 2])
+    assert_equal(bs.getCached(fname, 'foo'), [1, 2])
+    st = os.stat(fname)
+    os.utime(fname, (st.st_atime, st.st_mtime + 0.001))
+    assert_equal(bs.getCached(fname, 'foo'), None)
+    shutil.rmtree(d)
+
+
+def _setCached(args):
+    import deeptools.bamStats as bs
+    bs.setCached(*args)
+
+
+def test_cached_statistics_concurrent():
+    """
+    Processes caching different statistics of a file at the same time must
+    not overwrite each other's values
+    """
+    import multiprocessing
+    import shutil
+    import tempfile
+    import deeptools.bamStats as bs
+    d = tempfile.mkdtemp()
+    fname = os.path.join(d, "test.bam")
+    shutil.copy(BAMFILE_FILTER1, fname)
+    expected = dict([("key{}".format(i), i) for i in range(100)])
+    pool = multiprocessing.Pool(4)
+    pool.map(_setCached, [(fname, k, v) for k, v in expected.items()], chunksize=1)
+    pool.close()
+    pool.join()
+    assert_equal(bs.loadCache(fname), expected)
+    shutil.rmtree(d)
+
+
 def test_bam_compare_diff_files_skipnas():
     """
     Test skipnas
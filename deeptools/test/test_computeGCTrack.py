@@ -0,0 +1,42 @@
+import os
+import tempfile
+
+import numpy as np
+import py2bit
+from nose.tools import assert_equal
+
+import deeptools.computeGCTrack as gct
+from deeptools.utilities import getGC_contents
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_corrGC/"
+TBIT = ROOT + "sequence.2bit"
+
+
+def test_gc_track_matches_sequence():
+    """
+    The GC track must hold the same counts as utilities.getGC_contents() for
+    every position, with either data type, in several chunks and processes
+    """
+    tbit = py2bit.open(TBIT)
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    chunkSize = gct.CHUNK_SIZE
+    gct.CHUNK_SIZE = 77
+    try:
+        for fragmentLength in [1, 3, 50, 254, 255, 300, 1000, 1001]:
+            for numberOfProcessors in [1, 2]:
+                gct.writeGCTrack(TBIT, fragmentLength, fname, numberOfProcessors=numberOfProcessors)
+                track = gct.openGCTrack(fname)
+                track.check(tbit, fragmentLength)
+                for chrom, size in tbit.chroms().items():
+                    starts = np.arange(-2, size + 2)
+                    gc, valid = getGC_contents(tbit, chrom, starts, fragmentLength, fraction=False)
+                    tgc, tvalid = track.getGC_contents(chrom, starts)
+                    assert np.array_equal(tvalid, valid), fragmentLength
+                    assert np.array_equal(tgc, gc), fragmentLength
+                    assert_equal(track.getGC_content(chrom, 10), gc[12] if valid[12] else None)
+                del track
+    finally:
+        gct.CHUNK_SIZE = chunkSize
+        tbit.close()
+        os.remove(fname)
@@ -6,6 +6,9 @@ import deeptools.plotHeatmap
 import deeptools.plotProfile
 import deeptools.utilities
 import json
+import numpy as np
+import shutil
+import tempfile
 
 __author__ = 'Fidel'
 
@@ -28,6 +31,9 @@ def cmpMatrices(f1, f2):
         if l1.startswith("@"):
             p1 = json.loads(l1[1:])
             p2 = json.loads(l2[1:])
+            # The index of the blocks of the file depends on the compression
+            p1.pop('index', None)
+            p2.pop('index', None)
             for k, v in p1.items():
                 if k not in p2.keys():
                     sys.stderr.write("key in {} missing: {} not in {}\n".format(f1, k, p2.keys()))
@@ -246,3 +252,246 @@ def test_chopRegionsFromMiddle():
     assert(downstream == [(300, 400), (800, 900)])
     assert(padLeft == 100)
     assert(padRight == 50)
+
+
+def test_computeMatrix_binary():
+    args = "reference-point -R {0}/test2.bed -S {0}/test.bw  -b 100 -a 100 " \
+           "--outFileName /tmp/_test.mat -bs 1 -p 1 --matrixFormat binary".format(ROOT).split()
+    deeptools.computeMatrix.main(args)
+    hm = deeptools.heatmapper.heatmapper()
+    hm.read_matrix_file('/tmp/_test.mat')
+    assert hm.matrix_format == 'binary'
+    hm2 = deeptools.heatmapper.heatmapper()
+    hm2.read_matrix_file(ROOT + '/master.mat.gz')
+    assert hm.matrix.regions == hm2.matrix.regions
+    assert hm.matrix.group_boundaries == hm2.matrix.group_boundaries
+    assert np.allclose(hm.matrix.matrix, hm2.matrix.matrix, equal_nan=True)
+
+    # and back to text
+    hm.save_matrix('/tmp/_test.mat.gz', file_format='text')
+    os.system('gunzip -f /tmp/_test.mat.gz')
+    assert cmpMatrices(ROOT + '/master.mat', '/tmp/_test.mat') is True
+    os.remove('/tmp/_test.mat')
+
+
+def test_computeMatrix_float32():
+    args = "reference-point -R {0}/test2.bed -S {0}/test.bw  -b 100 -a 100 " \
+           "--outFileName /tmp/_test.mat.gz -bs 1 -p 1 --float32".format(ROOT).split()
+    deeptools.computeMatrix.main(args)
+    os.system('gunzip -f /tmp/_test.mat.gz')
+    assert cmpMatrices(ROOT + '/master.mat', '/tmp/_test.mat') is True
+    os.remove('/tmp/_test.mat')
+
+    hm = deeptools.heatmapper.heatmapper(float32=True)
+    hm.read_matrix_file(ROOT + '/master.mat.gz')
+    assert hm.matrix.matrix.dtype == np.float32
+    assert not np.ma.isMaskedArray(hm.matrix.matrix)
+    hm2 = deeptools.heatmapper.heatmapper()
+    hm2.read_matrix_file(ROOT + '/master.mat.gz')
+    hm.matrix.sort_groups(sort_using='mean', sort_method='descend')
+    hm2.matrix.sort_groups(sort_using='mean', sort_method='descend')
+    assert hm.matrix.regions == hm2.matrix.regions
+    assert np.allclose(hm.matrix.matrix, hm2.matrix.matrix, equal_nan=True)
+
+
+def test_computeMatrix_regionCache():
+    cacheDir = tempfile.mkdtemp()
+    args = "reference-point -R {0}/test2.bed -S {0}/test.bw  -b 100 -a 100 " \
+           "--outFileName /tmp/_test.mat.gz -bs 1 -p 1 --regionCache {1}".format(ROOT, cacheDir).split()
+    # populate the cache and then use it
+    for i in range(2):
+        deeptools.computeMatrix.main(args)
+        os.system('gunzip -f /tmp/_test.mat.gz')
+        assert cmpMatrices(ROOT + '/master.mat', '/tmp/_test.mat') is True
+        os.remove('/tmp/_test.mat')
+    assert len(os.listdir(cacheDir)) == 1
+
+    # a narrower, re-binned window
+    args = "reference-point -R {0}/test2.bed -S {0}/test.bw  -b 50 -a 50 " \
+           "--outFileName /tmp/_test.mat.gz -bs 10 -p 1".format(ROOT).split()
+    deeptools.computeMatrix.main(args)
+    hm = deeptools.heatmapper.heatmapper()
+    hm.read_matrix_file('/tmp/_test.mat.gz')
+    deeptools.computeMatrix.main(args + ['--regionCache', cacheDir])
+    hm2 = deeptools.heatmapper.heatmapper()
+    hm2.read_matrix_file('/tmp/_test.mat.gz')
+    assert hm.matrix.regions == hm2.matrix.regions
+    assert np.allclose(hm.matrix.matrix, hm2.matrix.matrix, equal_nan=True)
+
+    # the least recently used values are removed beyond --regionCacheSize
+    deeptools.computeMatrix.main(args + ['--regionCache', cacheDir, '--regionCacheSize', '0'])
+    assert os.listdir(cacheDir) == []
+    os.remove('/tmp/_test.mat.gz')
+    shutil.rmtree(cacheDir)
+
+
+def test_hmcluster_fast():
+    for method in ['kmeans', 'hierarchical']:
+        hm = deeptools.heatmapper.heatmapper()
+        hm.read_matrix_file(ROOT + '/master.mat.gz')
+        nRegions = len(hm.matrix.regions)
+        hm.matrix.hmcluster(2, method=method, fast=True, numberOfProcessors=2)
+        assert hm.matrix.group_labels == ['cluster_1', 'cluster_2']
+        assert hm.matrix.group_boundaries[-1] == nRegions
+        assert len(hm.matrix.regions) == nRegions
+
+
+def test_plotBatch():
+    import deeptools.plotBatch
+    plots = [{"tool": "plotProfile", "args": "-o /tmp/_batch1.png --kmeans 2 --outFileSortedRegions /tmp/_batch1.bed"},
+             {"tool": "plotProfile", "args": ["-o", "/tmp/_batch2.png", "--kmeans", "2", "--perGroup"]},
+             {"tool": "plotProfile", "args": "-o /tmp/_batch3.png --outFileSortedRegions /tmp/_batch3.bed"}]
+    with open('/tmp/_batch.json', 'w') as fh:
+        json.dump(plots, fh)
+    deeptools.plotBatch.main("-m {0}/master.mat.gz --plots /tmp/_batch.json".format(ROOT).split())
+    for fname in ['/tmp/_batch1.png', '/tmp/_batch2.png', '/tmp/_batch3.png']:
+        assert os.path.exists(fname)
+        os.remove(fname)
+    # the clustering of the first plot doesn't affect the last
+    assert "cluster_1" in open('/tmp/_batch1.bed').read()
+    assert "cluster_1" not in open('/tmp/_batch3.bed').read()
+    for fname in ['/tmp/_batch.json', '/tmp/_batch1.bed', '/tmp/_batch3.bed']:
+        os.remove(fname)
+
+
+def test_profile_summaries():
+    hm = deeptools.heatmapper.heatmapper()
+    hm.read_matrix_file(ROOT + '/master.mat.gz')
+    prof = deeptools.plotProfile.Profile(hm, '/tmp/_profile.png', averagetype='mean', plot_type='se')
+    for stat in ['mean', 'median', 'max', 'min', 'std', 'sum']:
+        for group in range(hm.matrix.get_num_groups()):
+            for sample in range(hm.matrix.get_num_samples()):
+                ma = hm.matrix.get_matrix(group, sample)['matrix']
+                expected = np.ma.__getattribute__(stat)(ma, axis=0)
+                assert np.allclose(prof.getSummary(group, sample, stat), expected.filled(np.nan), equal_nan=True)
+    ma = hm.matrix.get_matrix(0, 0)['matrix']
+    assert np.allclose(prof.getError(0, 0), np.std(ma, axis=0) / np.sqrt(ma.shape[0]))
+
+
+def test_read_matrix_file_bgzf():
+    import gzip
+    import deeptools.bgzf
+    content = gzip.open(ROOT + '/master.mat.gz').read()
+    with open('/tmp/_test.mat.gz', 'wb') as fh:
+        for i in range(0, len(content), 1000):
+            fh.write(deeptools.bgzf.compressBlock(content[i:i + 1000]))
+    hm = deeptools.heatmapper.heatmapper()
+    hm.read_matrix_file(ROOT + '/master.mat.gz')
+    readBlocks = deeptools.heatmapper.MATRIX_READ_BLOCKS
+    try:
+        # With a single block per batch most rows span several batches
+        for deeptools.heatmapper.MATRIX_READ_BLOCKS in [1, readBlocks]:
+            for float32, numberOfProcessors in [(False, 1), (False, 2), (True, 2)]:
+                for fname in ['/tmp/_test.mat.gz', ROOT + '/master.mat']:
+                    hm2 = deeptools.heatmapper.heatmapper(float32=float32)
+                    hm2.read_matrix_file(fname, numberOfProcessors=numberOfProcessors)
+                    assert hm.matrix.regions == hm2.matrix.regions
+                    assert hm.matrix.group_boundaries == hm2.matrix.group_boundaries
+                    assert np.allclose(hm.matrix.matrix, hm2.matrix.matrix, equal_nan=True)
+    finally:
+        deeptools.heatmapper.MATRIX_READ_BLOCKS = readBlocks
+
+    # a truncated matrix is an error
+    with open('/tmp/_test.mat.gz', 'wb') as fh:
+        fh.write(deeptools.bgzf.compress(b''.join(content.splitlines(True)[:-1])))
+    try:
+        deeptools.heatmapper.heatmapper().read_matrix_file('/tmp/_test.mat.gz')
+        assert False
+    except ValueError:
+        pass
+    os.remove('/tmp/_test.mat.gz')
+
+
+def test_save_matrix_bgzf():
+    import gzip
+    import deeptools.bgzf
+    hm = deeptools.heatmapper.heatmapper()
+    hm.read_matrix_file(ROOT + '/master.mat.gz')
+    hm.save_matrix('/tmp/_test.mat.gz', numberOfProcessors=2)
+    assert deeptools.bgzf.blockOffsets(open('/tmp/_test.mat.gz', 'rb').read()) is not None
+    # The header may be reformatted, but the rows are unchanged
+    assert gzip.open('/tmp/_test.mat.gz').readlines()[1:] == gzip.open(ROOT + '/master.mat.gz').readlines()[1:]
+    hm.save_matrix_values('/tmp/_test.tab.gz', numberOfProcessors=2)
+    hm.save_matrix_values('/tmp/_test.tab')
+    assert gzip.open('/tmp/_test.tab.gz').read() == open('/tmp/_test.tab', 'rb').read()
+    for fname in ['/tmp/_test.mat.gz', '/tmp/_test.tab.gz', '/tmp/_test.tab']:
+        os.remove(fname)
+
+
+def test_read_matrix_subset():
+    import gzip
+    import threading
+    hm = deeptools.heatmapper.heatmapper()
+    hm.read_matrix_file(ROOT + '/master_multi.mat.gz')
+    hm.matrix.group_boundaries = [0, 2, 6]
+    hm.matrix.group_labels = ['a', 'b']
+    blockValues = deeptools.heatmapper.WRITE_BLOCK_VALUES
+    deeptools.heatmapper.WRITE_BLOCK_VALUES = 500
+    hm.save_matrix('/tmp/_test.mat.gz')
+    deeptools.heatmapper.WRITE_BLOCK_VALUES = blockValues
+    params = deeptools.heatmapper.readMatrixParameters('/tmp/_test.mat.gz', withIndex=True)
+    assert len(deeptools.heatmapper.readMatrixIndex('/tmp/_test.mat.gz', params)['rows']) > 2
+    assert 'index' not in deeptools.heatmapper.readMatrixParameters('/tmp/_test.mat.gz')
+    # the index is ignored in a copy of the file that's compressed differently
+    with gzip.open('/tmp/_test_gzip.mat.gz', 'wb') as fh:
+        fh.write(gzip.open('/tmp/_test.mat.gz').read())
+    assert deeptools.heatmapper.readMatrixIndex('/tmp/_test_gzip.mat.gz', params) is None
+    # and there's none if the output isn't seekable
+    os.mkfifo('/tmp/_test_fifo')
+    data = []
+    reader = threading.Thread(target=lambda: data.append(open('/tmp/_test_fifo', 'rb').read()))
+    reader.start()
+    hm.save_matrix('/tmp/_test_fifo')
+    reader.join()
+    with open('/tmp/_test_pipe.mat.gz', 'wb') as fh:
+        fh.write(data[0])
+    params = deeptools.heatmapper.readMatrixParameters('/tmp/_test_pipe.mat.gz', withIndex=True)
+    assert params['index'] is None
+    assert deeptools.heatmapper.readMatrixIndex('/tmp/_test_pipe.mat.gz', params) is None
+    hm.save_matrix('/tmp/_test.bin', file_format='binary')
+    values = np.asarray(hm.matrix.matrix)
+    sb = hm.matrix.sample_boundaries
+    expected = np.vstack([values[2:6], values[0:2]])
+    expected = np.hstack([expected[:, sb[2]:sb[3]], expected[:, sb[0]:sb[1]]])
+    for fname in ['/tmp/_test.mat.gz', '/tmp/_test_gzip.mat.gz', '/tmp/_test_pipe.mat.gz', '/tmp/_test.bin']:
+        hm2 = deeptools.heatmapper.heatmapper()
+        hm2.read_matrix_file(fname, groups=[1, 0], samples=[2, 0])
+        assert hm2.matrix.group_labels == ['b', 'a']
+        assert hm2.matrix.group_boundaries == [0, 4, 6]
+        assert hm2.matrix.sample_labels == [hm.matrix.sample_labels[2], hm.matrix.sample_labels[0]]
+        assert [x[2] for x in hm2.matrix.regions] == [x[2] for x in hm.matrix.regions[2:6] + hm.matrix.regions[0:2]]
+        assert np.allclose(hm2.matrix.matrix, expected, equal_nan=True)
+    for fname in ['/tmp/_test.mat.gz', '/tmp/_test_gzip.mat.gz', '/tmp/_test_fifo', '/tmp/_test_pipe.mat.gz', '/tmp/_test.bin']:
+        os.remove(fname)
+
+
+def test_plotHeatmap_parallel_downsample():
+    """
+    With several processors and --downsampleRows each heatmap still fills its axes
+    """
+    import multiprocessing
+    import matplotlib
+    import matplotlib.pyplot as plt
+    cpu_count = multiprocessing.cpu_count
+    savefig = deeptools.plotHeatmap.plt.savefig
+    checked = []
+
+    def checkExtents(*args, **kwargs):
+        # the figure is checked rather than saved
+        for ax in plt.gcf().axes:
+            for img in ax.get_images():
+                left, right, bottom, top = img.get_extent()
+                assert (left, right) == ax.get_xlim()
+                assert (bottom, top) == ax.get_ylim()
+                checked.append(ax)
+
+    multiprocessing.cpu_count = lambda: 2
+    deeptools.plotHeatmap.plt.savefig = checkExtents
+    try:
+        # plotHeatmap changes the global rcParams, which other tests rely on
+        with matplotlib.rc_context():
+            deeptools.plotHeatmap.main("-m {0}/large_matrix.mat.gz -o /tmp/_test_parallel.png -p 2 --downsampleRows mean --heatmapHeight 3".format(ROOT).split())
+    finally:
+        multiprocessing.cpu_count = cpu_count
+        deeptools.plotHeatmap.plt.savefig = savefig
+    assert len(checked) > 0
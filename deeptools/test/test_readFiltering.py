@@ -53,6 +53,24 @@ def test_estimate_read_filtering_params():
     unlink(outfile)
 
 
+def test_estimate_read_filtering_exact():
+    """
+    Test --exact, whose counts are cached for later runs
+    """
+    import deeptools.bamStats as bs
+    outfile = '/tmp/test_exact.txt'
+    args = '-b {} --minMappingQuality 10 --samFlagExclude 512 --ignoreDuplicates -bl {} --exact -o {}'.format(BAMFILE_FILTER, BEDFILE_FILTER, outfile).split()
+    expected = 'test_filtering.bam\t193\t193\t7\t180.0\t38.0\t0.0\t171.0\t29.0\t0.0\t0.0\t0.0\n'
+    for i in range(2):
+        est.main(args)
+        resp = open(outfile).readlines()[1].split("\t")
+        resp[0] = os.path.basename(resp[0])
+        assert_equal("\t".join(resp), expected)
+        keys = [x for x in bs.loadCache(BAMFILE_FILTER).keys() if x.startswith('filterCounts:')]
+        assert len(keys) > 0
+    unlink(outfile)
+
+
 def test_sieve():
     """
     Test filtering a BAM file by MAPQ, flag, and blacklist
@@ -73,11 +91,11 @@ def test_sieve():
     assert_equal(resp, expected)
     unlink(outlog)
     h = hashlib.md5(open(outfile, "rb").read()).hexdigest()
-    assert(h == "977bdab227a4dbfa3fc9f27c23a3e0b7")
+    assert(h == "3ff11cf63032ced419af0e9fec869bb3")
     unlink(outfile)
 
     h = hashlib.md5(open(outfiltered, "rb").read()).hexdigest()
-    assert(h == "762e79b7a2245ff6b2cea4139a1455de")
+    assert(h == "7eb4e11cd9b13acb43e49375d76626cd")
     unlink(outfiltered)
 
 
@@ -161,3 +179,58 @@ def test_sieve_BED_shift():
 
     assert_equal(resp, expected)
     unlink(outfile)
+
+
+def test_sieve_outputs():
+    """
+    Test alignmentSieve --outputs, which must give the same results as separate
+    runs. The filters on the command line are the defaults of each output.
+    """
+    outputs = [('--BED -o /tmp/test_sieve_outputs_1.bed', '/tmp/test_sieve_outputs_1.bed', None),
+               ('--BED --shift 1 -2 3 -4 -o /tmp/test_sieve_outputs_2.bed', '/tmp/test_sieve_outputs_2.bed', None),
+               ('--maxFragmentLength 160 --ignoreDuplicates -o /tmp/test_sieve_outputs_3.bam '
+                '--filterMetrics /tmp/test_sieve_outputs_3.log', '/tmp/test_sieve_outputs_3.log', 'short')]
+    jsonFile = '/tmp/test_sieve_outputs.json'
+    with open(jsonFile, 'w') as fh:
+        fh.write('[' + ', '.join(['{{"args": "{}", "label": "{}"}}'.format(x, label) if label else '{{"args": "{}"}}'.format(x)
+                                  for x, _, label in outputs]) + ']')
+    sieve.main('-b {} --maxFragmentLength 350 --outputs {}'.format(PAIREDBAMFILE_FILTER, jsonFile).split())
+    together = []
+    for _, fname, _ in outputs:
+        together.append(open(fname).read())
+        unlink(fname)
+    # The command line filter removes 12 of the 25 fragments, the one of the last output overrides it
+    assert_equal(len(together[0].splitlines()), 13)
+    assert_equal(together[2].splitlines()[-1], 'short\t8\t49')
+
+    for (args, fname, label), expected in zip(outputs, together):
+        if label:
+            args += ' --label ' + label
+        sieve.main('-b {} --maxFragmentLength 350 {}'.format(PAIREDBAMFILE_FILTER, args).split())
+        assert_equal(open(fname).read(), expected)
+        unlink(fname)
+    unlink('/tmp/test_sieve_outputs_3.bam')
+    unlink(jsonFile)
+
+
+def test_sieve_fragmentCoverage():
+    """
+    Test alignmentSieve --fragmentCoverage, which must match the pileup of the --BED output
+    """
+    import numpy as np
+    import pyBigWig
+    outfile = '/tmp/test_sieve_coverage.bed'
+    bwfile = '/tmp/test_sieve_coverage.bw'
+    args = '-b {} --minMappingQuality 10 --BED -o {} --shift 1 -2 3 -4 --fragmentCoverage {}'.format(PAIREDBAMFILE_FILTER, outfile, bwfile).split()
+    sieve.main(args)
+
+    expected = np.zeros(5002000, dtype=np.int64)
+    for line in open(outfile):
+        chrom, start, end = line.split()
+        expected[int(start):int(end)] += 1
+    bw = pyBigWig.open(bwfile)
+    values = np.nan_to_num(bw.values('chr2', 5000000, 5002000, numpy=True))
+    bw.close()
+    assert_equal(values.tolist(), expected[5000000:].tolist())
+    unlink(outfile)
+    unlink(bwfile)
@@ -1,6 +1,6 @@
 import sys
 import os
-from deeptoolsintervals import GTF
+from deeptoolsintervals import loadIndex
 from deeptools.bamHandler import openBam
 import matplotlib as mpl
 mpl.use('Agg')
@@ -88,6 +88,64 @@ def getGC_content(tb, chrom, fragStart, fragEnd, fraction=True):
     return bases['G'] + bases['C']
 
 
+def getGC_contents(tb, chrom, starts, length, fraction=True):
+    """
+    getGC_content() for many windows [starts[i], starts[i] + length) on a
+    chromosome. The sequence spanning all of them is fetched only once and
+    the G/C and non-N bases of each window are then the differences of
+    cumulative counts.
+
+    The windows may also have different lengths, if length is an array.
+
+    Returns the GC content of each window and whether it's valid, which is
+    the case if it isn't empty, lies within the chromosome and at least 95%
+    of its bases aren't N. The GC content of invalid windows is 0.
+
+    >>> import py2bit
+    >>> tb = py2bit.open(os.path.dirname(os.path.abspath(__file__)) + "/test/test_corrGC/sequence.2bit")
+    >>> gc, valid = getGC_contents(tb, 'chr2L', [0, 2, 4, 6, 8], 3, fraction=False)
+    >>> gc
+    array([2, 1, 1, 2, 2])
+    >>> gc[1] == getGC_content(tb, 'chr2L', 2, 5, fraction=False)
+    True
+    >>> getGC_contents(tb, 'chr2L', [0, tb.chroms('chr2L') - 2], 3)[1]
+    array([ True, False])
+    >>> getGC_contents(tb, 'chr2L', [0, 2, 2], [3, 5, 0], fraction=False)
+    (array([2, 2, 0]), array([ True,  True, False]))
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    length = np.broadcast_to(np.asarray(length, dtype=np.int64), starts.shape)
+    valid = (starts >= 0) & (length > 0) & (starts + length <= tb.chroms(chrom))
+    if fraction:
+        gc = np.zeros(len(starts))
+    else:
+        gc = np.zeros(len(starts), dtype=np.int64)
+    if not np.any(valid):
+        return gc, valid
+
+    lo = int(starts[valid].min())
+    seq = tb.sequence(chrom, lo, int((starts + length)[valid].max()))
+    if not isinstance(seq, bytes):
+        seq = seq.encode('ascii')
+    # Clearing the 0x20 bit converts lower case to upper case
+    seq = np.frombuffer(seq, dtype=np.uint8) & 0xDF
+    gcCum = np.zeros(len(seq) + 1, dtype=np.int64)
+    np.cumsum((seq == ord('G')) | (seq == ord('C')), out=gcCum[1:])
+    nonNCum = np.zeros(len(seq) + 1, dtype=np.int64)
+    np.cumsum(seq != ord('N'), out=nonNCum[1:])
+
+    offsets = starts[valid] - lo
+    length = length[valid]
+    nonN = nonNCum[offsets + length] - nonNCum[offsets]
+    counts = gcCum[offsets + length] - gcCum[offsets]
+    if fraction:
+        counts = counts / length.astype(float)
+    gc[valid] = counts
+    valid[valid] = nonN >= 0.95 * length
+    gc[~valid] = 0
+    return gc, valid
+
+
 def tbitToBamChrName(tbitNames, bamNames):
     """ checks if the chromosome names from the two-bit and bam file coincide.
         In case they do not coincide, a fix is tried. If successful, then
@@ -363,27 +421,41 @@ def bam_blacklisted_reads(bam_handle, chroms_to_ignore, blackListFileName=None,
     # Get the chromosome lengths
     chromLens = {x: y for x, y in zip(bam_handle.references, bam_handle.lengths)}
 
-    bl = GTF(blackListFileName)
+    bl = loadIndex(blackListFileName)
     hasOverlaps, minOverlap = bl.hasOverlaps(returnDistance=True)
     if hasOverlaps:
         sys.exit("Your blacklist file(s) has (have) regions that overlap. Proceeding with such a file would result in deepTools incorrectly calculating scaling factors. As such, you MUST fix this issue before being able to proceed.\n")
     if minOverlap < 1000:
         sys.stderr.write("WARNING: The minimum distance between intervals in your blacklist is {}. It makes little biological sense to include small regions between two blacklisted regions. Instead, these should likely be blacklisted as well.\n".format(minOverlap))
 
-    regions = []
-    for chrom in bl.chroms:
-        if (not chroms_to_ignore or chrom not in chroms_to_ignore) and chrom in chromLens:
-            for reg in bl.findOverlaps(chrom, 0, chromLens[chrom]):
-                regions.append([bam_handle.filename, chrom, reg[0], reg[1]])
-
-    if len(regions) > 0:
-        import multiprocessing
-        if len(regions) > 1 and numberOfProcessors > 1:
-            pool = multiprocessing.Pool(numberOfProcessors)
-            res = pool.map_async(bam_blacklisted_worker, regions).get(9999999)
-        else:
-            res = [bam_blacklisted_worker(x) for x in regions]
-        for val in res:
+    # The counts per chromosome are cached, see bamStats
+    from deeptools import bamStats
+    key = 'blacklisted:' + bamStats.blackListKey(blackListFileName)
+    counts = bamStats.getCached(bam_handle.filename, key)
+    if counts is None:
+        regions = []
+        for chrom in bl.chroms:
+            if chrom in chromLens:
+                for reg in bl.findOverlaps(chrom, 0, chromLens[chrom]):
+                    regions.append([bam_handle.filename, chrom, reg[0], reg[1]])
+
+        res = []
+        if len(regions) > 0:
+            import multiprocessing
+            if len(regions) > 1 and numberOfProcessors > 1:
+                pool = multiprocessing.Pool(numberOfProcessors)
+                res = pool.map_async(bam_blacklisted_worker, regions).get(9999999)
+                pool.close()
+                pool.join()
+            else:
+                res = [bam_blacklisted_worker(x) for x in regions]
+        counts = dict()
+        for reg, val in zip(regions, res):
+            counts[reg[1]] = counts.get(reg[1], 0) + val
+        bamStats.setCached(bam_handle.filename, key, counts)
+
+    for chrom, val in counts.items():
+        if not chroms_to_ignore or chrom not in chroms_to_ignore:
             blacklisted += val
 
     return blacklisted
@@ -1,2 +1,3 @@
 from deeptoolsintervals.parse import GTF
 from deeptoolsintervals.enrichment import Enrichment
+from deeptoolsintervals.index import loadIndex
@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+"""
+Serialized interval indices, which are opened with mmap rather than parsed.
+
+A finished GTF or Enrichment object is written as a small JSON header
+followed by flat arrays: for each chromosome the entries sorted by start,
+with their ends, the running maximum of the ends ("max-end", which allows
+finding all overlaps with two binary searches), group/feature indices,
+strands, scores, names and exons. Opening such a file only reads the header,
+the arrays are memory mapped and so shared between processes.
+
+loadIndex() keeps these files in a cache directory, keyed on the input files
+and parsing options, so the BED/GTF files are only parsed the first time
+they're used (e.g., by the first of several worker processes or runs).
+"""
+import bisect
+import hashlib
+import json
+import os
+import stat
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+from deeptoolsintervals.parse import GTF
+from deeptoolsintervals.enrichment import Enrichment
+
+MAGIC = b'DTINTIDX'
+VERSION = 1
+
+# The largest end position a tree can hold
+MAX_END = 4294967295
+
+
+def _align(x):
+    return x + (-x % 8)
+
+
+def _sequence(arr):
+    """
+    bisect is much faster on a memoryview than on a numpy array (python 3 only)
+    """
+    if sys.version_info[0] >= 3:
+        return memoryview(arr)
+    return arr
+
+
+def _uniqueChroms(chroms):
+    seen = set()
+    return [c for c in chroms if not (c in seen or seen.add(c))]
+
+
+def _entries(obj, chrom):
+    """
+    All of the entries in a tree on a given chromosome, as
+    (start, end, name, label/feature index, strand, score), sorted by start
+    """
+    t = obj.tree
+    overlaps = t.findOverlaps(chrom, 0, MAX_END, 0, 0, 0, "transcript_id", True)
+    if isinstance(obj, Enrichment):
+        features = t.findOverlappingFeatures(chrom, 0, MAX_END, 0, 0, 0) or []
+        overlaps = [(o[0], o[1], None, f, o[4], o[5]) for o, f in zip(overlaps, features)]
+    entries = []
+    for o in overlaps:
+        strand = o[4]
+        if not isinstance(strand, str):
+            strand = strand.decode("ascii")
+        entries.append((o[0], o[1], o[2], o[3], {'+': 0, '-': 1}.get(strand, 3), o[5]))
+    return sorted(entries, key=lambda x: (x[0], x[1]))
+
+
+def _indexArrays(obj):
+    """
+    The header and (name, array) list of the index of a GTF or Enrichment object
+    """
+    isEnrichment = isinstance(obj, Enrichment)
+    chroms = _uniqueChroms(obj.chroms)
+    featureTable = list(obj.features) if isEnrichment else []
+    featureIdx = {x: i for i, x in enumerate(featureTable)}
+
+    chromOffsets = [0]
+    starts, ends, maxEnds, groups, strands, scores = [], [], [], [], [], []
+    names, nameOffsets = [], [0]
+    exonStarts, exonEnds, exonOffsets = [], [], [0]
+    for chrom in chroms:
+        maxEnd = 0
+        for start, end, name, group, strand, score in _entries(obj, chrom):
+            maxEnd = max(maxEnd, end)
+            starts.append(start)
+            ends.append(end)
+            maxEnds.append(maxEnd)
+            strands.append(strand)
+            scores.append(np.nan if score == '.' else score)
+            if isEnrichment:
+                if group not in featureIdx:
+                    featureIdx[group] = len(featureTable)
+                    featureTable.append(group)
+                groups.append(featureIdx[group])
+                continue
+            groups.append(group)
+            name = name.encode("utf-8")
+            names.append(name)
+            nameOffsets.append(nameOffsets[-1] + len(name))
+            # Only exons that differ from the entry bounds are stored
+            exons = obj.exons[group].get(name.decode("utf-8"))
+            if exons and sorted(exons) != [(start, end)]:
+                for s, e in sorted(exons):
+                    exonStarts.append(s)
+                    exonEnds.append(e)
+            exonOffsets.append(len(exonStarts))
+        chromOffsets.append(len(starts))
+
+    arrays = [('chromOffsets', np.array(chromOffsets, dtype=np.int64)),
+              ('starts', np.array(starts, dtype=np.uint32)),
+              ('ends', np.array(ends, dtype=np.uint32)),
+              ('maxEnds', np.array(maxEnds, dtype=np.uint32)),
+              ('groups', np.array(groups, dtype=np.int32)),
+              ('strands', np.array(strands, dtype=np.int8)),
+              ('scores', np.array(scores, dtype=np.float64))]
+    if not isEnrichment:
+        arrays.extend([('names', np.frombuffer(b''.join(names), dtype=np.uint8)),
+                       ('nameOffsets', np.array(nameOffsets, dtype=np.int64)),
+                       ('exonStarts', np.array(exonStarts, dtype=np.uint32)),
+                       ('exonEnds', np.array(exonEnds, dtype=np.uint32)),
+                       ('exonOffsets', np.array(exonOffsets, dtype=np.int64))])
+
+    header = {'version': VERSION,
+              'type': 'Enrichment' if isEnrichment else 'GTF',
+              'chroms': chroms,
+              'allChroms': list(obj.chroms),
+              'labels': list(getattr(obj, 'labels', [])),
+              'features': list(obj.features) if isEnrichment else [],
+              'featureTable': featureTable,
+              'arrays': []}
+    return header, arrays
+
+
+def saveIndex(obj, fname):
+    """
+    Write a GTF or Enrichment object (after it has been created) to fname,
+    which can later be opened with openIndex().
+    """
+    header, arrays = _indexArrays(obj)
+    offset = 0
+    for name, arr in arrays:
+        header['arrays'].append([name, arr.dtype.str, len(arr), offset])
+        offset = _align(offset + arr.nbytes)
+    header = json.dumps(header).encode("utf-8")
+
+    with open(fname, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<Q", len(header)))
+        fh.write(header)
+        fh.write(b'\0' * (_align(fh.tell()) - fh.tell()))
+        for name, arr in arrays:
+            fh.write(arr.tobytes())
+            fh.write(b'\0' * (_align(fh.tell()) - fh.tell()))
+
+
+def openIndex(fname):
+    """
+    Open an index written by saveIndex(), returning an IndexedGTF or
+    IndexedEnrichment object.
+    """
+    with open(fname, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise IOError("{} is not an interval index".format(fname))
+        hLen = struct.unpack("<Q", fh.read(8))[0]
+        header = json.loads(fh.read(hLen).decode("utf-8"))
+    if header['version'] != VERSION:
+        raise IOError("{} has an unsupported version ({})".format(fname, header['version']))
+
+    dataStart = _align(len(MAGIC) + 8 + hLen)
+    mm = np.memmap(fname, dtype=np.uint8, mode='r')
+    arrays = dict()
+    for name, dtype, n, offset in header['arrays']:
+        dtype = np.dtype(dtype)
+        offset += dataStart
+        arrays[name] = mm[offset:offset + n * dtype.itemsize].view(dtype)
+
+    return _indexed(header, arrays)
+
+
+def _indexed(header, arrays):
+    if header['type'] == 'Enrichment':
+        return IndexedEnrichment(header, arrays)
+    return IndexedGTF(header, arrays)
+
+
+def indexObject(obj):
+    """
+    As openIndex(saveIndex(obj, fname)), but with the arrays held in memory
+    rather than written to a file.
+    """
+    header, arrays = _indexArrays(obj)
+    return _indexed(header, dict(arrays))
+
+
+class IndexedGTF(GTF):
+    """
+    A read-only GTF object backed by a memory mapped index. Only matchType=0
+    and strandType=0 (the defaults) are supported by findOverlaps().
+
+    >>> from deeptoolsintervals import parse, index
+    >>> from os.path import dirname
+    >>> import tempfile, os
+    >>> fname = "{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__))
+    >>> gtf = parse.GTF(fname, keepExons=True)
+    >>> fd, iname = tempfile.mkstemp()
+    >>> os.close(fd)
+    >>> index.saveIndex(gtf, iname)
+    >>> idx = index.openIndex(iname)
+    >>> idx.findOverlaps("1", 1, 20000) == gtf.findOverlaps("1", 1, 20000)
+    True
+    >>> idx.findOverlaps("chr1", 12000, 20000, trimOverlap=True, numericGroups=True, includeStrand=True)
+    [(12009, 13670, 'ENST00000450305', 0, [(12009, 12057), (12178, 12227), (12612, 12697), (12974, 13052), (13220, 13374), (13452, 13670)], '+', '.'), (14403, 29570, 'ENST00000488147', 0, [(14403, 14501), (15004, 15038), (15795, 15947), (16606, 16765), (16857, 17055), (17232, 17368), (17605, 17742), (17914, 18061), (18267, 18366), (24737, 24891), (29533, 29570)], '-', '.'), (17368, 17436, 'ENST00000619216', 1, [(17368, 17436)], '-', '.')]
+    >>> idx.findOverlaps("2", 1, 20000)
+    []
+    >>> idx.labels == gtf.labels
+    True
+    >>> gtf = parse.GTF(["{0}/test/noOverlaps.bed".format(dirname(parse.__file__))])
+    >>> index.saveIndex(gtf, iname)
+    >>> index.openIndex(iname).hasOverlaps(returnDistance=True)
+    (False, 9)
+    >>> os.remove(iname)
+    """
+
+    def __init__(self, header, arrays):
+        self.chroms = header['allChroms']
+        self.labels = header['labels']
+        self.chromIdx = {x: i for i, x in enumerate(header['chroms'])}
+        self.arrays = arrays
+        self.chromOffsets = arrays['chromOffsets'].tolist()
+        self.starts = _sequence(arrays['starts'])
+        self.ends = _sequence(arrays['ends'])
+        self.maxEnds = _sequence(arrays['maxEnds'])
+        self.groups = _sequence(arrays['groups'])
+        self.strands = _sequence(arrays['strands'])
+        self.scores = _sequence(arrays['scores'])
+        if 'names' in arrays:
+            self.names = _sequence(arrays['names'])
+            self.nameOffsets = _sequence(arrays['nameOffsets'])
+            self.exonStarts = _sequence(arrays['exonStarts'])
+            self.exonEnds = _sequence(arrays['exonEnds'])
+            self.exonOffsets = _sequence(arrays['exonOffsets'])
+
+    def countEntries(self):
+        return self.chromOffsets[-1]
+
+    def overlapping(self, chrom, start, end):
+        """
+        The indices of the entries overlapping [start, end)
+        """
+        idx = self.chromIdx.get(chrom)
+        if idx is None:
+            return []
+        lo = self.chromOffsets[idx]
+        hi = bisect.bisect_left(self.starts, end, lo, self.chromOffsets[idx + 1])
+        lo = bisect.bisect_right(self.maxEnds, start, lo, hi)
+        ends = self.ends
+        return [i for i in range(lo, hi) if ends[i] > start]
+
+    def overlapsCSR(self, chrom, starts, ends, maxCandidates=1 << 22):
+        """
+        The batch version of overlapping(), for many intervals [starts[i],
+        ends[i]) on one chromosome. The result is in CSR form, a tuple of
+        (offsets, indices) where the entries overlapping interval i are
+        indices[offsets[i]:offsets[i + 1]], sorted by start.
+
+        The candidates for each interval are found with two vectorized binary
+        searches and then filtered on their ends. maxCandidates bounds how many
+        of these are held in memory at once.
+
+        >>> from deeptoolsintervals import parse, index
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.bed".format(dirname(parse.__file__)))
+        >>> idx = index.indexObject(gtf)
+        >>> offsets, indices = idx.overlapsCSR("chr1", [0, 12000, 14000], [100, 12010, 15000])
+        >>> offsets
+        array([0, 0, 2, 4])
+        >>> [idx.starts[i] for i in indices]
+        [11868, 12009, 11868, 14403]
+        >>> idx.countOverlaps("1", [0, 12000, 14000], [100, 12010, 15000])
+        array([0, 2, 2])
+        >>> idx.countOverlaps("foo", [0], [100])
+        array([0])
+        """
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, MAX_END)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), 0, MAX_END)
+        n = len(starts)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        idx = None
+        chrom = self.mungeChromosome(chrom, append=False)
+        if chrom:
+            idx = self.chromIdx.get(chrom)
+        if idx is None or n == 0:
+            return offsets, np.zeros(0, dtype=np.int64)
+
+        lo0 = self.chromOffsets[idx]
+        hi0 = self.chromOffsets[idx + 1]
+        # Entries before lo end before the start, those from hi start after the end
+        hi = np.searchsorted(self.arrays['starts'][lo0:hi0], ends.astype(np.uint32), side='left')
+        lo = np.searchsorted(self.arrays['maxEnds'][lo0:hi0], starts.astype(np.uint32), side='right')
+        lo = np.minimum(lo, hi)
+        nCandidates = hi - lo
+        cumCandidates = np.cumsum(nCandidates)
+
+        counts = []
+        indices = []
+        i = 0
+        while i < n:
+            base = cumCandidates[i - 1] if i > 0 else 0
+            j = max(i + 1, int(np.searchsorted(cumCandidates, base + maxCandidates, side='right')))
+            nc = nCandidates[i:j]
+            query = np.repeat(np.arange(j - i), nc)
+            candidates = np.arange(cumCandidates[j - 1] - base) - np.repeat(cumCandidates[i:j] - nc - base, nc) + np.repeat(lo[i:j] + lo0, nc)
+            keep = self.arrays['ends'][candidates] > starts[i:j][query]
+            counts.append(np.bincount(query[keep], minlength=j - i))
+            indices.append(candidates[keep])
+            i = j
+        np.cumsum(np.concatenate(counts), out=offsets[1:])
+        return offsets, np.concatenate(indices).astype(np.int64)
+
+    def countOverlaps(self, chrom, starts, ends):
+        """
+        The number of entries overlapping each of the intervals [starts[i], ends[i])
+        """
+        return np.diff(self.overlapsCSR(chrom, starts, ends)[0])
+
+    def score(self, i):
+        score = self.scores[i]
+        if score != score:
+            return '.'
+        return score
+
+    def findOverlaps(self, chrom, start, end, strand=".", matchType=0, strandType=0, trimOverlap=False, numericGroups=False, includeStrand=False):
+        """
+        As GTF.findOverlaps()
+        """
+        if matchType != 0 or strandType != 0:
+            raise NotImplementedError("Only matchType=0 and strandType=0 are supported by an IndexedGTF")
+        chrom = self.mungeChromosome(chrom, append=False)
+        if not chrom:
+            return None
+        if self.countEntries() == 0:
+            return None
+
+        overlaps = []
+        for i in self.overlapping(chrom, start, end):
+            s = self.starts[i]
+            e = self.ends[i]
+            name = bytes(self.names[self.nameOffsets[i]:self.nameOffsets[i + 1]]).decode("utf-8")
+            group = self.groups[i]
+            if self.exonOffsets[i] == self.exonOffsets[i + 1]:
+                exons = [(s, e)]
+            else:
+                exons = list(zip(self.exonStarts[self.exonOffsets[i]:self.exonOffsets[i + 1]],
+                                 self.exonEnds[self.exonOffsets[i]:self.exonOffsets[i + 1]]))
+            if not numericGroups:
+                group = self.labels[group]
+            o = (s, e, name, group, exons)
+            if includeStrand:
+                o = o + ({0: '+', 1: '-'}.get(self.strands[i], '.'),)
+            overlaps.append(o + (self.score(i),))
+
+        overlaps = sorted(overlaps)
+
+        if trimOverlap:
+            while len(overlaps) > 0 and overlaps[0][0] < start:
+                del overlaps[0]
+
+        return overlaps
+
+    def hasOverlaps(self, returnDistance=False):
+        """
+        As GTF.hasOverlaps()
+        """
+        overlaps = False
+        minDistance = MAX_END
+        for i in range(len(self.chromOffsets) - 1):
+            lo = self.chromOffsets[i]
+            hi = self.chromOffsets[i + 1]
+            if hi - lo < 2:
+                continue
+            starts = self.arrays['starts'][lo:hi].astype(np.int64)
+            ends = self.arrays['ends'][lo:hi].astype(np.int64)
+            if np.any(starts[1:] < ends[:-1]):
+                overlaps = True
+                minDistance = 0
+                break
+            minDistance = min(minDistance, starts[0], np.min(starts[1:] - ends[:-1]))
+        if returnDistance:
+            return (overlaps, int(minDistance))
+        return overlaps
+
+
+class IndexedEnrichment(IndexedGTF):
+    """
+    A read-only Enrichment object backed by a memory mapped index.
+
+    >>> from deeptoolsintervals import enrichment, index
+    >>> from os.path import dirname
+    >>> import tempfile, os
+    >>> fname = "{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__))
+    >>> gtf = enrichment.Enrichment(fname)
+    >>> fd, iname = tempfile.mkstemp()
+    >>> os.close(fd)
+    >>> index.saveIndex(gtf, iname)
+    >>> idx = index.openIndex(iname)
+    >>> idx.findOverlaps("1", [(0, 2000000)]) == gtf.findOverlaps("1", [(0, 2000000)])
+    True
+    >>> idx.findOverlaps("chr1", [(11000, 11100), (11868, 11869)]) == gtf.findOverlaps("chr1", [(11000, 11100), (11868, 11869)])
+    True
+    >>> idx.features == gtf.features
+    True
+    >>> os.remove(iname)
+    """
+
+    def __init__(self, header, arrays):
+        IndexedGTF.__init__(self, header, arrays)
+        self.features = header['features']
+        self.featureTable = header['featureTable']
+
+    def findOverlaps(self, chrom, blocks, strand=".", matchType=0, strandType=0):
+        """
+        As Enrichment.findOverlaps()
+        """
+        if matchType != 0 or strandType != 0:
+            raise NotImplementedError("Only matchType=0 and strandType=0 are supported by an IndexedEnrichment")
+        chrom = self.mungeChromosome(chrom, append=False)
+        if not chrom:
+            return None
+        if self.countEntries() == 0:
+            return None
+
+        features = set()
+        for block in blocks:
+            for i in self.overlapping(chrom, int(block[0]), int(block[1])):
+                features.add(self.featureTable[self.groups[i]])
+        return frozenset(features)
+
+    def featureCounts(self, chrom, starts, ends, queryIds=None):
+        """
+        For each feature in featureTable, the number of the intervals [starts[i],
+        ends[i]) that overlap it. Intervals sharing a queryId (e.g., the blocks
+        of a single read) are counted once per feature.
+
+        >>> from deeptoolsintervals import enrichment, index
+        >>> from os.path import dirname
+        >>> gtf = enrichment.Enrichment("{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__)))
+        >>> idx = index.indexObject(gtf)
+        >>> counts = idx.featureCounts("1", [11868, 11868, 11000], [11869, 11869, 11100], [0, 0, 1])
+        >>> sorted((idx.featureTable[i], int(c)) for i, c in enumerate(counts) if c)
+        [('exon', 1), ('gene', 1), ('group 1', 1)]
+        """
+        offsets, indices = self.overlapsCSR(chrom, starts, ends)
+        nFeatures = len(self.featureTable)
+        if queryIds is None:
+            queryIds = np.arange(len(offsets) - 1)
+        queryIds = np.repeat(np.asarray(queryIds, dtype=np.int64), np.diff(offsets))
+        pairs = np.unique(queryIds * nFeatures + self.arrays['groups'][indices])
+        return np.bincount(pairs % nFeatures, minlength=nFeatures)
+
+
+def cacheDirectory():
+    """
+    The default directory holding cached indices, which is the "intervals"
+    subdirectory of $DEEPTOOLS_CACHE_DIR (~/.cache/deeptools by default), as
+    for the other caches of deepTools. None if $DEEPTOOLS_CACHE_DIR is set to
+    an empty value, which disables the cache.
+    """
+    d = os.environ.get('DEEPTOOLS_CACHE_DIR')
+    if d is None:
+        d = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'deeptools')
+    if not d:
+        return None
+    return os.path.join(d, "intervals")
+
+
+def privateDirectory(d):
+    """
+    Creates the directory d if needed and returns whether it can be trusted
+    to hold cached files: it must be a directory (not a symbolic link), owned
+    by the current user and not writable by the group or others.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> privateDirectory(os.path.join(d, "a", "b"))
+    True
+    >>> os.chmod(d, 0o777)
+    >>> privateDirectory(d)
+    False
+    >>> shutil.rmtree(d)
+    """
+    if not os.path.lexists(d):
+        try:
+            os.makedirs(d, 0o700)
+        except OSError:
+            # Another process may have created it
+            pass
+    try:
+        st = os.lstat(d)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        return False
+    return st.st_mode & 0o022 == 0
+
+
+def indexKey(fnames, cls, kwargs):
+    """
+    A key for the index of fnames parsed by cls(fnames, **kwargs), which
+    changes if any of the files is modified. None if they're not all local files.
+    """
+    key = [VERSION, cls.__name__, sorted(kwargs.items())]
+    for fname in fnames:
+        if not os.path.isfile(fname):
+            return None
+        st = os.stat(fname)
+        mtime = getattr(st, "st_mtime_ns", st.st_mtime)
+        key.append([os.path.abspath(fname), st.st_size, mtime, st.st_ino])
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def loadIndex(fnames, cls=GTF, cacheDir=None, **kwargs):
+    """
+    Returns the intervals in fnames, as parsed by cls(fnames, **kwargs) where
+    cls is GTF or Enrichment, as an IndexedGTF or IndexedEnrichment. The
+    serialized index is kept in cacheDir (by default, cacheDirectory()) and
+    only created if it doesn't already exist there. If caching is disabled,
+    cacheDir isn't private to the current user (see privateDirectory()) or
+    can't be written to, or fnames aren't all regular files, then the index
+    is instead held in memory.
+
+    >>> from deeptoolsintervals import parse, index
+    >>> from os.path import dirname
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> fname = "{0}/test/GRCh38.84.bed".format(dirname(parse.__file__))
+    >>> idx = index.loadIndex(fname, cacheDir=d, defaultGroup="foo")
+    >>> idx.findOverlaps("1", 1, 12500, numericGroups=True)
+    [(11868, 14409, '1:11868-14409', 0, [(11868, 14409)], '.'), (12009, 13670, '1:12009-13670', 0, [(12009, 13670)], '.')]
+    >>> len(os.listdir(d))
+    1
+    >>> idx = index.loadIndex([fname], cacheDir=d, defaultGroup="foo")  # from the cache
+    >>> len(os.listdir(d))
+    1
+    >>> shutil.rmtree(d)
+    """
+    if not isinstance(fnames, list):
+        fnames = [fnames]
+    key = indexKey(fnames, cls, kwargs)
+    if key is None:
+        return indexObject(cls(fnames, **kwargs))
+    if cacheDir is None:
+        cacheDir = cacheDirectory()
+    if cacheDir is None or not privateDirectory(cacheDir):
+        return indexObject(cls(fnames, **kwargs))
+    fname = os.path.join(cacheDir, key + ".idx")
+    if os.path.exists(fname):
+        try:
+            return openIndex(fname)
+        except Exception:
+            # A corrupt index is simply regenerated
+            pass
+
+    obj = cls(fnames, **kwargs)
+    try:
+        fd, tmpName = tempfile.mkstemp(suffix=".idx", dir=cacheDir)
+        os.close(fd)
+        saveIndex(obj, tmpName)
+        os.rename(tmpName, fname)
+    except (IOError, OSError):
+        return indexObject(obj)
+    return openIndex(fname)
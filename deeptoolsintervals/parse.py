@@ -207,58 +207,20 @@ class GTF(object):
 
         return chrom
 
-    def parseBEDcore(self, line, ncols):
-        """
-        Returns True if the entry was added, otherwise False
-
-        >>> from deeptoolsintervals import parse
-        >>> from os.path import dirname
-        >>> gtf = parse.GTF("{0}/test/GRCh38.84.bed12.bz2".format(dirname(parse.__file__)), keepExons=True, labels=["foo"])
-        >>> gtf.findOverlaps("1", 1, 20000)
-        [(11868, 14409, 'ENST00000456328.2', 'foo', [(11868, 12227), (12612, 12721), (13220, 14409)], 0.0), (12009, 13670, 'ENST00000450305.2', 'foo', [(12009, 12057), (12178, 12227), (12612, 12697), (12974, 13052), (13220, 13374), (13452, 13670)], 0.0), (14403, 29570, 'ENST00000488147.1', 'foo', [(14403, 14501), (15004, 15038), (15795, 15947), (16606, 16765), (16857, 17055), (17232, 17368), (17605, 17742), (17914, 18061), (18267, 18366), (24737, 24891), (29533, 29570)], 0.0), (17368, 17436, 'ENST00000619216.1', 'foo', [(17368, 17436)], 0.0)]
-        """
-
-        strand = 3
-        cols = line.split("\t")
-        name = "{0}:{1}-{2}".format(cols[0], cols[1], cols[2])
-
-        if int(cols[1]) < 0:
-            cols[1] = 0
-
-        if int(cols[1]) >= int(cols[2]):
-            sys.stderr.write("Warning: {0}:{1}-{2} is an invalid BED interval! Ignoring it.\n".format(cols[0], cols[1], cols[2]))
-            return
-
-        # BED6/BED12: set name and strand
-        score = '.'
-        if ncols > 3:
-            name = cols[3]
-            if cols[5] == '+':
-                strand = 0
-            elif cols[5] == '-':
-                strand = 1
-            score = cols[4]
-
-        # Ensure that the name is unique
-        name = findRandomLabel(self.exons[self.labelIdx], name)
-        self.tree.addEntry(self.mungeChromosome(cols[0]), int(cols[1]), int(cols[2]), name, strand, self.labelIdx, score)
-        if ncols != 12 or self.keepExons is False:
-            self.exons[self.labelIdx][name] = [(int(cols[1]), int(cols[2]))]
-        else:
-            assert(len(cols) == 12)
-            self.exons[self.labelIdx][name] = parseExonBounds(int(cols[1]), int(cols[2]), int(cols[9]), cols[10], cols[11])
-
-    def parseBED(self, fp, line, ncols=3, labelColumn=None):
+    def parseBED(self, fname, ncols=3, labelColumn=None):
         """
         parse a BED file. The default group label is the file name.
 
-        fp:    A python file pointer
-        line:  The first line
-        ncols: The number of columns to care about
+        fname:       The file name
+        ncols:       The number of columns to care about
+        labelColumn: The column holding the group label, if any
 
 
         >>> from deeptoolsintervals import parse
         >>> from os.path import dirname, basename
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.bed12.bz2".format(dirname(parse.__file__)), keepExons=True, labels=["foo"])
+        >>> gtf.findOverlaps("1", 1, 20000)
+        [(11868, 14409, 'ENST00000456328.2', 'foo', [(11868, 12227), (12612, 12721), (13220, 14409)], 0.0), (12009, 13670, 'ENST00000450305.2', 'foo', [(12009, 12057), (12178, 12227), (12612, 12697), (12974, 13052), (13220, 13374), (13452, 13670)], 0.0), (14403, 29570, 'ENST00000488147.1', 'foo', [(14403, 14501), (15004, 15038), (15795, 15947), (16606, 16765), (16857, 17055), (17232, 17368), (17605, 17742), (17914, 18061), (18267, 18366), (24737, 24891), (29533, 29570)], 0.0), (17368, 17436, 'ENST00000619216.1', 'foo', [(17368, 17436)], 0.0)]
         >>> gtf = parse.GTF("{0}/test/GRCh38.84.bed6".format(dirname(parse.__file__)), keepExons=True)
         >>> gtf.findOverlaps("1", 1, 20000)
         [(11868, 14409, 'ENST00000456328.2', 'group 1', [(11868, 14409)], 0.0), (12009, 13670, 'ENST00000450305.2', 'group 1', [(12009, 13670)], 0.0), (14403, 29570, 'ENST00000488147.1', 'group 1', [(14403, 29570)], 0.0), (17368, 17436, 'ENST00000619216.1', 'group 1', [(17368, 17436)], 0.0)]
@@ -297,163 +259,22 @@ class GTF(object):
         >>> assert(labels['group2'] == 9)
         >>> assert(labels['GRCh38.84.bed2'] == 1)
         """
-        groupLabelsFound = 0
-        groupEntries = 0
-
-        # Handle the first line
-        if labelColumn is not None:
-            cols = line.split("\t")
-            label = cols.pop(labelColumn)
-            line = "\t".join(cols)
-            if label in self.labels:
-                self.labelIdx = self.labels.index(label)
-            else:
-                self.labels.append(label)
-                self.exons.append(dict())
-                self.labelIdx = len(self.labels) - 1
-        else:
-            self.exons.append(dict())
-
-        self.parseBEDcore(line, ncols)
-        groupEntries = 1
-
-        # iterate over the remaining lines
-        for line in fp:
-            if not isinstance(line, str):
-                line = line.decode('ascii')
-            line = line.strip()
-            if len(line) == 0:
-                # Apparently this happens, some people seem to like trying to break things
-                continue
-
-            if line.startswith("#") and labelColumn is None:
-                # If there was a previous group AND it had no entries then remove it
-                if groupLabelsFound > 0:
-                    if groupEntries == 0:
-                        sys.stderr.write("Warning, the '{0}' group had no valid entries! Removing it.\n".format(self.labels[self.labelIdx]))
-                        del self.labels[-1]
-                        groupLabelsFound -= 1
-                        self.labelIdx -= 1
-
-                label = line[1:].strip()
-                if len(label):
-                    # Guard against duplicate group labels
-                    self.labels.append(findRandomLabel(self.labels, label))
-                else:
-                    # I'm sure someone will try an empty label...
-                    self.labels.append(findRandomLabel(self.labels, os.path.basename(self.filename)))
-                self.labelIdx += 1
-                self.exons.append(dict())
-                groupLabelsFound += 1
-                groupEntries = 0
-            elif line.startswith("#") and labelColumn is not None:
-                continue
-            else:
-                if labelColumn is not None:
-                    cols = line.split("\t")
-                    label = cols.pop(labelColumn)
-                    line = "\t".join(cols)
-                    if label in self.labels:
-                        self.labelIdx = self.labels.index(label)
-                    else:
-                        self.labels.append(label)
-                        self.exons.append(dict())
-                        self.labelIdx = len(self.labels) - 1
-                self.parseBEDcore(line, ncols)
-                if labelColumn is None:
-                    groupEntries += 1
-
-        if groupEntries > 0 and labelColumn is None:
-            if self.defaultGroup is not None:
-                self.labels.append(findRandomLabel(self.labels, self.defaultGroup))
-            else:
-                self.labels.append(findRandomLabel(self.labels, os.path.basename(self.filename)))
+        if labelColumn is None:
+            labelColumn = -1
+        self.tree.addFile(fname, ncols, labelColumn, self.keepExons, self.labels, self.exons, self.chroms,
+                          self.transcriptIDduplicated, self.labelIdx, self.transcriptID, self.exonID,
+                          self.transcript_id_designator, os.path.basename(fname), self.defaultGroup)
 
         # Reset self.labelIdx
         self.labelIdx = len(self.labels)
 
-    def parseGTFtranscript(self, cols, label):
-        """
-        Parse and add a transcript entry
-        """
-        if int(cols[3]) - 1 < 0:
-            sys.stderr.write("Warning: Invalid start in '{0}', skipping\n".format("\t".join(cols)))
-            return
-
-        if len(cols) < 9:
-            sys.stderr.write("Warning: non-GTF line encountered! {0}\n".format("\t".join(cols)))
-            return
-
-        s = next(csv.reader([cols[8]], delimiter=' '))
-        if "deepTools_group" in s and s[-1] != "deepTools_group":
-            label = s[s.index("deepTools_group") + 1].rstrip(";")
-        elif self.defaultGroup is not None:
-            label = self.defaultGroup
-
-        if self.transcript_id_designator not in s or s[-1] == self.transcript_id_designator:
-            sys.stderr.write("Warning: {0} is malformed!\n".format("\t".join(cols)))
-            return
-
-        if int(cols[3]) > int(cols[4]) or int(cols[3]) < 1:
-            sys.stderr.write("Warning: {0}:{1}-{2} is an invalid GTF interval! Ignoring it.\n".format(cols[0], cols[3], cols[4]))
-            return
-
-        strand = 3
-        if cols[6] == '+':
-            strand = 0
-        elif cols[6] == '-':
-            strand = 1
-
-        score = cols[5]
-
-        # Get the label index
-        if label not in self.labels:
-            self.labels.append(label)
-            self.exons.append(dict())
-        self.labelIdx = self.labels.index(label)
-
-        # Ensure unique names within GTF files
-        name = s[s.index(self.transcript_id_designator) + 1].rstrip(";")
-        if name in self.exons[self.labelIdx]:
-            sys.stderr.write("Warning: {0} occurs more than once! Only using the first instance.\n".format(name))
-            self.transcriptIDduplicated.append(name)
-            return
-
-        chrom = self.mungeChromosome(cols[0])
-        self.tree.addEntry(chrom, int(cols[3]) - 1, int(cols[4]), name, strand, self.labelIdx, score)
-
-        # Exon bounds placeholder
-        self.exons[self.labelIdx][name] = []
-
-    def parseGTFexon(self, cols):
-        """
-        Parse an exon entry and add it to the transcript hash
-        """
-        if int(cols[3]) - 1 < 0:
-            sys.stderr.write("Warning: Invalid start in '{0}', skipping\n".format("\t".join(cols)))
-            return
-
-        s = next(csv.reader([cols[8]], delimiter=' '))
-        if self.transcript_id_designator not in s or s[-1] == self.transcript_id_designator:
-            sys.stderr.write("Warning: {0} is malformed!\n".format("\t".join(cols)))
-            return
-
-        name = s[s.index(self.transcript_id_designator) + 1].rstrip(";")
-        if name in self.transcriptIDduplicated:
-            return
-        if name not in self.exons[self.labelIdx]:
-            self.exons[self.labelIdx][name] = []
-
-        self.exons[self.labelIdx][name].append((int(cols[3]) - 1, int(cols[4])))
-
-    def parseGTF(self, fp, line):
+    def parseGTF(self, fname):
         """
         parse a GTF file. Note that a single label will be used for every entry
         in a file that isn't explicitly labeled with a deepTools_group
         key:values pair in the last column
 
-        fp:   A python file pointer
-        line: The first non-comment line
+        fname: The file name
 
         >>> from deeptoolsintervals import parse
         >>> from os.path import dirname, basename
@@ -498,28 +319,9 @@ class GTF(object):
         >>> assert(labels['group 3'] == 7)
         >>> assert(labels['GRCh38.84.bed'] == 1)
         """
-        file_label = findRandomLabel(self.labels, os.path.basename(self.filename))
-
-        # Handle the first line
-        cols = line.split("\t")
-        if cols[2].lower() == self.transcriptID.lower():
-            self.parseGTFtranscript(cols, file_label)
-        elif cols[2].lower() == self.exonID.lower():
-            self.parseGTFexon(cols)
-
-        # Handle the remaining lines
-        for line in fp:
-            if not isinstance(line, str):
-                line = line.decode('ascii')
-            if not line.startswith('#'):
-                cols = line.split("\t")
-                if len(cols) == 0:
-                    continue
-
-                if cols[2].lower() == self.transcriptID.lower():
-                    self.parseGTFtranscript(cols, file_label)
-                elif cols[2].lower() == self.exonID.lower() and self.keepExons is True:
-                    self.parseGTFexon(cols)
+        self.tree.addFile(fname, 0, -1, self.keepExons, self.labels, self.exons, self.chroms,
+                          self.transcriptIDduplicated, self.labelIdx, self.transcriptID, self.exonID,
+                          self.transcript_id_designator, os.path.basename(fname), self.defaultGroup)
 
         # Reset self.labelIdx
         self.labelIdx = len(self.labels)
@@ -578,7 +380,7 @@ class GTF(object):
         if not isinstance(fnames, list):
             fnames = [fnames]
 
-        # Load the files
+        # Load the files, only the type is determined here. The parsing is done in C.
         for fname in fnames:
             self.filename = fname
             fp = openPossiblyCompressed(fname)
@@ -589,15 +391,15 @@ class GTF(object):
             line = line.strip()
 
             ftype = self.inferType(fp, line, labelColumn)
+            fp.close()
             if ftype == 'GTF':
-                self.parseGTF(fp, line)
+                self.parseGTF(fname)
             elif ftype == 'BED3':
-                self.parseBED(fp, line, 3, labelColumn)
+                self.parseBED(fname, 3, labelColumn)
             elif ftype == 'BED6':
-                self.parseBED(fp, line, 6, labelColumn)
+                self.parseBED(fname, 6, labelColumn)
             else:
-                self.parseBED(fp, line, 12, labelColumn)
-            fp.close()
+                self.parseBED(fname, 12, labelColumn)
 
         # Sanity check
         if self.tree.countEntries() == 0:
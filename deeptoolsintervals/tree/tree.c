@@ -4,6 +4,10 @@
 #include "tree.h"
 #include <assert.h>
 #include <float.h>
+#include <stdarg.h>
+#include <zlib.h>
+#include <bzlib.h>
+#include "kseq.h"
 
 static void pyGTFDealloc(pyGTFtree_t *self) {
     if(self->t) destroyGTFtree(self->t);
@@ -371,6 +375,862 @@ error:
     return NULL;
 }
 
+/*
+ * Bulk loading of BED and GTF files (possibly gzip or bzip2 compressed). This
+ * mirrors what GTF.parseBED() and GTF.parseGTF() in parse.py used to do line
+ * by line in python. The group labels, exons, chromosome names and duplicated
+ * transcript IDs are still held in python lists/dicts owned by the GTF object,
+ * which are updated in place.
+ */
+typedef struct {
+    gzFile gz;
+    FILE *fp;
+    BZFILE *bz;
+    int eof, error;
+} annotFile;
+
+//Returns 0 on EOF or error, the latter setting f->error
+static int annotRead(annotFile *f, void *buf, int len) {
+    int n, bzerror, nUnused, c;
+    void *unused;
+    char unusedCopy[BZ_MAX_UNUSED];
+
+    if(f->gz) {
+        n = gzread(f->gz, buf, len);
+        if(n < 0) {
+            f->error = 1;
+            return 0;
+        }
+        return n;
+    }
+
+    while(!f->eof) {
+        n = BZ2_bzRead(&bzerror, f->bz, buf, len);
+        if(bzerror == BZ_OK) return n;
+        if(bzerror != BZ_STREAM_END) {
+            f->error = 1;
+            return 0;
+        }
+
+        //Files from pbzip2 and the like contain multiple streams
+        BZ2_bzReadGetUnused(&bzerror, f->bz, &unused, &nUnused);
+        if(bzerror != BZ_OK) {
+            f->error = 1;
+            return 0;
+        }
+        memcpy(unusedCopy, unused, nUnused);
+        BZ2_bzReadClose(&bzerror, f->bz);
+        f->bz = NULL;
+        if(nUnused == 0) {
+            c = fgetc(f->fp);
+            if(c == EOF) {
+                f->eof = 1;
+                return n;
+            }
+            ungetc(c, f->fp);
+        }
+        f->bz = BZ2_bzReadOpen(&bzerror, f->fp, 0, 0, unusedCopy, nUnused);
+        if(bzerror != BZ_OK) {
+            f->error = 1;
+            return 0;
+        }
+        if(n) return n;
+    }
+    return 0;
+}
+
+KSTREAM_INIT(annotFile*, annotRead, 65536)
+
+static void annotClose(annotFile *f) {
+    int bzerror;
+    if(!f) return;
+    if(f->gz) gzclose(f->gz);
+    if(f->bz) BZ2_bzReadClose(&bzerror, f->bz);
+    if(f->fp) fclose(f->fp);
+    free(f);
+}
+
+//gzip and uncompressed files are both read with zlib
+static annotFile *annotOpen(char *fname) {
+    unsigned char first3[3];
+    int bzerror;
+    annotFile *f = calloc(1, sizeof(annotFile));
+    if(!f) return NULL;
+
+    f->fp = fopen(fname, "rb");
+    if(!f->fp) goto error;
+    if(fread(first3, 1, 3, f->fp) == 3 && first3[0] == 0x42 && first3[1] == 0x5a && first3[2] == 0x68) {
+        rewind(f->fp);
+        f->bz = BZ2_bzReadOpen(&bzerror, f->fp, 0, 0, NULL, 0);
+        if(bzerror != BZ_OK) goto error;
+    } else {
+        fclose(f->fp);
+        f->fp = NULL;
+        f->gz = gzopen(fname, "rb");
+        if(!f->gz) goto error;
+    }
+    return f;
+
+error:
+    annotClose(f);
+    return NULL;
+}
+
+typedef struct {
+    GTFtree *t;
+    PyObject *labels, *exons, *chroms, *duplicated, *duplicatedSet;
+    long labelIdx;
+    int keepExons;
+    kstring_t rawChrom, chrom; //The last chromosome name seen and its munged version
+    kstring_t label; //The last label looked up
+    long lastLabelIdx;
+    kstring_t name, value, group;
+    char **cols;
+    int mCols;
+} annotParser;
+
+//Writes to sys.stderr, like the python code did
+static void annotWarn(const char *fmt, ...) {
+    va_list ap;
+    char *s;
+    int l;
+
+    va_start(ap, fmt);
+    l = vsnprintf(NULL, 0, fmt, ap);
+    va_end(ap);
+    if(l < 0) return;
+    s = malloc(l + 1);
+    if(!s) return;
+    va_start(ap, fmt);
+    vsnprintf(s, l + 1, fmt, ap);
+    va_end(ap);
+#if PY_MAJOR_VERSION >= 3
+    PySys_FormatStderr("%s", s);
+#else
+    PySys_WriteStderr("%s", s);
+#endif
+    free(s);
+}
+
+//Returns 1 if s is in the python container o, 0 if not and -1 on error
+static int containsString(PyObject *o, char *s) {
+    int rv;
+    PyObject *os = PyString_FromString(s);
+    if(!os) return -1;
+    rv = PySequence_Contains(o, os);
+    Py_DECREF(os);
+    return rv;
+}
+
+//Like int(), sets a python ValueError and returns 1 if s isn't an integer
+static int annotInt(char *s, long long *val) {
+    char *end;
+    while(isspace(*s)) s++;
+    errno = 0;
+    *val = strtoll(s, &end, 10);
+    while(isspace(*end)) end++;
+    if(end == s || *end || errno) {
+        PyErr_Format(PyExc_ValueError, "invalid literal for int() with base 10: '%s'", s);
+        return 1;
+    }
+    return 0;
+}
+
+//findRandomLabel(): ensures that name isn't already in the container o by appending _r1, _r2, etc.
+static int uniqueName(PyObject *o, kstring_t *name) {
+    int rv, i = 0;
+    size_t l = name->l;
+
+    while(1) {
+        rv = containsString(o, name->s);
+        if(rv <= 0) return rv;
+        name->l = l;
+        kputs("_r", name);
+        kputw(++i, name);
+    }
+}
+
+//Splits a line by tabs in place, returning the number of columns
+static int splitColumns(annotParser *p, char *line) {
+    int n = 0;
+    while(1) {
+        if(n >= p->mCols) {
+            p->mCols = (p->mCols) ? 2 * p->mCols : 16;
+            p->cols = realloc(p->cols, p->mCols * sizeof(char*));
+            if(!p->cols) return -1;
+        }
+        p->cols[n++] = line;
+        line = strchr(line, '\t');
+        if(!line) break;
+        *line++ = '\0';
+    }
+    return n;
+}
+
+//str.strip()
+static char *stripLine(kstring_t *ks) {
+    char *s = ks->s;
+    while(ks->l && isspace(ks->s[ks->l - 1])) ks->s[--ks->l] = '\0';
+    while(isspace(*s)) s++;
+    return s;
+}
+
+static int isHeader(char *s) {
+    return (s[0] == '#' || strncmp(s, "track", 5) == 0 || strncmp(s, "browser", 7) == 0);
+}
+
+//mungeChromosome(), returns NULL on error
+static char *mungeChrom(annotParser *p, char *chrom) {
+    int rv = 0;
+    PyObject *os;
+
+    if(p->rawChrom.s && strcmp(p->rawChrom.s, chrom) == 0) return p->chrom.s;
+    p->rawChrom.l = 0;
+    kputs(chrom, &p->rawChrom);
+    p->chrom.l = 0;
+
+    rv = containsString(p->chroms, chrom);
+    if(rv < 0) return NULL;
+    if(rv) {
+        kputs(chrom, &p->chrom);
+        return p->chrom.s;
+    }
+
+    //chrM <-> MT and chr1 <-> 1 conversions
+    if(strcmp(chrom, "MT") == 0) {
+        rv = containsString(p->chroms, "chrM");
+        if(rv > 0) kputs("chrM", &p->chrom);
+    }
+    if(!rv && strcmp(chrom, "chrM") == 0) {
+        rv = containsString(p->chroms, "MT");
+        if(rv > 0) kputs("MT", &p->chrom);
+    }
+    if(!rv && strncmp(chrom, "chr", 3) == 0 && strlen(chrom) > 3) {
+        rv = containsString(p->chroms, chrom + 3);
+        if(rv > 0) kputs(chrom + 3, &p->chrom);
+    }
+    if(!rv) {
+        kputs("chr", &p->chrom);
+        kputs(chrom, &p->chrom);
+        rv = containsString(p->chroms, p->chrom.s);
+        if(!rv) {
+            p->chrom.l = 0;
+            kputs(chrom, &p->chrom);
+        }
+    }
+    if(rv < 0) return NULL;
+
+    os = PyString_FromString(p->chrom.s);
+    if(!os) return NULL;
+    rv = PyList_Append(p->chroms, os);
+    Py_DECREF(os);
+    if(rv) return NULL;
+    return p->chrom.s;
+}
+
+//Returns the index of a label, appending it (and an exon dict) if needed. -1 on error
+static long labelIndex(annotParser *p, char *label) {
+    PyObject *os = NULL, *d = NULL;
+    Py_ssize_t idx;
+
+    if(p->label.s && strcmp(p->label.s, label) == 0) return p->lastLabelIdx;
+
+    os = PyString_FromString(label);
+    if(!os) return -1;
+    idx = PySequence_Index(p->labels, os);
+    if(idx < 0) {
+        PyErr_Clear();
+        d = PyDict_New();
+        if(!d) goto error;
+        if(PyList_Append(p->labels, os)) goto error;
+        if(PyList_Append(p->exons, d)) goto error;
+        Py_DECREF(d);
+        idx = PyList_GET_SIZE(p->labels) - 1;
+    }
+    Py_DECREF(os);
+
+    p->label.l = 0;
+    kputs(label, &p->label);
+    p->lastLabelIdx = (long) idx;
+    return p->lastLabelIdx;
+
+error:
+    Py_XDECREF(os);
+    Py_XDECREF(d);
+    return -1;
+}
+
+//The exon dict for the current label, a borrowed reference
+static PyObject *exonDict(annotParser *p) {
+    if(p->labelIdx < 0 || p->labelIdx >= PyList_GET_SIZE(p->exons)) {
+        PyErr_SetString(PyExc_IndexError, "list index out of range");
+        return NULL;
+    }
+    return PyList_GET_ITEM(p->exons, p->labelIdx);
+}
+
+static double annotScore(char *s) {
+    if(strcmp(s, ".") == 0) return DBL_MAX;
+    return strtod(s, NULL);
+}
+
+static int addAnnotEntry(annotParser *p, char *chrom, long long start, long long end, uint8_t strand, double score) {
+    if(start >= (uint32_t) -1 || end >= (uint32_t) -1 || end <= start) {
+        PyErr_SetString(PyExc_RuntimeError, "addFile received invalid bounds!");
+        return 1;
+    }
+    chrom = mungeChrom(p, chrom);
+    if(!chrom) return 1;
+    if(addGTFentry(p->t, chrom, (uint32_t) start, (uint32_t) end, strand, p->name.s, (uint32_t) p->labelIdx, score)) {
+        PyErr_SetString(PyExc_RuntimeError, "addFile received an error while inserting an entry!");
+        return 1;
+    }
+    return 0;
+}
+
+//Splits a comma-separated list in place (after stripping commas from the ends)
+static int splitCommas(char *s, char **out, int m) {
+    int n = 0;
+    char *end = s + strlen(s);
+    while(*s == ',') s++;
+    while(end > s && *(end - 1) == ',') *(--end) = '\0';
+    while(n < m) {
+        out[n++] = s;
+        s = strchr(s, ',');
+        if(!s) break;
+        *s++ = '\0';
+    }
+    return n;
+}
+
+//parseExonBounds(), returns a new list or NULL on error
+static PyObject *exonBounds(long long start, long long end, long long n, char *sizes, char *offsets) {
+    PyObject *o = NULL, *t;
+    char **soffsets = NULL, **ssizes = NULL;
+    long long *lsizes = NULL, *loffsets = NULL;
+    int nOffsets, nSizes, m, i;
+    char *offsetsCopy = strdup(offsets), *sizesCopy = strdup(sizes);
+
+    if(!offsetsCopy || !sizesCopy) goto error;
+    m = strlen(offsets) + strlen(sizes) + 2;
+    soffsets = malloc(m * sizeof(char*));
+    ssizes = malloc(m * sizeof(char*));
+    loffsets = malloc(m * sizeof(long long));
+    lsizes = malloc(m * sizeof(long long));
+    if(!soffsets || !ssizes || !loffsets || !lsizes) goto error;
+    nOffsets = splitCommas(offsetsCopy, soffsets, m);
+    nSizes = splitCommas(sizesCopy, ssizes, m);
+
+    //Slicing, as [0:n]
+    if(n < 0) {
+        nOffsets = (nOffsets + n > 0) ? nOffsets + n : 0;
+        nSizes = (nSizes + n > 0) ? nSizes + n : 0;
+    } else {
+        if(nOffsets > n) nOffsets = n;
+        if(nSizes > n) nSizes = n;
+    }
+
+    for(i = 0; i < nOffsets; i++) {
+        if(annotInt(soffsets[i], loffsets + i)) break;
+    }
+    if(i == nOffsets) {
+        for(i = 0; i < nSizes && i < nOffsets; i++) {
+            if(annotInt(ssizes[i], lsizes + i)) break;
+        }
+    }
+    if(PyErr_Occurred()) {
+        PyErr_Clear();
+        annotWarn("Warning: Received an invalid exon offset (%s) or size (%s), using the entry bounds instead (%lld-%lld)\n", offsets, sizes, start, end);
+        o = Py_BuildValue("[(LL)]", start, end);
+    } else if(nOffsets < n || nSizes < n) {
+        annotWarn("Warning: There were too few exon start/end offsets (%s) or sizes (%s), using the entry bounds instead (%lld-%lld)\n", offsets, sizes, start, end);
+        o = Py_BuildValue("[(LL)]", start, end);
+    } else {
+        m = (nOffsets < nSizes) ? nOffsets : nSizes;
+        o = PyList_New(m);
+        if(!o) goto error;
+        for(i = 0; i < m; i++) {
+            t = Py_BuildValue("(LL)", start + loffsets[i], start + loffsets[i] + lsizes[i]);
+            if(!t) {
+                Py_DECREF(o);
+                o = NULL;
+                break;
+            }
+            PyList_SET_ITEM(o, i, t);
+        }
+    }
+
+error:
+    free(offsetsCopy);
+    free(sizesCopy);
+    free(soffsets);
+    free(ssizes);
+    free(loffsets);
+    free(lsizes);
+    if(!o && !PyErr_Occurred()) PyErr_NoMemory();
+    return o;
+}
+
+//parseBEDcore(), returns 1 on error
+static int parseBEDline(annotParser *p, int n, int ncols) {
+    char **cols = p->cols;
+    long long start, end, nExons;
+    uint8_t strand = 3;
+    char *score = ".";
+    PyObject *d, *oname = NULL, *oexons = NULL;
+    int rv;
+
+    if(n < 3 || (ncols > 3 && n < 6)) {
+        PyErr_Format(PyExc_IndexError, "The BED entry starting with '%s' has too few columns", cols[0]);
+        return 1;
+    }
+    if(annotInt(cols[1], &start) || annotInt(cols[2], &end)) return 1;
+
+    p->name.l = 0;
+    if(ncols > 3) {
+        kputs(cols[3], &p->name);
+        if(strcmp(cols[5], "+") == 0) {
+            strand = 0;
+        } else if(strcmp(cols[5], "-") == 0) {
+            strand = 1;
+        }
+        score = cols[4];
+    } else {
+        kputs(cols[0], &p->name);
+        kputc(':', &p->name);
+        kputs(cols[1], &p->name);
+        kputc('-', &p->name);
+        kputs(cols[2], &p->name);
+    }
+
+    if(start < 0) start = 0;
+    if(start >= end) {
+        annotWarn("Warning: %s:%lld-%s is an invalid BED interval! Ignoring it.\n", cols[0], start, cols[2]);
+        return 0;
+    }
+
+    //Ensure that the name is unique
+    d = exonDict(p);
+    if(!d) return 1;
+    if(uniqueName(d, &p->name)) return 1;
+    if(addAnnotEntry(p, cols[0], start, end, strand, annotScore(score))) return 1;
+
+    if(ncols != 12 || !p->keepExons) {
+        oexons = Py_BuildValue("[(LL)]", start, end);
+    } else {
+        if(n != 12) {
+            PyErr_Format(PyExc_AssertionError, "The BED12 entry for %s doesn't have 12 columns", p->name.s);
+            return 1;
+        }
+        if(annotInt(cols[9], &nExons)) return 1;
+        oexons = exonBounds(start, end, nExons, cols[10], cols[11]);
+    }
+    oname = PyString_FromString(p->name.s);
+    if(!oname || !oexons) goto error;
+    rv = PyDict_SetItem(d, oname, oexons);
+    Py_DECREF(oname);
+    Py_DECREF(oexons);
+    return rv ? 1 : 0;
+
+error:
+    Py_XDECREF(oname);
+    Py_XDECREF(oexons);
+    return 1;
+}
+
+//Moves the label column (if any) out of the columns, returning the new number of columns
+static int popLabel(annotParser *p, int n, long labelColumn, char **label) {
+    int i;
+    if(labelColumn >= n) {
+        PyErr_SetString(PyExc_IndexError, "pop index out of range");
+        return -1;
+    }
+    *label = p->cols[labelColumn];
+    for(i = labelColumn; i < n - 1; i++) p->cols[i] = p->cols[i + 1];
+    return n - 1;
+}
+
+//Appends findRandomLabel(labels, name) to the labels, returning 1 on error
+static int appendUniqueLabel(annotParser *p, char *name) {
+    int rv;
+    PyObject *os;
+    kstring_t ks = {0, 0, NULL};
+
+    kputs(name, &ks);
+    if(uniqueName(p->labels, &ks)) {
+        free(ks.s);
+        return 1;
+    }
+    os = PyString_FromString(ks.s);
+    free(ks.s);
+    if(!os) return 1;
+    rv = PyList_Append(p->labels, os);
+    Py_DECREF(os);
+    return rv ? 1 : 0;
+}
+
+static int appendExonDict(annotParser *p) {
+    int rv;
+    PyObject *d = PyDict_New();
+    if(!d) return 1;
+    rv = PyList_Append(p->exons, d);
+    Py_DECREF(d);
+    return rv ? 1 : 0;
+}
+
+//parseBED(), the first line must be the first non-header line
+static int parseBEDfile(annotParser *p, kstream_t *ks, kstring_t *line, int ncols, long labelColumn, char *bname, char *defaultGroup) {
+    int n, groupLabelsFound = 0, groupEntries = 0, first = 1;
+    char *s, *label;
+    Py_ssize_t l;
+
+    do {
+        s = stripLine(line);
+        if(!first && *s == '\0') continue;
+
+        if(!first && *s == '#') {
+            if(labelColumn >= 0) continue;
+
+            //If there was a previous group AND it had no entries then remove it
+            if(groupLabelsFound > 0 && groupEntries == 0) {
+                l = PyList_GET_SIZE(p->labels);
+                annotWarn("Warning, the '%s' group had no valid entries! Removing it.\n", PyString_AsString(PyList_GET_ITEM(p->labels, l - 1)));
+                if(PyList_SetSlice(p->labels, l - 1, l, NULL)) return 1;
+                groupLabelsFound--;
+                p->labelIdx--;
+            }
+
+            s++;
+            while(isspace(*s)) s++;
+            if(appendUniqueLabel(p, (*s) ? s : bname)) return 1;
+            p->labelIdx++;
+            if(appendExonDict(p)) return 1;
+            groupLabelsFound++;
+            groupEntries = 0;
+            continue;
+        }
+
+        n = splitColumns(p, s);
+        if(n < 0) {
+            PyErr_NoMemory();
+            return 1;
+        }
+        if(labelColumn >= 0) {
+            n = popLabel(p, n, labelColumn, &label);
+            if(n < 0) return 1;
+            p->labelIdx = labelIndex(p, label);
+            if(p->labelIdx < 0) return 1;
+        } else if(first) {
+            if(appendExonDict(p)) return 1;
+        }
+        if(parseBEDline(p, n, ncols)) return 1;
+        if(labelColumn < 0 || first) groupEntries++;
+        first = 0;
+    } while(ks_getuntil(ks, KS_SEP_LINE, line, NULL) >= 0);
+
+    if(groupEntries > 0 && labelColumn < 0) {
+        if(appendUniqueLabel(p, defaultGroup ? defaultGroup : bname)) return 1;
+    }
+    return 0;
+}
+
+/*
+  Sets p->value to the value following key in a GTF attribute column, split
+  as csv.reader(delimiter=' ') would. Returns 1 if the key is found and isn't
+  the last field, otherwise 0.
+*/
+static int gtfAttribute(annotParser *p, char *s, const char *key) {
+    kstring_t *tok = &p->name;
+    int more = (*s != '\0'), found = 0, prevIsKey = 0, isKey = 0;
+
+    while(more) {
+        tok->l = 0;
+        kputs("", tok);
+        if(*s == '"') {
+            s++;
+            while(*s) {
+                if(*s == '"') {
+                    if(*(s + 1) == '"') {
+                        kputc('"', tok);
+                        s += 2;
+                        continue;
+                    }
+                    s++;
+                    break;
+                }
+                kputc(*s++, tok);
+            }
+        }
+        while(*s && *s != ' ') kputc(*s++, tok);
+        more = (*s == ' ');
+        if(more) s++;
+
+        if(prevIsKey && !found) {
+            found = 1;
+            p->value.l = 0;
+            kputsn(tok->s, tok->l, &p->value);
+            while(p->value.l && p->value.s[p->value.l - 1] == ';') p->value.s[--p->value.l] = '\0';
+        }
+        isKey = (strcmp(tok->s, key) == 0);
+        prevIsKey = isKey;
+    }
+    if(isKey) return 0;
+    return found;
+}
+
+//parseGTFtranscript(), returns 1 on error
+static int parseGTFtranscript(annotParser *p, int n, char *line, char *fileLabel, char *defaultGroup, char *designator) {
+    char **cols = p->cols;
+    long long start, end;
+    uint8_t strand = 3;
+    char *label = fileLabel;
+    PyObject *d, *oname = NULL, *oexons = NULL;
+    int rv;
+
+    if(n < 9) {
+        annotWarn("Warning: non-GTF line encountered! %s\n", line);
+        return 0;
+    }
+    if(annotInt(cols[3], &start) || annotInt(cols[4], &end)) return 1;
+    if(start - 1 < 0) {
+        annotWarn("Warning: Invalid start in '%s', skipping\n", line);
+        return 0;
+    }
+
+    if(strstr(cols[8], "deepTools_group") && gtfAttribute(p, cols[8], "deepTools_group")) {
+        p->group.l = 0;
+        kputs(p->value.s, &p->group);
+        label = p->group.s;
+    } else if(defaultGroup) {
+        label = defaultGroup;
+    }
+
+    if(!gtfAttribute(p, cols[8], designator)) {
+        annotWarn("Warning: %s is malformed!\n", line);
+        return 0;
+    }
+
+    if(start > end) {
+        annotWarn("Warning: %s:%lld-%lld is an invalid GTF interval! Ignoring it.\n", cols[0], start, end);
+        return 0;
+    }
+
+    if(strcmp(cols[6], "+") == 0) {
+        strand = 0;
+    } else if(strcmp(cols[6], "-") == 0) {
+        strand = 1;
+    }
+
+    //Get the label index
+    p->labelIdx = labelIndex(p, label);
+    if(p->labelIdx < 0) return 1;
+
+    //Ensure unique names within GTF files
+    p->name.l = 0;
+    kputs(p->value.s, &p->name);
+    d = exonDict(p);
+    if(!d) return 1;
+    rv = containsString(d, p->name.s);
+    if(rv < 0) return 1;
+    if(rv) {
+        annotWarn("Warning: %s occurs more than once! Only using the first instance.\n", p->name.s);
+        oname = PyString_FromString(p->name.s);
+        if(!oname) return 1;
+        rv = PyList_Append(p->duplicated, oname) || PySet_Add(p->duplicatedSet, oname);
+        Py_DECREF(oname);
+        return rv ? 1 : 0;
+    }
+
+    if(addAnnotEntry(p, cols[0], start - 1, end, strand, annotScore(cols[5]))) return 1;
+
+    //Exon bounds placeholder
+    oname = PyString_FromString(p->name.s);
+    oexons = PyList_New(0);
+    if(!oname || !oexons) goto error;
+    rv = PyDict_SetItem(d, oname, oexons);
+    Py_DECREF(oname);
+    Py_DECREF(oexons);
+    return rv ? 1 : 0;
+
+error:
+    Py_XDECREF(oname);
+    Py_XDECREF(oexons);
+    return 1;
+}
+
+//parseGTFexon(), returns 1 on error
+static int parseGTFexon(annotParser *p, int n, char *line, char *designator) {
+    char **cols = p->cols;
+    long long start, end;
+    PyObject *d, *oname = NULL, *oexons = NULL, *t = NULL;
+    int rv;
+
+    if(n < 9) {
+        annotWarn("Warning: non-GTF line encountered! %s\n", line);
+        return 0;
+    }
+    if(annotInt(cols[3], &start) || annotInt(cols[4], &end)) return 1;
+    if(start - 1 < 0) {
+        annotWarn("Warning: Invalid start in '%s', skipping\n", line);
+        return 0;
+    }
+
+    if(!gtfAttribute(p, cols[8], designator)) {
+        annotWarn("Warning: %s is malformed!\n", line);
+        return 0;
+    }
+
+    oname = PyString_FromString(p->value.s);
+    if(!oname) return 1;
+    rv = PySet_Contains(p->duplicatedSet, oname);
+    if(rv) goto out;
+
+    //Exons preceding any transcript have nowhere to go
+    if(p->labelIdx >= PyList_GET_SIZE(p->exons)) goto out;
+    d = exonDict(p);
+    if(!d) goto error;
+    oexons = PyDict_GetItem(d, oname);
+    if(!oexons) {
+        oexons = PyList_New(0);
+        if(!oexons) goto error;
+        rv = PyDict_SetItem(d, oname, oexons);
+        Py_DECREF(oexons);
+        if(rv) goto error;
+    }
+    t = Py_BuildValue("(LL)", start - 1, end);
+    if(!t) goto error;
+    rv = PyList_Append(oexons, t);
+    Py_DECREF(t);
+
+out:
+    Py_DECREF(oname);
+    return (rv < 0) ? 1 : 0;
+
+error:
+    Py_DECREF(oname);
+    return 1;
+}
+
+//parseGTF(), the first line must be the first non-header line
+static int parseGTFfile(annotParser *p, kstream_t *ks, kstring_t *line, char *bname, char *defaultGroup, char *transcriptID, char *exonID, char *designator) {
+    int n;
+    char *fileLabel = NULL, *lineCopy = NULL;
+    kstring_t ksLabel = {0, 0, NULL};
+    kstring_t ksLine = {0, 0, NULL};
+    int rv = 1;
+
+    kputs(bname, &ksLabel);
+    if(uniqueName(p->labels, &ksLabel)) goto out;
+    fileLabel = ksLabel.s;
+
+    do {
+        if(line->s[0] == '#') continue;
+        while(line->l && (line->s[line->l - 1] == '\r' || line->s[line->l - 1] == '\n')) line->s[--line->l] = '\0';
+        if(line->l == 0) continue;
+
+        //Keep an unsplit copy for any warnings
+        ksLine.l = 0;
+        kputsn(line->s, line->l, &ksLine);
+        lineCopy = ksLine.s;
+        n = splitColumns(p, line->s);
+        if(n < 0) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        if(n < 3) {
+            annotWarn("Warning: non-GTF line encountered! %s\n", lineCopy);
+            continue;
+        }
+
+        if(strcasecmp(p->cols[2], transcriptID) == 0) {
+            if(parseGTFtranscript(p, n, lineCopy, fileLabel, defaultGroup, designator)) goto out;
+        } else if(p->keepExons && strcasecmp(p->cols[2], exonID) == 0) {
+            if(parseGTFexon(p, n, lineCopy, designator)) goto out;
+        }
+    } while(ks_getuntil(ks, KS_SEP_LINE, line, NULL) >= 0);
+    rv = 0;
+
+out:
+    free(ksLabel.s);
+    free(ksLine.s);
+    return rv;
+}
+
+static PyObject *pyAddFile(pyGTFtree_t *self, PyObject *args) {
+    char *fname = NULL, *transcriptID = NULL, *exonID = NULL, *designator = NULL, *bname = NULL, *defaultGroup = NULL;
+    long ncols, labelColumn, labelIdx;
+    int keepExons, rv = 1;
+    annotParser p;
+    annotFile *f = NULL;
+    kstream_t *ks = NULL;
+    kstring_t line = {0, 0, NULL};
+
+    memset(&p, 0, sizeof(annotParser));
+    if(!(PyArg_ParseTuple(args, "slliO!O!O!O!lssssz", &fname, &ncols, &labelColumn, &keepExons,
+                          &PyList_Type, &p.labels, &PyList_Type, &p.exons, &PyList_Type, &p.chroms,
+                          &PyList_Type, &p.duplicated, &labelIdx, &transcriptID, &exonID, &designator,
+                          &bname, &defaultGroup))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyAddFile received an invalid or missing argument!");
+        return NULL;
+    }
+    p.t = self->t;
+    p.keepExons = keepExons;
+    p.labelIdx = labelIdx;
+    p.duplicatedSet = PySet_New(p.duplicated);
+    if(!p.duplicatedSet) return NULL;
+
+    f = annotOpen(fname);
+    if(!f) {
+        PyErr_Format(PyExc_IOError, "Could not open %s", fname);
+        goto out;
+    }
+    ks = ks_init(f);
+    if(!ks) {
+        PyErr_NoMemory();
+        goto out;
+    }
+
+    //Skip the header
+    while(ks_getuntil(ks, KS_SEP_LINE, &line, NULL) >= 0) {
+        if(!isHeader(line.s)) break;
+    }
+    if(f->error) {
+        PyErr_Format(PyExc_IOError, "Error while reading %s", fname);
+        goto out;
+    }
+    if(!line.s || isHeader(line.s)) {
+        rv = 0;
+        goto out;
+    }
+
+    if(ncols == 0) {
+        rv = parseGTFfile(&p, ks, &line, bname, defaultGroup, transcriptID, exonID, designator);
+    } else {
+        rv = parseBEDfile(&p, ks, &line, (int) ncols, labelColumn, bname, defaultGroup);
+    }
+    if(!rv && f->error) {
+        PyErr_Format(PyExc_IOError, "Error while reading %s", fname);
+        rv = 1;
+    }
+
+out:
+    free(line.s);
+    free(p.rawChrom.s);
+    free(p.chrom.s);
+    free(p.label.s);
+    free(p.name.s);
+    free(p.value.s);
+    free(p.group.s);
+    free(p.cols);
+    Py_XDECREF(p.duplicatedSet);
+    if(ks) ks_destroy(ks);
+    annotClose(f);
+    if(rv) return NULL;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
 #if PY_MAJOR_VERSION >= 3
 PyMODINIT_FUNC PyInit_tree(void) {
     PyObject *res;
@@ -16,6 +16,7 @@ typedef struct {
 static PyObject *pyGTFinit(PyObject *self, PyObject *args);
 static PyObject *pyAddEntry(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyAddEnrichmentEntry(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyAddFile(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyVine2Tree(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyPrintGTFtree(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyCountEntries(pyGTFtree_t *self, PyObject *args);
@@ -32,6 +33,13 @@ static PyMethodDef treeMethods[] = {
 "Some documentation for pyAddEntry\n"},
     {"addEnrichmentEntry", (PyCFunction) pyAddEnrichmentEntry, METH_VARARGS,
 "Some documentation for pyAddEnrichmentEntry\n"},
+    {"addFile", (PyCFunction) pyAddFile, METH_VARARGS,
+"Add all of the entries in a (possibly gzip or bzip2 compressed) BED or GTF file.\n\
+The arguments are the file name, the number of BED columns (0 for GTF), the\n\
+label column (-1 for none), whether to keep exons, the label, exon,\n\
+chromosome and duplicated transcript lists (all updated in place), the current\n\
+label index, the transcript and exon features, the transcript ID attribute,\n\
+the file's base name and the default group (or None).\n"},
     {"finish", (PyCFunction) pyVine2Tree, METH_VARARGS,
 "This must be called after ALL entries from ALL files have been added.\n"},
     {"printGTFtree", (PyCFunction) pyPrintGTFtree, METH_VARARGS,
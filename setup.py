@@ -17,7 +17,7 @@ __version__ = '%s'
 
 srcs = [x for x in glob.glob("deeptoolsintervals/tree/*.c")]
 
-libs = ["z"]
+libs = ["z", "bz2"]
 additional_libs = [sysconfig.get_config_var("LIBDIR"), sysconfig.get_config_var("LIBPL")]
 
 module1 = Extension('deeptoolsintervals.tree',
@@ -85,7 +85,8 @@ setup(
              'bin/computeGCBias', 'bin/correctGCBias', 'bin/multiBigwigSummary',
              'bin/bigwigCompare', 'bin/plotCoverage', 'bin/plotPCA', 'bin/plotCorrelation',
              'bin/plotEnrichment', 'bin/deeptools', 'bin/computeMatrixOperations',
-             'bin/estimateReadFiltering', 'bin/alignmentSieve'],
+             'bin/estimateReadFiltering', 'bin/alignmentSieve', 'bin/plotBatch',
+             'bin/computeGCTrack'],
     include_package_data=True,
     url='http://pypi.python.org/pypi/deepTools/',
     license='LICENSE.txt',